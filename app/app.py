@@ -1,8 +1,13 @@
-import json, os, subprocess, re, io, time, hashlib, secrets
+import json, os, subprocess, re, io, shutil, signal, sys, time, hashlib, secrets
 from pathlib import Path
 from urllib.request import urlopen, Request
 from urllib.error import URLError
-from flask import Flask, jsonify, send_from_directory, Response, request
+from flask import Flask, jsonify, send_from_directory, send_file, Response, request
+
+try:
+    from . import flash_engine, image_index
+except ImportError:  # run as a script (job CLI): app/ is on sys.path
+    import flash_engine, image_index
 
 APP_PORT = int(os.environ.get("JR_GOLDEN_SD_PORT", "8025"))
 BASE_DIR = os.path.abspath(os.path.join(os.path.dirname(__file__), ".."))
@@ -40,7 +45,8 @@ def version_info():
     source = "env" if os.environ.get("JR_GOLDEN_SD_VERSION") else "git"
     return {"version": version, "describe": describe, "commit": commit, "dirty": dirty, "semver": semver, "source": source}
 
-CACHE_DIR = os.path.join(BASE_DIR, "cache")
+CACHE_DIR = os.environ.get("JR_GOLDEN_SD_CACHE_DIR") or os.path.join(BASE_DIR, "cache")
+SYSFS_ROOT = os.environ.get("JR_SYSFS_ROOT") or "/sys"
 
 app = Flask(__name__, static_folder=os.path.join(BASE_DIR, "static"))
 
@@ -67,6 +73,30 @@ def load_policy() -> dict:
             pol["write_word"] = w
             if "arm_ttl_seconds" in obj:
                 pol["arm_ttl_seconds"] = int(obj["arm_ttl_seconds"])
+            if "os_cache_quota_bytes" in obj:
+                pol["os_cache_quota_bytes"] = int(obj["os_cache_quota_bytes"])
+            if isinstance(obj.get("os_cache_variants"), dict):
+                pol["os_cache_variants"] = obj["os_cache_variants"]
+            if isinstance(obj.get("throughput_mbps"), dict):
+                pol["throughput_mbps"] = obj["throughput_mbps"]
+            if isinstance(obj.get("prefetch"), dict):
+                pol["prefetch"] = obj["prefetch"]
+            if isinstance(obj.get("peers"), list):
+                pol["peers"] = [str(x) for x in obj["peers"]]
+            if isinstance(obj.get("flash_engine"), dict):
+                pol["flash_engine"] = obj["flash_engine"]
+            if isinstance(obj.get("job_priority"), dict):
+                pol["job_priority"] = obj["job_priority"]
+            if isinstance(obj.get("thermal"), dict):
+                pol["thermal"] = obj["thermal"]
+            if isinstance(obj.get("bus"), dict):
+                pol["bus"] = obj["bus"]
+            if "cache_min_free_bytes" in obj:
+                pol["cache_min_free_bytes"] = int(obj["cache_min_free_bytes"])
+            if isinstance(obj.get("scrub"), dict):
+                pol["scrub"] = obj["scrub"]
+            if isinstance(obj.get("cache_tiers"), list):
+                pol["cache_tiers"] = [x for x in obj["cache_tiers"] if isinstance(x, dict) and x.get("path")]
     except Exception:
         pass
     return pol
@@ -205,9 +235,14 @@ def read_provider_files() -> list[dict]:
 def load_os_catalog() -> list[dict]:
     providers = read_provider_files()
     all_items = []
+    refreshed = False
     for p in providers:
         if p.get("type") == "imager_v4":
+            cpath = os.path.join(CACHE_DIR, f"{p['id']}.json")
+            before = os.path.getmtime(cpath) if os.path.exists(cpath) else 0
             data = cache_get(p["url"], f"{p['id']}.json", ttl_seconds=6*3600)
+            if os.path.exists(cpath) and os.path.getmtime(cpath) != before:
+                refreshed = True
             repo = json.loads(data.decode("utf-8", errors="replace"))
             items = flatten_imager_os(repo)
             for it in items:
@@ -229,6 +264,12 @@ def load_os_catalog() -> list[dict]:
                     "init_format": it.get("init_format"),
                 })
     all_items.sort(key=lambda x: (x["provider_id"], x["name"]))
+    if refreshed:
+        try:
+            prefetch_after_refresh(all_items)
+            maybe_start_scrub_job()
+        except Exception:
+            pass
     return all_items
 
 def find_os(os_id: str, catalog: list[dict]) -> dict | None:
@@ -237,10 +278,19 @@ def find_os(os_id: str, catalog: list[dict]) -> dict | None:
             return it
     return None
 
-def guess_decompress_cmd(url: str) -> str:
+def guess_decompress_cmd(url: str, path: str = "") -> str:
+    # Once the blob is cached its magic bytes decide; the URL suffix is only a hint before that
+    if path and os.path.exists(path):
+        return " ".join(flash_engine.decoder_argv(flash_engine.sniff_format(path)))
     u = (url or "").lower()
     if u.endswith(".img.xz") or u.endswith(".xz"):
         return "xz -dc"
+    if u.endswith(".gz"):
+        return "gzip -dc"
+    if u.endswith(".zst"):
+        return "zstd -dc"
+    if u.endswith(".bz2"):
+        return "bzip2 -dc"
     if u.endswith(".zip"):
         return "unzip -p"
     return "(unknown extractor)"
@@ -254,6 +304,7 @@ def safety_state() -> dict:
 
     m = detect_mode()
     root_parent = m["root_parent"]
+    tier_disks = cache_tier_disks()
 
     disks = []
     for d in obj.get("blockdevices", []):
@@ -278,9 +329,12 @@ def safety_state() -> dict:
             "rm": d.get("rm"),
             "rota": d.get("rota"),
             "is_root_disk": (d.get("name") == root_parent),
+            "cache_tier": tier_disks.get(name),
+            "topology": device_topology(name),
         })
 
-    eligible = [x for x in disks if not x["is_root_disk"]]
+    # a disk holding a cache tier would be unmounted and overwritten together with the images on it
+    eligible = [x for x in disks if not x["is_root_disk"] and not x["cache_tier"]]
     return {
         "mode": m["mode"],
         "root_source": m["root_source"],
@@ -290,38 +344,232 @@ def safety_state() -> dict:
         "can_flash_here": (m["mode"] == "SD"),
     }
 
+# ---------------- device topology (bus path + link speed) ----------------
+# Which host controller / hub / port a disk hangs off and the USB speed it enumerated at, read from
+# sysfs (SYSFS_ROOT). Disks on the same controller share its bandwidth; "bus" is the key for that.
+
+# usable MB/s of a USB link at each negotiated speed (Mbit/s in sysfs "speed")
+USB_LINK_MBPS = {1.5: 0.1, 12: 1, 480: 38, 5000: 400, 10000: 800, 20000: 1600}
+PCI_ADDR_RE = re.compile(r"^[0-9a-f]{4}:[0-9a-f]{2}:[0-9a-f]{2}\.[0-7]$")
+
+def device_topology(name: str) -> dict:
+    """{"bus", "controller", "usb": {port, busnum, devpath, speed_mbit, version, hubs, link_mbps}} for /dev/<name>."""
+    real = os.path.realpath(os.path.join(SYSFS_ROOT, "block", name, "device"))
+    if not os.path.exists(real):
+        return {"bus": None, "controller": None, "usb": None}
+    devices = os.path.join(os.path.realpath(SYSFS_ROOT), "devices")
+    parts = os.path.relpath(real, devices).split(os.sep)
+    roots = [i for i, p in enumerate(parts) if re.fullmatch(r"usb\d+", p)]
+    if roots:
+        i = roots[-1]
+        controller = parts[i - 1] if i else parts[0]
+        ports = [p for p in parts[i + 1:] if re.fullmatch(r"\d+-[\d.]+", p)]
+        port_dir = os.path.join(devices, *parts[:parts.index(ports[-1]) + 1]) if ports else ""
+
+        def attr(key):
+            try:
+                with open(os.path.join(port_dir, key), "r", encoding="utf-8") as f:
+                    return f.read().strip()
+            except OSError:
+                return None
+
+        try:
+            speed = float(attr("speed") or 0)
+        except ValueError:
+            speed = 0.0
+        speed = int(speed) if speed.is_integer() else speed
+        usb = {
+            "port": ports[-1] if ports else None,
+            "busnum": int(attr("busnum") or 0) or None,
+            "devpath": attr("devpath"),
+            "speed_mbit": speed or None,
+            "version": (attr("version") or "").strip() or None,
+            "hubs": ports[:-1],
+            "link_mbps": USB_LINK_MBPS.get(speed),
+        }
+        # the USB 2 and USB 3 root hubs of one xHCI controller are separate buses
+        return {"bus": f"usb:{controller}/{parts[i]}", "controller": controller, "usb": usb}
+    pci = [p for p in parts if PCI_ADDR_RE.match(p)]
+    controller = pci[-1] if pci else (parts[-2] if len(parts) > 1 else parts[0])
+    return {"bus": f"{'pci' if pci else parts[0]}:{controller}", "controller": controller, "usb": None}
+
+def target_rate_key(dev: dict) -> str:
+    tran = str(dev.get("tran") or "").lower()
+    if str(dev.get("name") or "").startswith("mmcblk"):
+        tran = "mmc"
+    return f"target_{tran}"
+
+def predict_target_mbps(dev: dict, sharing: int = 1) -> dict:
+    """
+    Expected write rate for dev: the learned rate for its class (tune_profiles.json) or the per-tran
+    default, capped by its USB link split between the `sharing` targets writing on that bus.
+    """
+    rates = throughput_mbps()
+    device = rates.get(target_rate_key(dev), rates["target_default"])
+    learned = (os_meta_load(tune_profiles_path()).get(tune_profile_key(dev)) or {}).get("mbps")
+    if learned:
+        device = float(learned)
+    link = ((dev.get("topology") or {}).get("usb") or {}).get("link_mbps")
+    if not link:
+        return {"mbps": round(device, 1), "limit": "learned" if learned else "device", "link_mbps": None, "sharing": sharing}
+    share = link / max(1, sharing)
+    return {"mbps": round(min(device, share), 1), "limit": "link" if share < device else ("learned" if learned else "device"),
+            "link_mbps": link, "sharing": sharing}
+
+def bus_topology_settings() -> dict:
+    """policy.bus = {"max_per_bus": 0}: >0 makes flash jobs wait while that many targets already write on their bus."""
+    cfg = load_policy().get("bus") or {}
+    return {"max_per_bus": max(0, int(cfg.get("max_per_bus", 0) or 0))}
+
+def bus_writers(before: float | None = None, exclude: str = "") -> dict:
+    """bus -> [(job_id, target)] for running flash jobs (optionally only those created before `before`)."""
+    out = {}
+    for jid in job_ids():
+        job = job_load(jid)
+        if not job or job.get("type") != "flash" or job.get("status") != "running" or job.get("id") == exclude:
+            continue
+        if not job_is_alive(int(job.get("pid", 0) or 0)) or os.path.exists(job.get("rc_path") or ""):
+            continue
+        if before is not None and float(job.get("created_at") or 0) >= before:
+            continue
+        for target, bus in ((job.get("meta") or {}).get("buses") or {}).items():
+            if bus:
+                out.setdefault(bus, []).append((job["id"], target))
+    return out
+
+def predict_targets(devs: list) -> dict:
+    """path -> predict_target_mbps for targets written together, counting running flash jobs on each bus."""
+    busy = bus_writers()
+    mine = {}
+    for d in devs:
+        bus = (d.get("topology") or {}).get("bus")
+        mine[bus] = mine.get(bus, 0) + 1
+    out = {}
+    for d in devs:
+        bus = (d.get("topology") or {}).get("bus")
+        out[d["path"]] = {"bus": bus, **predict_target_mbps(d, mine[bus] + len(busy.get(bus, [])) if bus else 1)}
+    return out
+
+def bus_wait(job_id: str, poll_s: float = 5.0) -> int:
+    """Called from a flash job before writing: wait (FIFO by job age) for room on its targets' buses."""
+    limit = bus_topology_settings()["max_per_bus"]
+    job = {}
+    for _ in range(50):  # the job record is saved right after the script starts
+        job = job_load(job_id) or {}
+        if job or not limit:
+            break
+        time.sleep(0.1)
+    mine = (job.get("meta") or {}).get("buses") or {}
+    last = None
+    while limit:
+        busy = bus_writers(before=float(job.get("created_at") or time.time()), exclude=job_id)
+        full = sorted({b for b in mine.values() if b and len(busy.get(b, [])) >= limit})
+        if not full:
+            break
+        if full != last:
+            print(f"WAITING: bus {', '.join(full)} busy ({', '.join(j for b in full for j, _ in busy[b])})", flush=True)
+            last = full
+        time.sleep(poll_s)
+    return 0
+
 # ---------------- arming state (still no writes) ----------------
 
 def arm_state_path() -> str:
     ensure_cache_dir()
     return os.path.join(CACHE_DIR, "arm_state.json")
 
-def load_arm_state() -> dict | None:
+def load_arms() -> dict:
+    """All unexpired arms, keyed by target. Several targets can be armed at once for /api/flash_multi."""
     path = arm_state_path()
     if not os.path.exists(path):
-        return None
+        return {}
     try:
         with open(path, "r", encoding="utf-8") as f:
-            st = json.load(f)
-        if float(st.get("expires_at", 0)) < time.time():
-            return None
-        return st
+            obj = json.load(f)
     except Exception:
+        return {}
+    if not isinstance(obj, dict):
+        return {}
+    arms = obj.get("arms") if "arms" in obj else {obj.get("target"): obj}   # single-arm file from older builds
+    now = time.time()
+    out = {}
+    for target, st in (arms or {}).items():
+        try:
+            if target and isinstance(st, dict) and float(st.get("expires_at", 0)) >= now:
+                out[target] = st
+        except (TypeError, ValueError):
+            continue
+    return out
+
+def load_arm_state(target: str | None = None) -> dict | None:
+    """The arm for target, or (no target) the most recently issued one."""
+    arms = load_arms()
+    if target is not None:
+        return arms.get(target)
+    if not arms:
         return None
+    return max(arms.values(), key=lambda st: float(st.get("issued_at", 0) or 0))
 
 def save_arm_state(st: dict):
     path = arm_state_path()
-    with open(path, "w", encoding="utf-8") as f:
-        json.dump(st, f)
-
-def clear_arm_state():
+    arms = load_arms()
+    arms[st["target"]] = st
+    tmp = path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump({"arms": arms}, f)
+    os.replace(tmp, path)
+
+def clear_arm_state(target: str | None = None):
     path = arm_state_path()
     try:
-        if os.path.exists(path):
+        arms = load_arms() if target is not None else {}
+        arms.pop(target, None)
+        if arms:
+            tmp = path + ".tmp"
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump({"arms": arms}, f)
+            os.replace(tmp, path)
+        elif os.path.exists(path):
             os.remove(path)
     except Exception:
         pass
 
+def flash_arm_error(target: str, os_id: str, token: str, confirm_target: str, serial_suffix: str,
+                    eligible: dict) -> tuple[str, str]:
+    """
+    Check one target against its arm. Returns (error, os_id); os_id falls back to the armed one.
+    """
+    if not target or target not in eligible:
+        return "Target is not eligible (root disk is blocked).", os_id
+    if confirm_target and confirm_target != target:
+        return "Target confirmation does not match exactly.", os_id
+
+    armed = load_arm_state(target)
+    if not armed:
+        if load_arms():
+            return "ARM state target does not match requested target.", os_id
+        return "Not armed. Call /api/arm first.", os_id
+
+    if float(armed.get("expires_at") or 0) <= time.time():
+        clear_arm_state(target)
+        return "ARM token expired. Re-arm and try again.", os_id
+
+    if not os_id:
+        os_id = str(armed.get("os_id") or "").strip()
+    if not os_id:
+        return "os_id required (and must match what you armed with).", os_id
+    if armed.get("os_id") and armed.get("os_id") != os_id:
+        return "ARM state os_id does not match requested os_id.", os_id
+
+    if not token or token != str(armed.get("token") or ""):
+        return "Invalid or missing token. Use the token returned by /api/arm.", os_id
+
+    if serial_suffix:
+        actual = (eligible[target].get("serial") or "")
+        if actual and not actual.endswith(serial_suffix):
+            return "Serial suffix does not match target disk.", os_id
+    return "", os_id
+
 
 # ---------------- jobs (downloads, later flash) ----------------
 
@@ -347,6 +595,10 @@ def job_load(job_id: str) -> dict | None:
     except Exception:
         return None
 
+def job_ids() -> list[str]:
+    """Jobs on disk: <id>.json, not the <id>.engine.json / <id>.telemetry.json written beside them."""
+    return [fn[:-len(".json")] for fn in os.listdir(jobs_dir()) if fn.endswith(".json") and "." not in fn[:-len(".json")]]
+
 def job_save(job: dict):
     job["updated_at"] = time.time()
     with open(job_file(job["id"]), "w", encoding="utf-8") as f:
@@ -375,7 +627,7 @@ def job_refresh(job: dict) -> dict:
             _jid = job.get('id') or job.get('job_id')
             _jid = str(_jid) if _jid is not None else ''
             if _jid and re.fullmatch(r"[A-Za-z0-9_-]+", _jid):
-                rc_path = Path('cache/jobs') / (_jid + '.rc')
+                rc_path = Path(jobs_dir()) / (_jid + '.rc')
                 if rc_path.exists():
                     rc_txt = rc_path.read_text(encoding='utf-8', errors='ignore').strip()
                     try:
@@ -398,23 +650,143 @@ def job_refresh(job: dict) -> dict:
             job.setdefault('status_note', 'status_enrich_error: ' + str(e))
     return job
 
-def start_job(job_type: str, script_body: str, meta: dict) -> dict:
+def job_stop(job: dict, note: str):
+    """SIGTERM a running job's process group (start_job gives each its own session); the job exits 143."""
+    pid = int(job.get("pid", 0) or 0)
+    if pid > 0 and job_is_alive(pid):
+        try:
+            os.killpg(pid, signal.SIGTERM)
+        except OSError:
+            pass
+    job.setdefault("meta", {})["stopped"] = note
+    job_save(job)
+
+# Scheduling class per job type. The web UI (gunicorn) stays at nice 0 / best-effort 4, so an
+# interactive flash competes only with it, and background work yields to both.
+#   ionice: [class, level] (1 realtime, 2 best-effort 0-7, 3 idle)    nice: -20..19
+#   cpus: "0-2" / [0, 1]    io_max: "wbps=20M" (cache disk) or "MAJ:MIN ..."    cpu_max: "50000 100000"
+JOB_PRIORITY_DEFAULTS = {
+    "flash": {"ionice": [2, 0], "nice": 0},
+    "download_os": {"ionice": [2, 4], "nice": 5},
+    "prefetch": {"ionice": [3, 0], "nice": 19},
+    "os_variant": {"ionice": [3, 0], "nice": 19, "cpu_max": "50000 100000"},
+    "cache_tier": {"ionice": [3, 0], "nice": 19},
+    "scrub": {"ionice": [3, 0], "nice": 19},
+    "os_custom": {"ionice": [3, 0], "nice": 19},
+    "os_index": {"ionice": [3, 0], "nice": 19},
+}
+
+def job_priority(job_type: str) -> dict:
+    """Defaults for job_type overlaid with policy.job_priority[job_type] (policy.job_priority["*"] first)."""
+    cfg = load_policy().get("job_priority") or {}
+    out = dict(JOB_PRIORITY_DEFAULTS.get(job_type) or {})
+    for key in ("*", job_type):
+        if isinstance(cfg.get(key), dict):
+            out.update(cfg[key])
+    out["cgroup_root"] = str(cfg.get("cgroup_root") or os.environ.get("JR_GOLDEN_SD_CGROUP", "")).strip()
+    return out
+
+def parse_cpus(spec) -> set:
+    if isinstance(spec, list):
+        return {int(x) for x in spec}
+    out = set()
+    for part in str(spec or "").split(","):
+        part = part.strip()
+        if "-" in part:
+            a, b = part.split("-", 1)
+            out.update(range(int(a), int(b) + 1))
+        elif part:
+            out.add(int(part))
+    return out
+
+def cache_disk_devno() -> str:
+    """MAJ:MIN of the disk holding CACHE_DIR (io.max wants the whole disk, not the partition)."""
+    st = os.stat(CACHE_DIR)
+    d = os.path.join(SYSFS_ROOT, "dev", "block", f"{os.major(st.st_dev)}:{os.minor(st.st_dev)}")
+    if os.path.exists(os.path.join(d, "partition")):
+        with open(os.path.join(os.path.realpath(d), "..", "dev"), "r", encoding="utf-8") as f:
+            return f.read().strip()
+    return f"{os.major(st.st_dev)}:{os.minor(st.st_dev)}"
+
+def job_cgroup(job_type: str, prio: dict) -> tuple[str, list]:
+    """
+    cgroup v2 group for job_type under cgroup_root (delegated to the service user, e.g. systemd
+    Delegate=yes), with io.max / cpu.max applied. Returns (cgroup.procs path or "", notes).
+    """
+    root = prio.get("cgroup_root")
+    if not root or not (prio.get("io_max") or prio.get("cpu_max")):
+        return "", []
+    notes = []
+    try:
+        d = os.path.join(root, re.sub(r"[^a-z0-9_]+", "_", job_type))
+        os.makedirs(d, exist_ok=True)
+        if prio.get("cpu_max"):
+            Path(d, "cpu.max").write_text(str(prio["cpu_max"]) + "\n")
+        if prio.get("io_max"):
+            io = str(prio["io_max"])
+            Path(d, "io.max").write_text((io if ":" in io.split()[0] else f"{cache_disk_devno()} {io}") + "\n")
+        return os.path.join(d, "cgroup.procs"), notes
+    except OSError as e:
+        notes.append(f"cgroup: {e}")
+        return "", notes
+
+def job_priority_argv(prio: dict) -> list:
+    """
+    nice / taskset / ionice prefixes for the job's argv. They exec the script, so no Python runs between
+    fork and exec (preexec_fn isn't safe in a threaded server). Unusable settings leave the default.
+    """
+    argv = []
+    try:
+        nice = max(-20, min(19, int(prio.get("nice", 0))))
+        argv += ["nice", "-n", str(nice)] if nice else []
+    except (TypeError, ValueError):
+        pass
+    if prio.get("cpus") not in (None, "", []) and shutil.which("taskset"):
+        try:
+            argv += ["taskset", "-c", ",".join(str(c) for c in sorted(parse_cpus(prio["cpus"])))]
+        except ValueError:
+            pass
+    ionice = prio.get("ionice")
+    if isinstance(ionice, list) and ionice and shutil.which("ionice"):
+        argv += ["ionice", "-c", str(int(ionice[0]))] + (["-n", str(int(ionice[1]))] if len(ionice) > 1 and int(ionice[0]) != 3 else [])
+    return argv
+
+def start_job(job_type: str, script_body: str, meta: dict, on_exit: str = "") -> dict:
+    """Run script_body as a background job. on_exit is a command run as the script exits, before its rc lands."""
     jid = secrets.token_hex(8)
     d = jobs_dir()
     script_path = os.path.join(d, f"{jid}.sh")
     log_path = os.path.join(d, f"{jid}.log")
     rc_path = os.path.join(d, f"{jid}.rc")
 
+    engine_status_path = os.path.join(d, f"{jid}.engine.json")
+
+    prio = job_priority(job_type)
+    procs, prio_notes = job_cgroup(job_type, prio)
+
     script = "#!/bin/bash\n"
     script += "set -euo pipefail\n"
-    script += f"trap 'echo $? > {shlex_quote(rc_path)}' EXIT\n"
+    if procs:
+        # join the cgroup before anything forks, so every child of the job is in it
+        script += f"echo $$ 2>/dev/null > {shlex_quote(procs)} || echo {shlex_quote('cgroup: could not join ' + procs)}\n"
+    if on_exit:
+        # pollers see the job as running until on_exit is done, so nothing reads a half-finished record
+        script += f"jr_on_exit() {{ local rc=$?; {on_exit} || true; echo $rc > {shlex_quote(rc_path)}; }}\n"
+        script += "trap jr_on_exit EXIT\n"
+    else:
+        script += f"trap 'echo $? > {shlex_quote(rc_path)}' EXIT\n"
+    script += "trap 'exit 143' TERM\n"
+    script += f"JR_JOB_ID={jid}\n"
+    script += f"JR_ENGINE_STATUS={shlex_quote(engine_status_path)}\n"
+    script += f"{shlex_quote(sys.executable)} {shlex_quote(os.path.abspath(__file__))} telemetry {jid} --pid $$ --type {shlex_quote(job_type)} </dev/null || true &\n"
     script += script_body.strip() + "\n"
 
     Path(script_path).write_text(script)
     os.chmod(script_path, 0o700)
 
+    argv = job_priority_argv(prio) + ["bash", script_path]
     lf = open(log_path, "ab", buffering=0)
-    proc = subprocess.Popen(["bash", script_path], stdout=lf, stderr=subprocess.STDOUT, start_new_session=True)
+    proc = subprocess.Popen(argv, stdout=lf, stderr=subprocess.STDOUT, start_new_session=True)
 
     job = {
         "id": jid,
@@ -426,11 +798,55 @@ def start_job(job_type: str, script_body: str, meta: dict) -> dict:
         "script_path": script_path,
         "log_path": log_path,
         "rc_path": rc_path,
+        "engine_status_path": engine_status_path,
+        "priority": {**{k: v for k, v in prio.items() if k != "cgroup_root"}, "cgroup": os.path.dirname(procs) or None,
+                     "notes": prio_notes},
         "meta": meta or {},
     }
     job_save(job)
     return job
 
+def job_absorb_engine(job: dict, engine: dict):
+    """Copy the outcome of a finished engine run into the job record (once; `app.py engine-absorb` as the job exits)."""
+    if engine.get("phase") not in ("done", "partial", "failed") or job.get("engine_absorbed"):
+        return
+    meta = job.setdefault("meta", {})
+    if engine.get("extract_verify"):
+        meta["extract_verify"] = engine["extract_verify"]
+    if engine.get("readback"):
+        meta["readback_verify"] = engine["readback"]
+    if engine.get("source_verify"):
+        meta["source_verify"] = engine["source_verify"]
+        flash_source_verified(job, engine["source_verify"])
+    if engine.get("delta"):
+        meta["delta"] = engine["delta"]
+    if engine.get("trim"):
+        meta["trim"] = engine["trim"]
+    if engine.get("resume"):
+        meta["resume"] = {k: v for k, v in engine["resume"].items() if k != "prefix_sha256"}
+    if len(engine.get("targets") or []) > 1:
+        meta["target_results"] = [
+            {k: t.get(k) for k in ("target", "ok", "phase", "bytes_written", "mbps", "readback", "errors")}
+            for t in engine["targets"]
+        ]
+    if engine.get("phase") in ("done", "partial"):
+        record_decode_stats(engine)
+        record_tune_profiles(job, engine)
+        job["decode"] = {"format": engine.get("format"), **(engine.get("decoder") or {})}
+    job["engine_absorbed"] = True
+    job_save({k: v for k, v in job.items() if k != "engine"})
+
+def job_engine_status(job: dict) -> dict | None:
+    """Progress/result JSON a native engine (flash_engine.py) keeps next to the job log."""
+    path = job.get("engine_status_path")
+    if not path or not os.path.exists(path):
+        return None
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            return json.load(f)
+    except Exception:
+        return None
+
 def shlex_quote(s: str) -> str:
     import shlex
     return shlex.quote(s)
@@ -444,16 +860,1772 @@ def os_cache_dir() -> str:
 def os_cache_key(os_id: str, url: str) -> str:
     return hashlib.sha1((os_id + "|" + url).encode("utf-8")).hexdigest()[:16]
 
-def os_cache_paths(os_id: str, url: str) -> dict:
+# ---------------- thermal telemetry + pacing ----------------
+# Every job gets a sampler (app.py telemetry) that records SoC temperature, CPU clock and the
+# firmware throttle flags into cache/jobs/<id>.telemetry.json. For low-priority job types it
+# also paces: the job's process group is stopped (SIGSTOP) while the SoC is near its limit and
+# continued once it has cooled, so a prefetch never pushes an interactive flash into throttling.
+# All reads go through SYSFS_ROOT (JR_SYSFS_ROOT) so the logic can run against a fake tree.
+
+THERMAL_DEFAULTS = {
+    "interval_s": 5,
+    "pause_c": None,            # None: 5C below the lowest passive trip point, else 80C
+    "resume_c": None,           # None: pause_c - 8C
+    "pause_on_throttle": True,  # firmware says throttled / soft temp limit right now
+    "max_pause_s": 1800,        # then let the job run anyway rather than starve it
+    "pace": ["prefetch", "os_variant", "cache_tier", "scrub", "os_custom", "os_index"],
+    "keep_samples": 720,
+}
+
+# Raspberry Pi firmware get_throttled bits (low half: now, high half: since boot)
+THROTTLE_FLAGS = {0: "under_voltage", 1: "freq_capped", 2: "throttled", 3: "soft_temp_limit"}
+
+def thermal_policy() -> dict:
+    out = dict(THERMAL_DEFAULTS)
+    out.update(load_policy().get("thermal") or {})
+    return out
+
+def sysfs_read(*parts) -> str | None:
+    try:
+        with open(os.path.join(SYSFS_ROOT, *parts), "r", encoding="utf-8") as f:
+            return f.read().strip()
+    except (OSError, UnicodeDecodeError):
+        return None
+
+def read_throttled() -> int | None:
+    """get_throttled as an int: firmware sysfs attribute, else vcgencmd on a real /sys."""
+    import glob
+    for pat in ("devices/platform/soc/soc:firmware/get_throttled", "devices/platform/*firmware*/get_throttled"):
+        for path in sorted(glob.glob(os.path.join(SYSFS_ROOT, pat))):
+            try:
+                return int(Path(path).read_text().strip(), 16)
+            except (OSError, ValueError):
+                continue
+    if SYSFS_ROOT == "/sys" and shutil.which("vcgencmd"):
+        try:
+            out = subprocess.run(["vcgencmd", "get_throttled"], capture_output=True, text=True, timeout=3).stdout
+            return int(out.strip().split("=", 1)[-1], 16)
+        except (OSError, ValueError, subprocess.SubprocessError):
+            return None
+    return None
+
+def thermal_state() -> dict:
+    """One sample: thermal zones (C), hottest zone, CPU clock (MHz), decoded throttle flags."""
+    import glob
+    zones = []
+    for d in sorted(glob.glob(os.path.join(SYSFS_ROOT, "class", "thermal", "thermal_zone*"))):
+        name = os.path.basename(d)
+        try:
+            temp = int(sysfs_read("class", "thermal", name, "temp")) / 1000.0
+        except (TypeError, ValueError):
+            continue
+        passive = []
+        for tp in glob.glob(os.path.join(d, "trip_point_*_type")):
+            if Path(tp).read_text().strip() == "passive":
+                try:
+                    passive.append(int(Path(tp[:-len("type")] + "temp").read_text()) / 1000.0)
+                except (OSError, ValueError):
+                    pass
+        zones.append({"zone": name, "type": sysfs_read("class", "thermal", name, "type"), "temp_c": round(temp, 1),
+                      "passive_c": min(passive) if passive else None})
+    cur = sysfs_read("devices", "system", "cpu", "cpu0", "cpufreq", "scaling_cur_freq")
+    top = sysfs_read("devices", "system", "cpu", "cpu0", "cpufreq", "cpuinfo_max_freq")
+    raw = read_throttled()
+    return {
+        "at": time.time(),
+        "temp_c": max((z["temp_c"] for z in zones), default=None),
+        "zones": zones,
+        "cpu_mhz": int(cur) // 1000 if cur and cur.isdigit() else None,
+        "cpu_max_mhz": int(top) // 1000 if top and top.isdigit() else None,
+        "throttled_raw": None if raw is None else hex(raw),
+        "throttled_now": [n for b, n in THROTTLE_FLAGS.items() if raw is not None and raw >> b & 1],
+        "throttled_since_boot": [n for b, n in THROTTLE_FLAGS.items() if raw is not None and raw >> (b + 16) & 1],
+    }
+
+def thermal_limits(pol: dict, st: dict) -> tuple[float, float]:
+    pause = pol.get("pause_c")
+    if pause is None:
+        passive = [z["passive_c"] for z in st.get("zones") or [] if z.get("passive_c")]
+        pause = min(passive) - 5 if passive else 80.0
+    resume = pol.get("resume_c")
+    return float(pause), float(resume if resume is not None else float(pause) - 8)
+
+def thermal_hot(pol: dict, st: dict, paused: bool) -> str:
+    """Reason to hold a paced job ("" = run). Hysteresis: a paused job waits for resume_c."""
+    pause_c, resume_c = thermal_limits(pol, st)
+    temp = st.get("temp_c")
+    if temp is not None and temp >= (resume_c if paused else pause_c):
+        return f"{temp:.1f}C (limit {pause_c:.0f}C)"
+    busy = [f for f in st.get("throttled_now") or [] if f in ("throttled", "soft_temp_limit")]
+    if pol.get("pause_on_throttle") and busy:
+        return "firmware " + "+".join(busy)
+    return ""
+
+def job_telemetry_path(job_id: str) -> str:
+    return os.path.join(jobs_dir(), f"{job_id}.telemetry.json")
+
+def job_telemetry_loop(job_id: str, pid: int, job_type: str) -> int:
+    """Sampler for one job; runs until the job writes its rc file or its process goes away."""
+    os.setsid()  # own process group, so pausing the job never stops the sampler
+    pol = thermal_policy()
+    pace = job_type in (pol.get("pace") or [])
+    rc_path = os.path.join(jobs_dir(), f"{job_id}.rc")
+    out = job_telemetry_path(job_id)
+    tel = {"paced": pace, "samples": [], "max_temp_c": None, "min_cpu_mhz": None, "throttled_seen": [],
+           "paused": False, "paused_s": 0.0, "pauses": 0}
+    paused_at = None
+    last_flags = []
+    interval = max(1.0, float(pol.get("interval_s") or 5))
+
+    def signal_job(sig):
+        try:
+            os.killpg(pid, sig)
+        except OSError:
+            pass
+
+    try:
+        while job_is_alive(pid) and not os.path.exists(rc_path):
+            st = thermal_state()
+            tel["samples"].append({"at": round(st["at"], 1), "temp_c": st["temp_c"], "cpu_mhz": st["cpu_mhz"],
+                                   "throttled": st["throttled_raw"]})
+            del tel["samples"][:-int(pol.get("keep_samples") or 720)]
+            if st["temp_c"] is not None:
+                tel["max_temp_c"] = max(tel["max_temp_c"] or st["temp_c"], st["temp_c"])
+            if st["cpu_mhz"] is not None:
+                tel["min_cpu_mhz"] = min(tel["min_cpu_mhz"] or st["cpu_mhz"], st["cpu_mhz"])
+            tel["throttled_seen"] = sorted(set(tel["throttled_seen"]) | set(st["throttled_now"]))
+            tel["last"] = st
+            if st["throttled_now"] != last_flags:
+                print(f"THERMAL: throttle flags now {','.join(st['throttled_now']) or 'clear'}"
+                      f" ({st['temp_c']}C, {st['cpu_mhz']} MHz)", flush=True)
+                last_flags = st["throttled_now"]
+
+            if pace:
+                why = thermal_hot(pol, st, paused_at is not None)
+                if why and paused_at is None:
+                    print(f"THERMAL: pausing job, SoC at {why}", flush=True)
+                    signal_job(signal.SIGSTOP)
+                    paused_at = time.time()
+                    tel["pauses"] += 1
+                elif paused_at is not None and (not why or time.time() - paused_at >= float(pol.get("max_pause_s") or 1800)):
+                    print("THERMAL: resuming job" + (f" after max_pause_s, still {why}" if why else ""), flush=True)
+                    signal_job(signal.SIGCONT)
+                    tel["paused_s"] += time.time() - paused_at
+                    paused_at = None
+            tel["paused"] = paused_at is not None
+            tel["updated_at"] = time.time()
+            with open(out + ".tmp", "w", encoding="utf-8") as f:
+                json.dump(tel, f)
+            os.replace(out + ".tmp", out)
+            time.sleep(interval)
+    finally:
+        if paused_at is not None:
+            signal_job(signal.SIGCONT)
+    return 0
+
+def job_telemetry(job: dict) -> dict | None:
+    """Summary for the job API: everything but the full sample series (last 12 kept)."""
+    try:
+        with open(job_telemetry_path(job["id"]), "r", encoding="utf-8") as f:
+            tel = json.load(f)
+    except Exception:
+        return None
+    tel["samples_n"] = len(tel.get("samples") or [])
+    tel["samples"] = (tel.get("samples") or [])[-12:]
+    return tel
+
+# ---------------- OS image store (content-addressed) ----------------
+#
+# cache/os/blobs/<sha256>   image bytes exactly as downloaded, one copy per hash
+# cache/os/<key>.meta.json  per-os_id entry; "blob" points at the sha256 above
+# Blobs (and their variants) may instead live on a faster cache tier, <tier>/os/blobs/<sha256>.
+
+_SHA256_RE = re.compile(r"^[0-9a-f]{64}$")
+_OS_CACHE_MIGRATED = False
+
+def os_blob_dir() -> str:
+    d = os.path.join(os_cache_dir(), "blobs")
+    os.makedirs(d, exist_ok=True)
+    return d
+
+def os_blob_path(sha256: str) -> str:
+    """The blob on the first cache tier holding it, else where it would be on the boot cache."""
+    for tier in cache_tiers()[:-1]:
+        path = os.path.join(tier["blobs"], sha256)
+        if tier["available"] and os.path.exists(path):
+            return path
+    return os.path.join(os_blob_dir(), sha256)
+
+def norm_sha256(value) -> str:
+    v = str(value or "").strip().lower()
+    return v if _SHA256_RE.match(v) else ""
+
+def sha256_file(path: str, bufsize: int = 4 * 1024 * 1024, rate_mbps: float = 0) -> str:
+    """sha256 of a file, read at most rate_mbps MB/s when set; its pages are dropped afterwards."""
+    h = hashlib.sha256()
+    start = time.monotonic()
+    done = 0
+    with open(path, "rb") as f:
+        while True:
+            b = f.read(bufsize)
+            if not b:
+                break
+            h.update(b)
+            done += len(b)
+            if rate_mbps > 0:
+                ahead = done / (rate_mbps * 1e6) - (time.monotonic() - start)
+                if ahead > 0:
+                    time.sleep(ahead)
+        flash_engine.drop_cache(f.fileno())
+    return h.hexdigest()
+
+def os_meta_load(meta_path: str) -> dict:
+    if not os.path.exists(meta_path):
+        return {}
+    try:
+        with open(meta_path, "r", encoding="utf-8") as f:
+            obj = json.load(f)
+        return obj if isinstance(obj, dict) else {}
+    except Exception:
+        return {}
+
+def os_meta_save(meta_path: str, meta: dict):
+    tmp = meta_path + ".tmp"
+    with open(tmp, "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    os.replace(tmp, meta_path)
+
+def os_cache_legacy_unhashed() -> list[str]:
+    """Legacy cache/os/<key>.bin files whose download never recorded sha256_actual."""
+    d = os_cache_dir()
+    return [os.path.join(d, fn) for fn in sorted(os.listdir(d)) if fn.endswith(".bin")
+            and not norm_sha256(os_meta_load(os.path.join(d, fn[:-len(".bin")] + ".meta.json")).get("sha256_actual"))]
+
+def migrate_os_cache(rehash: bool = False, rate_mbps: float = 0):
+    """
+    Move legacy cache/os/<key>.bin files into the blob store. Entries whose download recorded
+    sha256_actual are just renamed (once per process, from os_cache_paths); entries without it stay
+    where they are, still usable as <key>.bin, until the scrub job hashes them (rehash=True), so no
+    request ever hashes an image.
+    """
+    global _OS_CACHE_MIGRATED
+    if _OS_CACHE_MIGRATED and not rehash:
+        return
+    _OS_CACHE_MIGRATED = True
+    d = os_cache_dir()
+    for fn in sorted(os.listdir(d)):
+        if not fn.endswith(".bin"):
+            continue
+        legacy = os.path.join(d, fn)
+        meta_path = os.path.join(d, fn[:-len(".bin")] + ".meta.json")
+        meta = os_meta_load(meta_path)
+        try:
+            sha = norm_sha256(meta.get("sha256_actual"))
+            if not sha and rehash:
+                sha = sha256_file(legacy, rate_mbps=rate_mbps)
+                print(f"LEGACY {fn} hashed to {sha}", flush=True)
+            if not sha:
+                continue
+            blob = os_blob_path(sha)
+            if os.path.exists(blob):
+                os.remove(legacy)
+            else:
+                os.replace(legacy, blob)
+                if rehash:
+                    os_blob_memo_record(sha, sha, "migrate")
+        except Exception:
+            continue
+        meta["blob"] = sha
+        meta["sha256_actual"] = sha
+        meta["size_bytes"] = os.path.getsize(blob)
+        meta["path"] = blob
+        meta["migrated_at"] = time.time()
+        os_meta_save(meta_path, meta)
+
+def os_cache_paths(os_id: str, url: str, expect_sha256: str = "") -> dict:
+    """
+    Resolve the cache entry for os_id. "bin" is the blob the entry points at, or the
+    blob named by the publisher hash when the entry has not been recorded yet.
+    """
+    migrate_os_cache()
     key = os_cache_key(os_id, url)
     base = os.path.join(os_cache_dir(), key)
+    meta_path = base + ".meta.json"
+    blob = norm_sha256(os_meta_load(meta_path).get("blob")) or norm_sha256(expect_sha256)
     return {
         "key": key,
         "base": base,
-        "meta": base + ".meta.json",
-        "bin":  base + ".bin"
+        "meta": meta_path,
+        "bmap": base + ".bmap",
+        "blob": blob or None,
+        "bin":  os_blob_path(blob) if blob else base + ".bin"
+    }
+
+# ---------------- OS cache quota (LRU) ----------------
+#
+# cache/os/usage/<sha256>.json  {"last_used", "hits"} per blob; last_used falls back to
+# the blob mtime (= download finish) so freshly downloaded blobs are not evicted first.
+
+def os_usage_path(sha256: str) -> str:
+    d = os.path.join(os_cache_dir(), "usage")
+    os.makedirs(d, exist_ok=True)
+    return os.path.join(d, sha256 + ".json")
+
+def os_usage_load(sha256: str) -> dict:
+    return os_meta_load(os_usage_path(sha256))
+
+def os_blob_touch(sha256: str, event: str):
+    sha = norm_sha256(sha256)
+    if not sha:
+        return
+    u = os_usage_load(sha)
+    u["hits"] = int(u.get("hits", 0)) + 1
+    u["last_used"] = time.time()
+    u["last_event"] = event
+    try:
+        os_meta_save(os_usage_path(sha), u)
+    except Exception:
+        pass
+
+def os_cache_quota_bytes() -> int:
+    """Sum of the available tiers' quotas (see cache_tier_quota); 0 = unlimited."""
+    quotas = [cache_tier_quota(t) for t in cache_tiers() if t["available"]]
+    return 0 if 0 in quotas else sum(quotas)
+
+def os_cache_entries() -> dict:
+    """Map blob sha256 -> [meta entries pointing at it]."""
+    out = {}
+    d = os_cache_dir()
+    for fn in sorted(os.listdir(d)):
+        if not fn.endswith(".meta.json"):
+            continue
+        meta = os_meta_load(os.path.join(d, fn))
+        sha = norm_sha256(meta.get("blob"))
+        if sha:
+            out.setdefault(sha, []).append(meta)
+    return out
+
+def os_pinned_blobs() -> set:
+    """Blobs that must not be evicted: armed os_ids, and anything a running job reads."""
+    pinned = set()
+    armed = {st.get("os_id") for st in load_arms().values() if st.get("os_id")}
+    if armed:
+        for sha, metas in os_cache_entries().items():
+            if any(m.get("os_id") in armed for m in metas):
+                pinned.add(sha)
+    for jid in job_ids():
+        job = job_load(jid)
+        if not job or job.get("status") != "running" or not job_is_alive(int(job.get("pid", 0) or 0)):
+            continue
+        meta = job.get("meta") or {}
+        for v in (meta.get("blob"), (meta.get("paths") or {}).get("blob"), meta.get("expected_sha256")):
+            if norm_sha256(v):
+                pinned.add(norm_sha256(v))
+        for v in (meta.get("in"), meta.get("out")):
+            if v and norm_sha256(os.path.basename(str(v))):
+                pinned.add(os.path.basename(str(v)))
+    return pinned
+
+def os_cache_usage() -> dict:
+    entries = os_cache_entries()
+    pinned = os_pinned_blobs()
+    blobs = []
+    seen = set()
+    for tier in cache_tiers():
+        if not tier["available"]:
+            continue
+        for fn in os.listdir(tier["blobs"]):
+            if not _SHA256_RE.match(fn) or fn in seen:
+                continue
+            path = os.path.join(tier["blobs"], fn)
+            try:
+                st = os.stat(path)
+            except OSError:
+                continue
+            seen.add(fn)
+            blobs.append(os_cache_usage_entry(fn, path, st, tier, entries.get(fn, []), fn in pinned))
+    blobs.sort(key=lambda x: x["last_used"])
+    return {
+        "quota_bytes": os_cache_quota_bytes(),
+        "total_bytes": sum(x["size_bytes"] for x in blobs),
+        "tiers": [{**{k: t[k] for k in ("name", "root", "available", "note", "read_mbps")},
+                   "quota_bytes": cache_tier_quota(t) if t["available"] else None,
+                   "used_bytes": sum(x["size_bytes"] for x in blobs if x["tier"] == t["name"]),
+                   "free_bytes": cache_tier_free(t) if t["available"] else None} for t in cache_tiers()],
+        "entries": blobs,
+    }
+
+def os_cache_usage_entry(fn: str, path: str, st, tier: dict, metas: list, pinned: bool) -> dict:
+    u = os_usage_load(fn)
+    variants = os_variant_files(fn)
+    return {
+        "blob": fn,
+        "size_bytes": st.st_size + sum(v["size_bytes"] for v in variants.values()),
+        "blob_bytes": st.st_size,
+        "variants": variants,
+        "last_used": max(float(u.get("last_used", 0) or 0), st.st_mtime),
+        "hits": int(u.get("hits", 0)),
+        "pinned": pinned,
+        "os_ids": [m.get("os_id") for m in metas],
+        "names": sorted({m.get("name") for m in metas if m.get("name")}),
+        "path": path,
+        "tier": tier["name"],
+    }
+
+def os_cache_remove(e: dict) -> bool:
+    """Delete one usage entry's blob, variants, usage and verification records."""
+    try:
+        os.remove(e["path"])
+    except OSError:
+        return False
+    for p in [v["path"] for v in e["variants"].values()] + [os_usage_path(e["blob"]), os_verified_path(e["blob"]),
+                                                            os_index_path(e["blob"])]:
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+    return True
+
+# ---------------- verified-hash memo + scrub ----------------
+#
+# cache/os/verified/<sha256>.json  {"ino", "size", "mtime_ns", "sha256", "ok", "verified_at", "how"}
+# A blob is named by its hash, so "verified" means its bytes hashed to its name. The record only holds
+# while (inode, size, mtime_ns) still match the file; a move, rewrite or truncation invalidates it.
+# A low-priority "scrub" job rehashes blobs whose check is older than policy.scrub.interval_days, at
+# policy.scrub.rate_mbps, and deletes any that no longer match (bit rot on the SD card).
+
+SCRUB_DEFAULTS = {"enabled": True, "interval_days": 30, "rate_mbps": 10}
+
+def os_verified_path(sha256: str) -> str:
+    d = os.path.join(os_cache_dir(), "verified")
+    os.makedirs(d, exist_ok=True)
+    return os.path.join(d, sha256 + ".json")
+
+def os_blob_memo(sha256: str) -> dict | None:
+    """The verification record for the blob as it is on disk now, or None if missing/stale."""
+    memo = os_meta_load(os_verified_path(sha256))
+    try:
+        st = os.stat(os_blob_path(sha256))
+    except OSError:
+        return None
+    if not memo or (memo.get("ino"), memo.get("size"), memo.get("mtime_ns")) != (st.st_ino, st.st_size, st.st_mtime_ns):
+        return None
+    return memo
+
+def os_blob_memo_record(sha256: str, actual: str, how: str) -> dict:
+    path = os_blob_path(sha256)
+    st = os.stat(path)
+    memo = {"sha256": sha256, "ok": actual == sha256, "actual": actual, "ino": st.st_ino, "size": st.st_size,
+            "mtime_ns": st.st_mtime_ns, "verified_at": time.time(), "how": how, "path": path}
+    os_meta_save(os_verified_path(sha256), memo)
+    if not memo["ok"]:
+        os_blob_discard(sha256)
+    return memo
+
+def os_blob_discard(sha256: str):
+    """
+    Delete a blob that no longer hashes to its name, with its variants, index and usage; it re-downloads.
+    Only the mismatch memo stays (until the next download replaces it): a kept copy would be space no
+    quota, LRU or admission check accounts for.
+    """
+    paths = [os_blob_path(sha256)] + [v["path"] for v in os_variant_files(sha256).values()]
+    for p in paths + [os_index_path(sha256), os_usage_path(sha256)]:
+        try:
+            os.remove(p)
+        except OSError:
+            pass
+
+def os_blob_verify(sha256: str, rate_mbps: float = 0, how: str = "check") -> dict:
+    """Memo if still valid, else hash the blob now and record the result ("skipped" tells which)."""
+    memo = os_blob_memo(sha256)
+    if memo:
+        return {**memo, "skipped": True}
+    return {**os_blob_memo_record(sha256, sha256_file(os_blob_path(sha256), rate_mbps=rate_mbps), how), "skipped": False}
+
+def flash_source_verify_args(source: dict, blob: str | None) -> str:
+    """
+    Have the engine hash the cached blob as it feeds the decoder, unless a valid memo already
+    vouches for it. Only the blob itself qualifies (variants are not named by their hash), and
+    zip sources are read by unzip rather than the feeder.
+    """
+    if not blob or source.get("variant") or source.get("kind") == "zip" or source.get("path") != os_blob_path(blob):
+        return ""
+    return "" if os_blob_memo(blob) else f" --expect-source-sha256 {blob}"
+
+def flash_source_verified(job: dict, sv: dict):
+    """Record what a flash learned about its cached blob: a full read that matched, or a mismatch."""
+    meta = job.get("meta") or {}
+    blob = meta.get("blob")
+    if meta.get("stream") or not blob or sv.get("expected_sha256") != blob or not sv.get("actual_sha256"):
+        return
+    try:
+        if int(sv.get("bytes_read") or 0) != os.path.getsize(os_blob_path(blob)):
+            return
+        os_blob_memo_record(blob, sv["actual_sha256"], "flash")
+    except OSError:
+        pass
+
+def scrub_settings() -> dict:
+    out = dict(SCRUB_DEFAULTS)
+    out.update(load_policy().get("scrub") or {})
+    return out
+
+def scrub_due() -> list[str]:
+    """Blobs with no valid memo or one older than interval_days, least recently verified first."""
+    cutoff = time.time() - float(scrub_settings()["interval_days"]) * 86400
+    due = []
+    for e in os_cache_usage()["entries"]:
+        memo = os_blob_memo(e["blob"])
+        when = float(memo.get("verified_at") or 0) if memo else 0.0
+        if when < cutoff:
+            due.append((when, e["blob"]))
+    return [sha for _, sha in sorted(due)]
+
+def maybe_start_scrub_job() -> dict | None:
+    cfg = scrub_settings()
+    if not cfg.get("enabled") or job_running("scrub") or not (scrub_due() or os_cache_legacy_unhashed()):
+        return None
+    script = f"""
+echo "=== SCRUB (rehash cached images at {float(cfg["rate_mbps"])} MB/s) ==="
+{shlex_quote(sys.executable)} {shlex_quote(os.path.abspath(__file__))} scrub --rate-mbps {float(cfg["rate_mbps"])}
+"""
+    return start_job("scrub", script, {})
+
+def start_blob_scrub_job(sha256: str) -> dict:
+    """A scrub job for one blob (/api/os_cache?verify=1): the running one, else a new one at rate_mbps."""
+    job = job_running("scrub", blob=sha256)
+    if job:
+        return job
+    rate = float(scrub_settings()["rate_mbps"])
+    script = f"""
+echo "=== SCRUB {sha256} (at {rate} MB/s) ==="
+{shlex_quote(sys.executable)} {shlex_quote(os.path.abspath(__file__))} scrub --rate-mbps {rate} --blob {shlex_quote(sha256)}
+"""
+    return start_job("scrub", script, {"blob": sha256})
+
+def scrub_run(rate_mbps: float, blob: str = "") -> int:
+    """Rehash the blobs that are due (or just blob, unless its memo still holds)."""
+    if not blob:
+        migrate_os_cache(rehash=True, rate_mbps=rate_mbps)   # legacy entries no request was allowed to hash
+    bad = 0
+    for sha in [blob] if blob else scrub_due():
+        if not os.path.exists(os_blob_path(sha)):
+            continue
+        t0 = time.time()
+        if blob:
+            memo = os_blob_verify(sha, rate_mbps, "scrub")
+        else:
+            memo = os_blob_memo_record(sha, sha256_file(os_blob_path(sha), rate_mbps=rate_mbps), "scrub")
+        print(f"{'OK' if memo['ok'] else 'MISMATCH'} {sha} {memo['size']} bytes in {time.time() - t0:.1f}s"
+              + ("" if memo["ok"] else f" (hashes to {memo['actual']}; deleted)"), flush=True)
+        bad += 0 if memo["ok"] else 1
+    print(f"SCRUB_DONE mismatches={bad}", flush=True)
+    return 0
+
+# ---------------- image index + inspect ----------------
+#
+# cache/os/index/<sha256>.json  unit table (image_index.build_index) + the inspection it produced.
+# Built at the end of each download (app.py os-index), or by an os_index job that /api/os_cache/inspect
+# starts when it is missing (never in a request: a single-member gzip decodes the whole image); later
+# inspections are a file read, and single files are read through the unit table.
+
+def os_index_path(sha256: str) -> str:
+    d = os.path.join(os_cache_dir(), "index")
+    os.makedirs(d, exist_ok=True)
+    return os.path.join(d, sha256 + ".json")
+
+def os_blob_index(sha256: str, build: bool = False) -> dict | None:
+    """Index + inspection of a cached blob; built (and saved) when missing if build is set."""
+    path = os_index_path(sha256)
+    blob = os_blob_path(sha256)
+    idx = os_meta_load(path)
+    if idx and idx.get("size_bytes") == os.path.getsize(blob):
+        return idx
+    if not build:
+        return None
+    t0 = time.time()
+    idx = image_index.build_index(blob)
+    with image_index.ImageReader(blob, idx) as r:
+        idx["inspect"] = image_index.inspect(r.read)
+        idx["inspect_decoded_bytes"] = r.decoded
+    idx.update({"blob": sha256, "built_at": time.time(), "build_s": round(time.time() - t0, 3)})
+    os_meta_save(path, idx)
+    return idx
+
+def maybe_start_index_job(sha256: str) -> dict:
+    """The os_index job building a blob's index: the running one, else a new one."""
+    job = job_running("os_index", blob=sha256)
+    if job:
+        return job
+    script = f"""
+echo "=== IMAGE INDEX ==="
+{shlex_quote(sys.executable)} {shlex_quote(os.path.abspath(__file__))} os-index {shlex_quote(sha256)}
+"""
+    return start_job("os_index", script, {"blob": sha256})
+
+def os_blob_read_file(sha256: str, idx: dict, part: dict, path: str, max_bytes: int) -> bytes | None:
+    """One file from a FAT partition of a cached blob, decoding only the units it lives in."""
+    with image_index.ImageReader(os_blob_path(sha256), idx) as r:
+        return image_index.Fat(r.read, part["start_bytes"]).read_file(path, max_bytes)
+
+# ---------------- customization profiles + pre-customized images ----------------
+#
+# cache/custom_profiles.json  {"<name>": {hostname, user, ssh, wifi, timezone, keymap, boot_path}}
+# A profile is rendered for an image's init_format into first-boot files:
+#   systemd                      firstrun.sh + a systemd.run= hook appended to cmdline.txt (Raspberry Pi OS)
+#   cloudinit / cloudinit-rpi    user-data, meta-data and (with wifi) network-config
+# The render (cache/custom/<hash>.json) is written into the boot partition of a sparse raw copy of the
+# blob once, by an "os_custom" job; the copy is stored as a variant (<blob>.custom-<hash16>.img) so it
+# is tiered, accounted and evicted with its blob, and flashing the same profile again writes it as is.
+
+CUSTOM_INIT_FORMATS = ("systemd", "cloudinit", "cloudinit-rpi")
+CUSTOM_HOSTNAME_RE = re.compile(r"^[A-Za-z0-9](?:[A-Za-z0-9-]{0,61}[A-Za-z0-9])?$")
+CUSTOM_USER_RE = re.compile(r"^[a-z_][a-z0-9_-]{0,31}$")
+
+def custom_profiles_path() -> str:
+    return os.path.join(CACHE_DIR, "custom_profiles.json")
+
+def custom_profiles() -> dict:
+    return os_meta_load(custom_profiles_path())
+
+def custom_profile_check(p: dict) -> str | None:
+    """Why profile p can't be rendered, or None."""
+    if p.get("hostname") and not CUSTOM_HOSTNAME_RE.match(str(p["hostname"])):
+        return "hostname must be 1-63 letters, digits or '-'"
+    user = p.get("user") or {}
+    if user and not CUSTOM_USER_RE.match(str(user.get("name") or "")):
+        return "user.name must be a lowercase login name"
+    if user.get("password_hash") and not str(user["password_hash"]).startswith("$"):
+        return "user.password_hash must be a crypt(3) hash (e.g. from openssl passwd -6); plain passwords aren't stored"
+    keys = (p.get("ssh") or {}).get("authorized_keys") or []
+    if not isinstance(keys, list) or not all(isinstance(k, str) and k.startswith(("ssh-", "ecdsa-", "sk-")) for k in keys):
+        return "ssh.authorized_keys must be a list of public keys"
+    wifi = p.get("wifi") or {}
+    if wifi:
+        if not 1 <= len(str(wifi.get("ssid") or "")) <= 32:
+            return "wifi.ssid must be 1-32 characters"
+        psk = str(wifi.get("psk") or "")
+        if psk and not (8 <= len(psk) <= 63 or re.match(r"^[0-9a-fA-F]{64}$", psk)):
+            return "wifi.psk must be 8-63 characters or 64 hex digits"
+        if not re.match(r"^[A-Z]{2}$", str(wifi.get("country") or "")):
+            return "wifi.country must be a two-letter country code (e.g. GB)"
+    for k in ("timezone", "keymap", "boot_path"):
+        if p.get(k) and not re.match(r"^[A-Za-z0-9_+/.-]+$", str(p[k])):
+            return f"{k} has unexpected characters"
+    return None
+
+def custom_firstrun(p: dict, boot: str) -> str:
+    """firstrun.sh for systemd images, in the shape Raspberry Pi Imager writes (imager_custom if present)."""
+    q = shlex_quote
+    ic = "/usr/lib/raspberrypi-sys-mods/imager_custom"
+    lines = ["#!/bin/bash", "", "set +e", "", "# jr-golden-sd customization; runs once via systemd.run, then removes itself", ""]
+    if p.get("hostname"):
+        h = q(p["hostname"])
+        lines += ["CURRENT_HOSTNAME=$(cat /etc/hostname | tr -d \" \\t\\n\\r\")",
+                  f"if [ -f {ic} ]; then", f"   {ic} set_hostname {h}", "else",
+                  f"   echo {h} >/etc/hostname",
+                  f"   sed -i \"s/127.0.1.1.*$CURRENT_HOSTNAME/127.0.1.1\\t\"{h}\"/g\" /etc/hosts", "fi"]
+    lines += ["FIRSTUSER=$(getent passwd 1000 | cut -d: -f1)", "FIRSTUSERHOME=$(getent passwd 1000 | cut -d: -f6)"]
+    ssh = p.get("ssh") or {}
+    keys = "\n".join(ssh.get("authorized_keys") or [])
+    if keys or ssh.get("enabled"):
+        lines += [f"if [ -f {ic} ]; then",
+                  f"   {ic} enable_ssh" + (f" -k {q(keys)}" if keys and not ssh.get("password_auth") else ""), "else"]
+        if keys:
+            lines += ['   install -o "$FIRSTUSER" -m 700 -d "$FIRSTUSERHOME/.ssh"',
+                      f'   echo {q(keys)} >"$FIRSTUSERHOME/.ssh/authorized_keys"',
+                      '   chown "$FIRSTUSER:$FIRSTUSER" "$FIRSTUSERHOME/.ssh/authorized_keys"',
+                      '   chmod 600 "$FIRSTUSERHOME/.ssh/authorized_keys"']
+            if not ssh.get("password_auth"):
+                lines += ["   echo 'PasswordAuthentication no' >>/etc/ssh/sshd_config"]
+        lines += ["   systemctl enable ssh", "fi"]
+    user = p.get("user") or {}
+    if user.get("name"):
+        n, pw = q(user["name"]), q(user.get("password_hash") or "")
+        lines += ["if [ -f /usr/lib/userconf-pi/userconf ]; then", f"   /usr/lib/userconf-pi/userconf {n} {pw}", "else"]
+        if user.get("password_hash"):
+            lines += [f"   echo \"$FIRSTUSER:\"{pw} | chpasswd -e"]
+        lines += [f"   if [ \"$FIRSTUSER\" != {n} ]; then",
+                  f"      usermod -l {n} \"$FIRSTUSER\"", f"      usermod -m -d \"/home/\"{n} {n}",
+                  f"      groupmod -n {n} \"$FIRSTUSER\"", "   fi", "fi"]
+    wifi = p.get("wifi") or {}
+    if wifi:
+        s, k, c = q(wifi["ssid"]), q(wifi.get("psk") or ""), q(wifi["country"])
+        lines += [f"if [ -f {ic} ]; then", f"   {ic} set_wlan {'-h ' if wifi.get('hidden') else ''}{s} {k} {c}", "else",
+                  "cat >/etc/wpa_supplicant/wpa_supplicant.conf <<'WPAEOF'",
+                  f"country={wifi['country']}", "ctrl_interface=DIR=/var/run/wpa_supplicant GROUP=netdev",
+                  "ap_scan=1", "", "update_config=1", "network={",
+                  *(["\tscan_ssid=1"] if wifi.get("hidden") else []),
+                  f"\tssid={json.dumps(wifi['ssid'])}",
+                  *([f"\tpsk={wifi['psk'] if len(wifi['psk']) == 64 else json.dumps(wifi['psk'])}"] if wifi.get("psk") else ["\tkey_mgmt=NONE"]),
+                  "}", "WPAEOF", "   chmod 600 /etc/wpa_supplicant/wpa_supplicant.conf", "   rfkill unblock wifi",
+                  "   for filename in /var/lib/systemd/rfkill/*:wlan ; do", "       echo 0 > $filename", "   done", "fi"]
+    if p.get("keymap") or p.get("timezone"):
+        lines += [f"if [ -f {ic} ]; then"]
+        lines += [f"   {ic} set_keymap {q(p['keymap'])}"] if p.get("keymap") else []
+        lines += [f"   {ic} set_timezone {q(p['timezone'])}"] if p.get("timezone") else []
+        lines += ["else"]
+        lines += ["   rm -f /etc/localtime", f"   echo {q(p['timezone'])} >/etc/timezone",
+                  "   dpkg-reconfigure -f noninteractive tzdata"] if p.get("timezone") else []
+        lines += ["   cat >/etc/default/keyboard <<'KBEOF'", "XKBMODEL=\"pc105\"", f"XKBLAYOUT=\"{p['keymap']}\"",
+                  "XKBVARIANT=\"\"", "XKBOPTIONS=\"\"", "", "KBEOF",
+                  "   dpkg-reconfigure -f noninteractive keyboard-configuration"] if p.get("keymap") else []
+        lines += ["fi"]
+    lines += [f"rm -f {boot}/firstrun.sh", f"sed -i 's| systemd.run.*||g' {boot}/cmdline.txt", "exit 0", ""]
+    return "\n".join(lines)
+
+def custom_cloud_config(p: dict, settings_hash: str, init_format: str) -> dict:
+    """user-data / meta-data / network-config; JSON is valid YAML, so no YAML emitter is needed."""
+    user = p.get("user") or {}
+    ssh = p.get("ssh") or {}
+    cfg = {"manage_etc_hosts": True}
+    if p.get("hostname"):
+        cfg["hostname"] = p["hostname"]
+    if user.get("name"):
+        groups = "users,adm,dialout,audio,netdev,video,plugdev,cdrom,sudo"
+        if init_format == "cloudinit-rpi":
+            groups += ",input,gpio,spi,i2c,render"
+        u = {"name": user["name"], "groups": groups,
+             "shell": "/bin/bash", "sudo": "ALL=(ALL) NOPASSWD:ALL", "lock_passwd": not user.get("password_hash")}
+        if user.get("password_hash"):
+            u["passwd"] = user["password_hash"]
+        if ssh.get("authorized_keys"):
+            u["ssh_authorized_keys"] = ssh["authorized_keys"]
+        cfg["users"] = [u]
+    elif ssh.get("authorized_keys"):
+        cfg["ssh_authorized_keys"] = ssh["authorized_keys"]
+    if ssh.get("authorized_keys") or ssh.get("enabled"):
+        cfg["ssh_pwauth"] = bool(ssh.get("password_auth", not ssh.get("authorized_keys")))
+    if p.get("timezone"):
+        cfg["timezone"] = p["timezone"]
+    if p.get("keymap"):
+        cfg["keyboard"] = {"model": "pc105", "layout": p["keymap"]}
+    files = {
+        "user-data": "#cloud-config\n" + json.dumps(cfg, indent=2) + "\n",
+        "meta-data": f"instance-id: jr-golden-sd-{settings_hash[:16]}\n",
+    }
+    wifi = p.get("wifi") or {}
+    if wifi:
+        ap = {"password": wifi["psk"]} if wifi.get("psk") else {}
+        if wifi.get("hidden"):
+            ap["hidden"] = True
+        net = {"network": {"version": 2, "wifis": {"wlan0": {"dhcp4": True, "optional": True,
+                                                                  "regulatory-domain": wifi["country"],
+                                                                  "access-points": {wifi["ssid"]: ap}}}}}
+        files["network-config"] = json.dumps(net["network"], indent=2) + "\n"
+    return files
+
+def custom_render(p: dict, init_format: str) -> dict:
+    """First-boot files for profile p on an init_format image; "hash" keys the customized image."""
+    settings = {k: v for k, v in p.items() if k not in ("name", "updated_at")}
+    settings_hash = hashlib.sha256(json.dumps(settings, sort_keys=True).encode()).hexdigest()
+    if init_format == "systemd":
+        boot = p.get("boot_path") or "/boot/firmware"
+        files = {"firstrun.sh": custom_firstrun(p, boot)}
+        cmdline = f"systemd.run={boot}/firstrun.sh systemd.run_success_action=reboot systemd.unit=kernel-command-line.target"
+    else:
+        files = custom_cloud_config(p, settings_hash, init_format)
+        cmdline = ""
+    render = {"init_format": init_format, "files": files, "cmdline_append": cmdline}
+    render["hash"] = hashlib.sha256(json.dumps(render, sort_keys=True).encode()).hexdigest()
+    render["profile"] = p.get("name")
+    return render
+
+def custom_render_path(h: str) -> str:
+    d = os.path.join(CACHE_DIR, "custom")
+    os.makedirs(d, exist_ok=True)
+    return os.path.join(d, h + ".json")
+
+def custom_variant_kind(h: str) -> str:
+    return "custom-" + h[:16]
+
+def custom_init_format(os_item: dict, sha256: str) -> str | None:
+    """The item's init_format, else what the image's boot partition looks built for."""
+    fmt = str(os_item.get("init_format") or "").strip().lower()
+    if not fmt:
+        fmt = ((os_blob_index(sha256) or {}).get("inspect") or {}).get("init_format") or ""
+    return fmt if fmt in CUSTOM_INIT_FORMATS else None
+
+def custom_prepare(os_item: dict, paths: dict, profile_name: str) -> dict:
+    """
+    Customized image for (blob, profile): {"ready": path} when cached, else starts (or finds) the
+    os_custom job building it and returns {"job"}; {"error", "status"} when it can't be made.
+    """
+    p = custom_profiles().get(profile_name)
+    if not p:
+        return {"error": f"Unknown customization profile: {profile_name}", "status": 404}
+    sha = paths.get("blob")
+    if not sha or not os.path.exists(os_blob_path(sha)):
+        return {"error": "Customized images are made from the cached image; call /api/download_os first.", "status": 400}
+    if not str(os_item.get("init_format") or "").strip() and os_blob_index(sha) is None:
+        job = maybe_start_index_job(sha)
+        return {"error": f"The image is being inspected for its first-boot mechanism (job {job['id']}); "
+                         "try again when it finishes.", "job": job, "status": 409}
+    init_format = custom_init_format(os_item, sha)
+    if not init_format:
+        return {"error": f"No known first-boot mechanism for this image (init_format {os_item.get('init_format')!r}).",
+                "status": 400}
+    render = custom_render({**p, "name": profile_name}, init_format)
+    kind = custom_variant_kind(render["hash"])
+    have = os_variant_files(sha).get(kind)
+    out = {"profile": profile_name, "init_format": init_format, "hash": render["hash"], "kind": kind}
+    if have:
+        return {**out, "ready": have["path"]}
+    job = job_running("os_custom", blob=sha, kind=kind)
+    if job:
+        return {**out, "job": job}
+    blob = os_blob_path(sha)
+    need = int(os_item.get("extract_size") or 0) or os.path.getsize(blob)
+    admit = cache_admit(need, f"{sha}.{kind}", cache_tier_of(blob), sha + f".{kind}.img.tmp")
+    if "busy" in admit:
+        return {**out, "job": job_load(admit["busy"]) if admit["busy"] else None}
+    if not admit["ok"]:
+        return {**out, "error": "No room on the blob's cache tier for a customized copy.", "room": admit["room"],
+                "status": 507}
+    os_meta_save(custom_render_path(render["hash"]), render)
+
+    src = source_kind(os_item["url"], blob)
+    raw = os_variant_files(sha).get("raw")
+    outp = admit["tmp"][:-len(".tmp")]
+    if raw:
+        copy = f'cp --sparse=always {shlex_quote(raw["path"])} "$TMP"'
+    else:
+        decode = decode_cmd(src)
+        read = f'{decode} "$IN"' if src == "zip" else f'dd if="$IN" bs=4M iflag=nocache status=none | {decode}'
+        copy = f'{read} | dd of="$TMP" bs=4M conv=sparse,fdatasync oflag=nocache status=none'
+    script = f"""
+echo "=== CUSTOMIZED IMAGE (profile {profile_name}, {init_format}) ==="
+IN={shlex_quote(blob)}
+OUT={shlex_quote(outp)}
+TMP={shlex_quote(admit["tmp"])}
+rm -f "$TMP"
+{copy}
+{shlex_quote(sys.executable)} {shlex_quote(os.path.abspath(__file__))} customize-image "$TMP" {render["hash"]}
+mv "$TMP" "$OUT"
+echo "CUSTOM_READY $(du -h "$OUT" | awk '{{print $1}}')"
+"""
+    job = start_job("os_custom", script, {"blob": sha, "kind": kind, "profile": profile_name,
+                                          "init_format": init_format, "render": custom_render_path(render["hash"]),
+                                          "out": outp, "tier": admit["tier"]["name"], "reserved_bytes": need})
+    cache_reservation_bind(admit["token"], job["id"])
+    return {**out, "job": job}
+
+def custom_apply(img: str, h: str) -> dict:
+    """Write render h into the boot partition of the raw image img (os_custom jobs)."""
+    render = os_meta_load(custom_render_path(h))
+    if not render:
+        raise RuntimeError(f"render {h} not found")
+    fd = os.open(img, os.O_RDWR)
+    try:
+        res = image_index.customize_boot(lambda off, n: os.pread(fd, n, off), lambda off, data: os.pwrite(fd, data, off),
+                                         {k: v.encode() for k, v in render["files"].items()}, render["cmdline_append"])
+        os.fsync(fd)
+    finally:
+        os.close(fd)
+    return res
+
+def custom_flash_source(os_item: dict, paths: dict, profile_name: str) -> dict:
+    """
+    What /api/flash and /api/flash_multi write for a profile: the customized copy as a raw source,
+    with its own bmap and checkpoint id, and without the base image's extract hash.
+    """
+    c = custom_prepare(os_item, paths, profile_name)
+    if c.get("error"):
+        return c
+    if not c.get("ready"):
+        # The first flash of a (blob, profile) pair always lands here; POST /api/os_custom ahead of time avoids it
+        job_id = (c.get("job") or {}).get("id") or "starting"
+        return {**c, "error": f"The customized image for profile {profile_name!r} is being prepared "
+                              f"(job {job_id}); flash again when it finishes.", "status": 409}
+    return {
+        **c,
+        "source": {"kind": "raw", "path": c["ready"], "decode": decode_cmd("raw"), "variant": True},
+        "paths": {**paths, "bmap": c["ready"] + ".bmap"},
+        "os_item": {**os_item, "extract_sha256": None},
+        "image_id": f'{paths["blob"]}-{c["hash"][:16]}',
+    }
+
+# ---------------- cache tiers ----------------
+#
+# policy.cache_tiers = [{"name": "ssd", "path": "/mnt/ssd/golden-sd", "quota_bytes": N, "read_mbps": 300}, ...]
+# lists faster volumes, fastest first; the boot cache (CACHE_DIR) is always the last tier. Only image
+# bytes move (<tier>/os/blobs, <tier>/os/variants); metadata, usage, bmaps and jobs stay on the boot
+# cache. New downloads land on the fastest tier with room; a "cache_tier" job then keeps the most
+# recently used blobs on the fastest tiers, demoting the rest. A disk holding a tier is never a flash target.
+
+def cache_tiers() -> list[dict]:
+    boot = os_cache_dir()
+    boot_dev = os.stat(boot).st_dev
+    out = []
+    for i, cfg in enumerate(load_policy().get("cache_tiers") or []):
+        path = os.path.abspath(str(cfg["path"]))
+        note = ""
+        try:
+            if os.stat(path).st_dev == boot_dev:
+                note = "on the boot cache filesystem (volume not mounted?)"
+            elif not os.access(path, os.W_OK):
+                note = "not writable"
+        except OSError as e:
+            note = f"unavailable: {e.strerror}"
+        out.append(cache_tier_entry(str(cfg.get("name") or f"tier{i}"), os.path.join(path, "os"), cfg, note))
+    pol = load_policy()
+    out.append(cache_tier_entry("boot", boot, {"quota_bytes": pol.get("os_cache_quota_bytes")}, ""))
+    return out
+
+def cache_tier_entry(name: str, root: str, cfg: dict, note: str) -> dict:
+    tier = {"name": name, "root": root, "blobs": os.path.join(root, "blobs"), "variants": os.path.join(root, "variants"),
+            "available": not note, "note": note or None, "quota_bytes": cfg.get("quota_bytes"), "read_mbps": cfg.get("read_mbps")}
+    if tier["available"]:
+        try:
+            os.makedirs(tier["blobs"], exist_ok=True)
+            os.makedirs(tier["variants"], exist_ok=True)
+        except OSError as e:
+            tier.update({"available": False, "note": f"unavailable: {e.strerror}"})
+    return tier
+
+def cache_tier_quota(tier: dict) -> int:
+    """The tier's quota_bytes (boot: policy.os_cache_quota_bytes), or half its filesystem; 0 = unlimited."""
+    if tier.get("quota_bytes") is not None:
+        return max(0, int(tier["quota_bytes"]))
+    try:
+        st = os.statvfs(tier["root"])
+        return (st.f_blocks * st.f_frsize) // 2
+    except OSError:
+        return 0
+
+def cache_tier_free(tier: dict) -> int:
+    try:
+        st = os.statvfs(tier["root"])
+        return st.f_bavail * st.f_frsize
+    except OSError:
+        return 0
+
+def cache_tier_of(path: str) -> dict:
+    tiers = cache_tiers()
+    for tier in tiers:
+        if os.path.abspath(path).startswith(tier["root"] + os.sep):
+            return tier
+    return tiers[-1]
+
+def cache_tier_read_mbps(tier: dict) -> float:
+    rates = throughput_mbps()
+    if tier.get("read_mbps"):
+        return float(tier["read_mbps"])
+    return rates["cache_read"] if tier["name"] == "boot" else rates.get(f"cache_read_{tier['name']}", rates["cache_read_tier"])
+
+def path_disk(path: str) -> str:
+    """Kernel name of the whole disk holding path ("sda" for /mnt/ssd on sda1), or ""."""
+    try:
+        st = os.stat(path)
+    except OSError:
+        return ""
+    d = os.path.join(SYSFS_ROOT, "dev", "block", f"{os.major(st.st_dev)}:{os.minor(st.st_dev)}")
+    if not os.path.exists(d):
+        return ""
+    real = os.path.realpath(d)
+    return os.path.basename(os.path.dirname(real) if os.path.exists(os.path.join(real, "partition")) else real)
+
+def cache_tier_disks() -> dict:
+    """disk name -> tier name, for the tiers on other disks than the boot cache."""
+    out = {}
+    for tier in cache_tiers()[:-1]:
+        disk = path_disk(tier["root"]) if tier["available"] else ""
+        if disk:
+            out.setdefault(disk, tier["name"])
+    return out
+
+def cache_tier_plan() -> list[dict]:
+    """
+    Moves that put the most recently used blobs on the fastest tiers: tiers are filled hottest-first
+    within their quota and free space; pinned blobs stay where they are. Demotions come first.
+    """
+    tiers = [t for t in cache_tiers() if t["available"]]
+    if len(tiers) < 2:
+        return []
+    usage = os_cache_usage()
+    rank = {t["name"]: i for i, t in enumerate(tiers)}
+    room = {}
+    for t in tiers:
+        here = sum(e["size_bytes"] for e in usage["entries"] if e["tier"] == t["name"])
+        quota = cache_tier_quota(t)
+        room[t["name"]] = min(quota or float("inf"), here + cache_tier_free(t) - 64 * 1024 * 1024)
+    for e in usage["entries"]:
+        if e["pinned"]:
+            room[e["tier"]] -= e["size_bytes"]
+    moves = []
+    for e in sorted(usage["entries"], key=lambda x: -x["last_used"]):
+        if e["pinned"]:
+            continue
+        want = next((t["name"] for t in tiers if room[t["name"]] >= e["size_bytes"]), e["tier"])
+        if rank[want] > rank[e["tier"]] and room[e["tier"]] >= e["size_bytes"]:
+            want = e["tier"]   # nothing faster has room and it still fits here: leave it
+        room[want] -= e["size_bytes"]
+        if want != e["tier"]:
+            moves.append({"blob": e["blob"], "from": e["tier"], "to": want, "size_bytes": e["size_bytes"],
+                          "kind": "promote" if rank[want] < rank[e["tier"]] else "demote"})
+    moves.sort(key=lambda m: m["kind"] != "demote")
+    return moves
+
+def os_blob_move(sha256: str, tier: dict) -> dict:
+    """Copy a blob (hash-checked) and its variants to tier, then drop the old copies."""
+    src = os_blob_path(sha256)
+    dst = os.path.join(tier["blobs"], sha256)
+    if src == dst:
+        return {"blob": sha256, "moved": False}
+    with open(src, "rb") as f:
+        sha, size = flash_engine.sink_stream(f, dst + ".tmp")
+        flash_engine.drop_cache(f.fileno())
+    if sha != sha256:
+        os.remove(dst + ".tmp")
+        raise RuntimeError(f"copy of {sha256} hashed {sha}")
+    shutil.copystat(src, dst + ".tmp")   # mtime is the LRU fallback; a move is not a use
+    variants = os_variant_files(sha256)
+    for v in variants.values():
+        out = os.path.join(tier["variants"], os.path.basename(v["path"]))
+        subprocess.run(["cp", "--sparse=always", "--preserve=timestamps", v["path"], out + ".tmp"], check=True)
+        os.replace(out + ".tmp", out)
+    os.replace(dst + ".tmp", dst)
+    os.remove(src)
+    for v in variants.values():
+        os.remove(v["path"])
+    os_blob_memo_record(sha256, sha, "move")   # the copy was hashed on the way
+    return {"blob": sha256, "moved": True, "size_bytes": size, "to": tier["name"]}
+
+def maybe_start_tier_job() -> dict | None:
+    """Start a cache_tier job when the placement plan has moves and none is running."""
+    if job_running("cache_tier") or not cache_tier_plan():
+        return None
+    script = f"""
+echo "=== CACHE TIERS ==="
+{shlex_quote(sys.executable)} {shlex_quote(os.path.abspath(__file__))} cache-tier --apply
+"""
+    return start_job("cache_tier", script, {})
+
+def cache_tier_apply() -> int:
+    """Run the current plan (re-planned per move, since usage changes as jobs come and go)."""
+    done = set()
+    while True:
+        moves = [m for m in cache_tier_plan() if m["blob"] not in done]
+        if not moves:
+            return 0
+        m = moves[0]
+        done.add(m["blob"])
+        tier = next(t for t in cache_tiers() if t["name"] == m["to"])
+        print(f"{m['kind']}: {m['blob']} {m['from']} -> {m['to']} ({m['size_bytes']} bytes)", flush=True)
+        try:
+            os_blob_move(m["blob"], tier)
+        except (OSError, RuntimeError, subprocess.CalledProcessError) as e:
+            print(f"ERROR: {m['blob']}: {e}", flush=True)
+
+# ---------------- free-space admission ----------------
+#
+# A download reserves its image_download_size on one tier before its job starts (cache/reservations.json,
+# under flock so concurrent requests and workers see each other). A reservation counts until its job
+# ends, less what the job's temp file already occupies; `app.py sink --prealloc` fallocates that file to
+# the full size up front, so ext4 on SD gets a few large extents instead of growing the file piecemeal.
+
+def cache_min_free_bytes() -> int:
+    """policy.cache_min_free_bytes: never fill a cache filesystem beyond this (default 512 MiB)."""
+    return max(0, int(load_policy().get("cache_min_free_bytes", 512 * 1024 * 1024)))
+
+def cache_reservations(fn):
+    """Run fn(reservations) under the lock with dead reservations dropped; fn may change the dict."""
+    import fcntl
+    ensure_cache_dir()
+    path = os.path.join(CACHE_DIR, "reservations.json")
+    with open(path + ".lock", "w") as lock:
+        fcntl.flock(lock, fcntl.LOCK_EX)
+        res = {k: v for k, v in os_meta_load(path).items() if cache_reservation_live(v)}
+        out = fn(res)
+        os_meta_save(path, res)
+        return out
+
+def cache_reservation_live(r: dict) -> bool:
+    if not r.get("job_id"):
+        return time.time() - float(r.get("created_at") or 0) < 120   # admitted, job not recorded yet
+    job = job_load(r["job_id"]) or {}
+    return (job.get("status") == "running" and job_is_alive(int(job.get("pid", 0) or 0))
+            and not os.path.exists(job.get("rc_path") or ""))
+
+def cache_reservation_outstanding(r: dict) -> int:
+    try:
+        held = os.stat(r["tmp"]).st_blocks * 512
+    except OSError:
+        held = 0
+    return max(0, int(r.get("bytes") or 0) - held)
+
+def cache_tier_room(tier: dict, reservations: dict, usage: dict | None = None) -> int:
+    """Bytes a new download may still put on tier: free space and quota, less reservations and the floor."""
+    reserved = [r for r in reservations.values() if r.get("tier") == tier["name"]]
+    room = cache_tier_free(tier) - sum(cache_reservation_outstanding(r) for r in reserved) - cache_min_free_bytes()
+    quota = cache_tier_quota(tier)
+    if quota:
+        usage = usage or os_cache_usage()
+        used = sum(e["size_bytes"] for e in usage["entries"] if e["tier"] == tier["name"])
+        room = min(room, quota - used - sum(int(r.get("bytes") or 0) for r in reserved))
+    return room
+
+def cache_admit(need: int, key: str, tmp_on: dict | None = None, tmp_name: str = "") -> dict:
+    """
+    Reserve need bytes for a download: on the fastest tier with room, else after evicting least-recently
+    used, unpinned blobs (slowest tier first, so hot images on fast tiers go last).
+    -> {"ok", "tier", "token", "tmp", "evicted", "room"} or {"ok": False, "error", "room", "evicted"}
+    A live reservation for the same key means another job is already fetching it: {"ok": False, "busy": job_id}.
+    tmp_on / tmp_name reserve <tmp_on>/os/variants/<tmp_name> instead, for a file that must stay on its
+    blob's tier; nothing is evicted for it (the blob it is made from could go first).
+    """
+    def admit(res):
+        held = next((r for r in res.values() if r.get("key") == key), None)
+        if held:
+            return {"ok": False, "busy": held.get("job_id"), "room": {}, "evicted": [],
+                    "error": "This image is already being downloaded."}
+        tiers = [t for t in cache_tiers() if t["available"] and (not tmp_on or t["name"] == tmp_on["name"])]
+        room = {t["name"]: cache_tier_room(t, res) for t in tiers}
+        pick = next((t for t in tiers if room[t["name"]] >= need), None)
+        evicted = []
+        for tier in ([] if pick or tmp_on else reversed(tiers)):
+            victims = [e for e in os_cache_usage()["entries"] if e["tier"] == tier["name"] and not e["pinned"]]
+            if room[tier["name"]] + sum(e["size_bytes"] for e in victims) < need:
+                continue   # emptying this tier still wouldn't fit it; keep its blobs
+            for e in victims:
+                if room[tier["name"]] >= need:
+                    break
+                if not os_cache_remove(e):
+                    continue
+                evicted.append({"blob": e["blob"], "size_bytes": e["size_bytes"], "os_ids": e["os_ids"], "tier": tier["name"]})
+                room[tier["name"]] = cache_tier_room(tier, res)
+            if room[tier["name"]] >= need:
+                pick = tier
+                break
+        if not pick:
+            best = max(room.values(), default=0)
+            return {"ok": False, "room": room, "evicted": evicted,
+                    "error": f"Not enough cache space: the image needs {need} bytes, the most any cache tier can take "
+                             f"is {max(0, best)} bytes (after evicting unpinned images, keeping {cache_min_free_bytes()} bytes free)."}
+        token = secrets.token_hex(8)
+        tmp = os.path.join(pick["variants"], tmp_name) if tmp_on else os.path.join(pick["blobs"], f".{key}.tmp")
+        res[token] = {"tier": pick["name"], "key": key, "bytes": need, "tmp": tmp, "created_at": time.time(), "job_id": None}
+        return {"ok": True, "tier": pick, "token": token, "tmp": tmp, "evicted": evicted, "room": room}
+    return cache_reservations(admit)
+
+def cache_reservation_bind(token: str, job_id: str):
+    def bind(res):
+        if token in res:
+            res[token]["job_id"] = job_id
+    cache_reservations(bind)
+
+# ---------------- derived image variants ----------------
+#
+# cache/os/variants/<sha256>.img      raw, sparse (holes for zero runs): no decode at flash time
+# cache/os/variants/<sha256>.img.zst  zstd: decodes several times faster than xz on a Pi
+# Enabled via policy.os_cache_variants = {"kind": "zstd"|"raw", "level": 3, "min_hits": 0}.
+
+VARIANT_SUFFIX = {"raw": ".img", "zstd": ".img.zst"}
+
+# Rough decode rates on a Pi 4/5 (MB/s of decompressed output). Rates measured by flash jobs
+# (decode_stats.json) replace these; policy.throughput_mbps overrides both, plus "cache_read"
+# and per-tran target rates.
+DEFAULT_THROUGHPUT_MBPS = {
+    "raw": 2000, "zstd": 300, "gzip": 80, "zip": 70, "xz": 30, "bzip2": 25,
+    "cache_read": 40, "cache_read_tier": 150,
+    "target_nvme": 400, "target_usb": 35, "target_mmc": 20, "target_default": 30,
+}
+
+def decode_stats_path() -> str:
+    ensure_cache_dir()
+    return os.path.join(CACHE_DIR, "decode_stats.json")
+
+def record_decode_stats(engine: dict):
+    """Fold a finished engine run's decoder rate into the per-format moving average."""
+    fmt = engine.get("format")
+    mbps = (engine.get("decoder") or {}).get("mbps")
+    if not fmt or not mbps:
+        return
+    stats = os_meta_load(decode_stats_path())
+    cur = stats.get(fmt) or {}
+    n = int(cur.get("samples", 0))
+    avg = float(mbps) if not n else 0.7 * float(cur.get("mbps", mbps)) + 0.3 * float(mbps)
+    stats[fmt] = {"mbps": round(avg, 2), "samples": n + 1, "last_argv": (engine.get("decoder") or {}).get("argv"),
+                  "updated_at": time.time()}
+    try:
+        os_meta_save(decode_stats_path(), stats)
+    except Exception:
+        pass
+
+def tune_profiles_path() -> str:
+    return os.path.join(CACHE_DIR, "tune_profiles.json")
+
+def tune_profile_key(dev: dict) -> str:
+    """Target class for learned write settings: transport + model (e.g. "usb|Extreme Pro")."""
+    return f'{(dev.get("tran") or "").strip() or "-"}|{(dev.get("model") or "").strip() or "-"}'
+
+def record_tune_profiles(job: dict, engine: dict):
+    """Store each target's tuned write size / depth and the rate it achieved under its device class."""
+    classes = (job.get("meta") or {}).get("target_classes") or {}
+    profiles = os_meta_load(tune_profiles_path())
+    changed = False
+    for t in engine.get("targets") or []:
+        tune = t.get("tune") or {}
+        key = classes.get(t.get("target"))
+        if not key or not t.get("ok") or tune.get("mode") not in ("trial", "profile"):
+            continue
+        cur = profiles.get(key) or {}
+        if tune["mode"] == "trial" and tune.get("chosen_mbps"):
+            cur.update({"write_size": tune.get("write_size"), "queue_depth": tune.get("queue_depth"),
+                        "tuned_mbps": tune["chosen_mbps"], "trials": tune.get("trials"), "tuned_at": time.time()})
+        if not cur.get("write_size"):
+            continue
+        n = int(cur.get("flashes", 0))
+        mbps = float(t.get("mbps") or 0)
+        cur["mbps"] = round(mbps if not n else 0.7 * float(cur.get("mbps", mbps)) + 0.3 * mbps, 2)
+        cur["flashes"] = n + 1
+        cur["updated_at"] = time.time()
+        profiles[key] = cur
+        changed = True
+    if changed:
+        try:
+            os_meta_save(tune_profiles_path(), profiles)
+        except Exception:
+            pass
+
+def throughput_mbps() -> dict:
+    rates = dict(DEFAULT_THROUGHPUT_MBPS)
+    for fmt, st in os_meta_load(decode_stats_path()).items():
+        if isinstance(st, dict) and st.get("mbps"):
+            rates[fmt] = float(st["mbps"])
+    for k, v in (load_policy().get("throughput_mbps") or {}).items():
+        try:
+            rates[k] = float(v)
+        except (TypeError, ValueError):
+            continue
+    return rates
+
+def os_variant_dir() -> str:
+    d = os.path.join(os_cache_dir(), "variants")
+    os.makedirs(d, exist_ok=True)
+    return d
+
+def os_variant_files(sha256: str) -> dict:
+    out = {}
+    dirs = [t["variants"] for t in cache_tiers()[:-1] if t["available"]] + [os_variant_dir()]
+    for kind, suffix in VARIANT_SUFFIX.items():
+        path = next((p for p in (os.path.join(d, sha256 + suffix) for d in dirs) if os.path.exists(p)), "")
+        if path:
+            st = os.stat(path)
+            out[kind] = {"path": path, "size_bytes": st.st_blocks * 512, "apparent_bytes": st.st_size}
+    # pre-customized copies (<sha256>.custom-<hash16>.img) live and go with the blob like variants
+    for d in dirs:
+        for fn in os.listdir(d) if os.path.isdir(d) else []:
+            if fn.startswith(sha256 + ".custom-") and fn.endswith(".img"):
+                st = os.stat(os.path.join(d, fn))
+                out.setdefault(fn[len(sha256) + 1:-len(".img")], {
+                    "path": os.path.join(d, fn), "size_bytes": st.st_blocks * 512, "apparent_bytes": st.st_size})
+    return out
+
+def source_kind(url: str, path: str = "") -> str:
+    if path and os.path.exists(path):
+        return flash_engine.sniff_format(path)
+    cmd = guess_decompress_cmd(url)
+    return {"xz -dc": "xz", "gzip -dc": "gzip", "zstd -dc": "zstd", "unzip -p": "zip", "bzip2 -dc": "bzip2"}.get(cmd, "raw")
+
+def decode_cmd(kind: str) -> str:
+    return " ".join(shlex_quote(x) for x in flash_engine.decoder_argv(kind))
+
+def job_running(job_type: str, **match) -> dict | None:
+    for jid in job_ids():
+        job = job_load(jid)
+        if not job or job.get("type") != job_type or job.get("status") != "running":
+            continue
+        if not job_is_alive(int(job.get("pid", 0) or 0)):
+            continue
+        meta = job.get("meta") or {}
+        if all(meta.get(k) == v for k, v in match.items()):
+            return job
+    return None
+
+def maybe_start_variant_job(sha256: str, url: str) -> dict | None:
+    """Start a background job deriving the configured variant of a blob, if it is hot enough."""
+    sha = norm_sha256(sha256)
+    cfg = load_policy().get("os_cache_variants") or {}
+    kind = str(cfg.get("kind") or "").lower()
+    if not sha or kind not in VARIANT_SUFFIX:
+        return None
+    blob = os_blob_path(sha)
+    src = source_kind(url, blob)
+    if not os.path.exists(blob) or src == "raw" or src == kind:
+        return None
+    if int(os_usage_load(sha).get("hits", 0)) < int(cfg.get("min_hits", 0)):
+        return None
+    if kind in os_variant_files(sha) or job_running("os_variant", blob=sha):
+        return None
+    if cache_reservations(lambda res: cache_tier_room(cache_tier_of(blob), res)) < os.path.getsize(blob):
+        return None   # a variant is about the blob's size (zstd) or sparse (raw); don't squeeze downloads
+
+    out = os.path.join(cache_tier_of(blob)["variants"], sha + VARIANT_SUFFIX[kind])
+    decode = decode_cmd(src)
+    # keep the blob and the variant out of the page cache (dd nocache / app.py sink)
+    read = f'{decode} "$IN"' if src == "zip" else f'dd if="$IN" bs=4M iflag=nocache status=none | {decode}'
+    if kind == "raw":
+        encode = 'dd of="$TMP" bs=4M conv=sparse,fdatasync oflag=nocache status=none'
+    else:
+        level = max(1, min(19, int(cfg.get("level", 3))))
+        sink = f'{shlex_quote(sys.executable)} {shlex_quote(os.path.abspath(__file__))} sink "$TMP" >/dev/null'
+        encode = f'zstd -q -T0 -{level} -c | {sink}'
+    script = f"""
+echo "=== OS VARIANT ({kind}) ==="
+IN={shlex_quote(blob)}
+OUT={shlex_quote(out)}
+TMP="$OUT.tmp"
+command -v {decode.split()[0]} >/dev/null || {{ echo "ERROR: {decode.split()[0]} not installed"; exit 20; }}
+{"command -v zstd >/dev/null || { echo 'ERROR: zstd not installed'; exit 21; }" if kind == "zstd" else ""}
+rm -f "$TMP"
+{read} | {encode}
+mv "$TMP" "$OUT"
+echo "VARIANT_READY $(du -h "$OUT" | awk '{{print $1}}')"
+"""
+    return start_job("os_variant", script, {"blob": sha, "kind": kind, "source_kind": src, "out": out})
+
+def pick_flash_source(sha256: str, url: str, target: dict | None = None, extract_size=None) -> dict:
+    """
+    Choose between the original blob and its derived variants. Each candidate's rate is the
+    slowest of decode, cache read from its tier (scaled by its compression ratio) and the target;
+    ties go to the candidate that reads fewer bytes from the cache.
+    """
+    rates = throughput_mbps()
+    target_rate = predict_target_mbps(target or {})["mbps"]
+
+    blob = os_blob_path(sha256)
+    cands = [{"kind": source_kind(url, blob), "path": blob, "size_bytes": os.path.getsize(blob), "variant": False}]
+    variants = {k: v for k, v in os_variant_files(sha256).items() if k in VARIANT_SUFFIX}
+    for kind, v in variants.items():
+        cands.append({"kind": kind, "path": v["path"], "size_bytes": v["size_bytes"], "variant": True})
+    try:
+        raw_bytes = int(extract_size or 0)
+    except (TypeError, ValueError):
+        raw_bytes = 0
+    raw_bytes = raw_bytes or (variants.get("raw") or {}).get("apparent_bytes") or max(c["size_bytes"] for c in cands)
+    for c in cands:
+        ratio = raw_bytes / max(1, c["size_bytes"])
+        tier = cache_tier_of(c["path"])
+        c["tier"] = tier["name"]
+        c["est_mbps"] = round(min(rates.get(c["kind"], rates["xz"]), cache_tier_read_mbps(tier) * ratio, target_rate), 1)
+        c["decode"] = decode_cmd(c["kind"])
+    cands.sort(key=lambda c: (-c["est_mbps"], c["size_bytes"]))
+    best = dict(cands[0])
+    best["candidates"] = cands
+    return best
+
+# ---------------- flash engine ----------------
+
+FLASH_ENGINE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "flash_engine.py")
+FLASH_VERIFY_MODES = ("none", "sample", "full")
+
+def flash_engine_settings() -> dict:
+    """
+    policy.flash_engine = {"engine": "native"|"dd", "block_size": 4194304, "buffers": 8,
+                           "queue_depth": 4, "sync_mb": 64, "direct": true, "sparse": true,
+                           "verify": "none"|"sample"|"full", "verify_samples": 64, "stall_timeout": 120,
+                           "delta": false, "delta_max_ratio": 0.5, "trim": true,
+                           "tune": "auto"|"always"|"off"}
+    sparse: write only the ranges in the entry's block map (paths["bmap"]), recording one on first flash.
+    verify: read the target back after the write (/api/flash "verify" overrides per job).
+    delta: compare with what the target already holds and write only differing chunks (/api/flash "delta"
+    overrides per job), falling back to plain writes once more than delta_max_ratio of it differs.
+    trim: discard the image area first and let the device zero sparse ranges, where sysfs says it can.
+    tune: "auto" starts from the learned profile for the target's tran/model (cache/tune_profiles.json)
+    and tunes write size / queue depth during the first seconds when there is none; "always" re-tunes.
+    stall_timeout: seconds without a completed write before one target of a fan-out flash is dropped.
+    """
+    cfg = load_policy().get("flash_engine") or {}
+    out = {"engine": "native", "block_size": 4 * 1024 * 1024, "buffers": 8, "queue_depth": 4, "sync_mb": 64,
+           "direct": True, "sparse": True, "verify": "none", "verify_samples": 64, "stall_timeout": 120,
+           "delta": False, "delta_max_ratio": 0.5, "trim": True, "tune": "auto"}
+    if str(cfg.get("engine", "")).lower() in ("native", "dd"):
+        out["engine"] = str(cfg["engine"]).lower()
+    for k in ("block_size", "buffers", "queue_depth", "sync_mb", "verify_samples", "stall_timeout"):
+        try:
+            out[k] = max(0, int(cfg.get(k, out[k])))
+        except (TypeError, ValueError):
+            pass
+    out["direct"] = bool(cfg.get("direct", True))
+    out["sparse"] = bool(cfg.get("sparse", True))
+    if str(cfg.get("verify", "")).lower() in FLASH_VERIFY_MODES:
+        out["verify"] = str(cfg["verify"]).lower()
+    out["delta"] = bool(cfg.get("delta", False))
+    out["trim"] = bool(cfg.get("trim", True))
+    if str(cfg.get("tune", "")).lower() in ("auto", "always", "off"):
+        out["tune"] = str(cfg["tune"]).lower()
+    try:
+        out["delta_max_ratio"] = min(1.0, max(0.0, float(cfg.get("delta_max_ratio", out["delta_max_ratio"]))))
+    except (TypeError, ValueError):
+        pass
+    return out
+
+def flash_target_id(dev: dict) -> str:
+    """Stable identity for checkpoints: the serial survives re-plugging (sda -> sdb), the path doesn't."""
+    return str(dev.get("serial") or "").strip() or str(dev.get("path") or "")
+
+def flash_checkpoint_path(dev: dict) -> str:
+    d = os.path.join(CACHE_DIR, "flash_checkpoints")
+    os.makedirs(d, exist_ok=True)
+    slug = re.sub(r"[^A-Za-z0-9_.-]+", "_", flash_target_id(dev)).strip("_") or "target"
+    return os.path.join(d, slug + ".json")
+
+def flash_checkpoint_load(dev: dict) -> dict | None:
+    """Checkpoint an interrupted flash left for this target (written by flash_engine.py --checkpoint)."""
+    path = flash_checkpoint_path(dev)
+    try:
+        with open(path, "r", encoding="utf-8") as f:
+            cp = json.load(f)
+    except (OSError, ValueError):
+        return None
+    if cp.get("target_id") != flash_target_id(dev):
+        return None
+    return cp
+
+def flash_tune_args(engine: dict, devs: list[dict]) -> str:
+    """--profile for targets whose device class has learned settings, --tune for the others."""
+    if engine["tune"] == "off":
+        return ""
+    profiles = os_meta_load(tune_profiles_path()) if engine["tune"] == "auto" else {}
+    args = []
+    for dev in devs:
+        prof = profiles.get(tune_profile_key(dev)) or {}
+        if prof.get("write_size") and prof.get("queue_depth"):
+            args.append(f'--profile {shlex_quote(dev["path"] + "=" + str(int(prof["write_size"])) + ":" + str(int(prof["queue_depth"])))}')
+    if len(args) < len(devs):
+        args.append("--tune")
+    return "".join(" " + a for a in args)
+
+def flash_engine_cmd(engine: dict, source: dict, os_item: dict, paths: dict, target_args: str) -> str:
+    """Shell command running flash_engine.py on "$IN"; target_args carries the --target option(s)."""
+    extract_sha = norm_sha256(os_item.get("extract_sha256"))
+    cmd = " ".join([
+        '$SUDO', shlex_quote(sys.executable), shlex_quote(FLASH_ENGINE),
+        '--source "$IN"', f'--format {shlex_quote(source["kind"])}', target_args,
+        '--status "$JR_ENGINE_STATUS"', f'--expect-size {int(os_item.get("extract_size") or 0)}',
+        *([f'--expect-sha256 {extract_sha}'] if extract_sha else []),
+        f'--block-size {engine["block_size"]}', f'--buffers {engine["buffers"]}',
+        f'--queue-depth {engine["queue_depth"]}', f'--sync-mb {engine["sync_mb"]}',
+        f'--stall-timeout {engine["stall_timeout"]}',
+        f'--verify {engine["verify"]}', f'--verify-samples {engine["verify_samples"]}',
+        *([f'--delta --delta-max-ratio {engine["delta_max_ratio"]}'] if engine["delta"] else []),
+        *([] if engine["trim"] else ["--trim off"]),
+        *([] if engine["direct"] else ["--no-direct"]),
+    ])
+    if engine["sparse"]:
+        have = os.path.exists(paths["bmap"])
+        cmd += f' --bmap {shlex_quote(paths["bmap"])}' if have else f' --bmap-out {shlex_quote(paths["bmap"])}'
+    return cmd
+
+# ---------------- downloads + prefetch ----------------
+
+def start_download_job(os_item: dict, job_type: str = "download_os", wait_seconds: int = 0,
+                       rate_limit: str = "", low_priority: bool = False) -> dict:
+    """
+    Link or download os_item into the blob store.
+    Returns {"cached", "paths", "job", "eviction"}; job is None when the blob was already cached, or
+    when no tier has room for it ("rejected" then says why). A download or prefetch of the same os_id
+    that is already running is returned as job, with "existing": True.
+    With wait_seconds the job is admitted by `app.py download-admit` once the wait is over, so a queued
+    prefetch neither evicts nor holds a reservation while it sleeps.
+    """
+    os_id = os_item["id"]
+    url = os_item["url"]
+    expect = norm_sha256(os_item.get("image_download_sha256"))
+    paths = os_cache_paths(os_id, url, expect)
+
+    meta = {
+        "os_id": os_id,
+        "name": os_item.get("name"),
+        "provider": os_item.get("provider_label"),
+        "url": url,
+        "expected_sha256": expect,
+        "release_date": os_item.get("release_date"),
+        "created_at": time.time(),
+        "path": paths["bin"],
     }
 
+    # Blob already in the store (same hash under another provider/id): just point at it
+    if paths["blob"] and os.path.exists(paths["bin"]):
+        if not os.path.exists(paths["meta"]) or os_meta_load(paths["meta"]).get("blob") != paths["blob"]:
+            meta.update({
+                "blob": paths["blob"],
+                "sha256_actual": paths["blob"],
+                "size_bytes": os.path.getsize(paths["bin"]),
+                "linked_at": time.time(),
+            })
+            os_meta_save(paths["meta"], meta)
+        os_blob_touch(paths["blob"], "download_hit")
+        return {"cached": True, "paths": paths, "job": None, "eviction": None}
+
+    # Duplicate jobs would share the .tmp file and meta stub, and each hold a reservation
+    running = job_running("download_os", os_id=os_id) or job_running("prefetch", os_id=os_id)
+    if running and running["type"] == "prefetch" and job_type != "prefetch" and not running["meta"].get("tier"):
+        job_stop(running, "superseded by a download")   # still waiting for its window; don't make the user wait too
+        running = None
+    if running:
+        return {"cached": False, "paths": paths, "job": running, "eviction": None, "existing": True}
+
+    # Reserve room (evicting only if no tier has it) before the download starts
+    try:
+        need = int(os_item.get("image_download_size") or 0)
+    except (TypeError, ValueError):
+        need = 0
+    admit, eviction = None, None
+    if wait_seconds <= 0:
+        admit = cache_admit(need, paths["key"])
+        eviction = {"evicted": admit["evicted"]}
+        if "busy" in admit:
+            # lost a race with a request admitted a moment ago; its job may not be recorded yet
+            busy = job_load(admit["busy"]) if admit["busy"] else None
+            return {"cached": False, "paths": paths, "job": busy, "eviction": None, "existing": True,
+                    **({} if busy else {"rejected": admit["error"], "room": {}})}
+        if not admit["ok"]:
+            return {"cached": False, "paths": paths, "job": None, "eviction": eviction, "rejected": admit["error"],
+                    "room": admit["room"]}
+
+    # Write meta stub now (job will fill in actual sha/size/blob)
+    os_meta_save(paths["meta"], meta)
+
+    curl_opts = ""
+    if rate_limit:
+        curl_opts = f"--limit-rate {shlex_quote(str(rate_limit))} "
+    if admit:
+        admission = f"BLOBDIR={shlex_quote(admit['tier']['blobs'])}\nTMP={shlex_quote(admit['tmp'])}\n"
+    else:
+        # exit 10: another job is downloading it now
+        admission = f"""echo "Waiting {int(wait_seconds)}s for the download window"
+sleep {int(wait_seconds)}
+ADMIT=$({shlex_quote(sys.executable)} {shlex_quote(os.path.abspath(__file__))} download-admit "$JR_JOB_ID") || {{ RC=$?; [ "$RC" -eq 10 ] && exit 0; exit 4; }}
+eval "$ADMIT"
+"""
+
+    nice = "nice -n 19 ionice -c 3 " if low_priority else ""
+
+    # Peers are addressed by hash, so they only help when the publisher hash is known.
+    # Peer bytes are verified against it like upstream bytes; a bad copy falls through.
+    peer_loop = ""
+    peers = cache_peers() if expect else []
+    if peers:
+        peer_loop = f"""  for PEER in {" ".join(shlex_quote(p) for p in peers)}; do
+    echo "Trying peer: $PEER"
+    if PEER_SHA=$({nice}curl -fsS --connect-timeout 3 {curl_opts}"$PEER/api/blobs/$EXPECT" | sink "$TMP"); then
+      if [ "$PEER_SHA" = "$EXPECT" ]; then
+        SHA="$EXPECT"
+        FROM="$PEER"
+        echo "Fetched from peer: $PEER"
+        break
+      fi
+      echo "Peer copy failed verification: $PEER"
+    fi
+    rm -f "$TMP"
+  done
+"""
+
+    # Publishers that ship a bmaptool map put it next to the image (foo.img.bmap / foo.img.xz.bmap)
+    bmap_urls = []
+    for u in (re.sub(r"\.(xz|gz|zst|bz2|zip)$", "", url) + ".bmap", url + ".bmap"):
+        if u not in bmap_urls and u != url:
+            bmap_urls.append(u)
+    bmap_fetch = f"""BMAP={shlex_quote(paths["bmap"])}
+if [ ! -f "$BMAP" ]; then
+  for BU in {" ".join(shlex_quote(u) for u in bmap_urls)}; do
+    if curl -fsSL --max-time 30 -o "$BMAP.tmp" "$BU" 2>/dev/null && grep -q "<bmap" "$BMAP.tmp"; then
+      mv "$BMAP.tmp" "$BMAP"
+      echo "Publisher bmap: $BU"
+      break
+    fi
+    rm -f "$BMAP.tmp"
+  done
+fi
+"""
+
+    # Bytes go through `app.py sink`, which hashes them on the way and keeps the page cache from
+    # filling with the image (writeback every few MiB, written ranges dropped).
+    script = f"""
+{admission}echo "Downloading: {shlex_quote(url)}"
+sink() {{ {nice}{shlex_quote(sys.executable)} {shlex_quote(os.path.abspath(__file__))} sink --prealloc {need} "$@"; }}
+META={shlex_quote(paths["meta"])}
+EXPECT={shlex_quote(expect)}
+
+mkdir -p "$BLOBDIR"
+
+if [ -n "$EXPECT" ] && [ -f "$BLOBDIR/$EXPECT" ]; then
+  # Landed in the store while this job was waiting (another id, another job)
+  echo "Blob already cached: $EXPECT"
+  SHA="$EXPECT"
+  FROM="cache"
+  SIZE=$(stat -c %s "$BLOBDIR/$EXPECT")
+else
+  SHA=""
+  FROM={shlex_quote(url)}
+{peer_loop}  if [ -z "$SHA" ]; then
+    # retry by hand: curl can't rewind bytes it already streamed into the pipe
+    for TRY in 1 2 3 4; do
+      if SHA=$({nice}curl -L --fail {curl_opts}{shlex_quote(url)} | sink "$TMP"); then
+        break
+      fi
+      SHA=""
+      echo "Download attempt $TRY failed"
+      sleep 2
+    done
+    if [ -z "$SHA" ]; then
+      echo "ERROR: download failed"
+      rm -f "$TMP"
+      exit 3
+    fi
+  fi
+  SIZE=$(stat -c %s "$TMP" || wc -c < "$TMP")
+
+  if [ -n "$EXPECT" ] && [ "$SHA" != "$EXPECT" ]; then
+    echo "SHA256 MISMATCH"
+    echo "expected=$EXPECT"
+    echo "actual=$SHA"
+    rm -f "$TMP"
+    exit 2
+  fi
+fi
+
+OUT="$BLOBDIR/$SHA"
+if [ -f "$OUT" ]; then
+  echo "Blob already cached: $SHA (dedupe)"
+  rm -f "$TMP"
+else
+  mv "$TMP" "$OUT"
+  # sink hashed exactly these bytes, so the blob starts out verified
+  {shlex_quote(sys.executable)} {shlex_quote(os.path.abspath(__file__))} blob-verified "$SHA" || true
+fi
+
+python3 - <<'PY2'
+import json, os, time
+meta_path = os.environ.get("JR_META")
+sha = os.environ.get("JR_SHA")
+size = int(os.environ.get("JR_SIZE") or "0")
+with open(meta_path, "r", encoding="utf-8") as f:
+    m = json.load(f)
+m["downloaded_at"] = time.time()
+m["sha256_actual"] = sha
+m["size_bytes"] = size
+m["blob"] = sha
+m["path"] = os.environ.get("JR_OUT")
+m["fetched_from"] = os.environ.get("JR_FROM")
+with open(meta_path + ".tmp", "w", encoding="utf-8") as f:
+    json.dump(m, f)
+os.replace(meta_path + ".tmp", meta_path)
+print("META_UPDATED")
+PY2
+
+{bmap_fetch}
+{shlex_quote(sys.executable)} {shlex_quote(os.path.abspath(__file__))} os-variant "$SHA" --url {shlex_quote(url)} || true
+nice -n 19 {shlex_quote(sys.executable)} {shlex_quote(os.path.abspath(__file__))} os-index "$SHA" >/dev/null || true
+{shlex_quote(sys.executable)} {shlex_quote(os.path.abspath(__file__))} cache-tier || true
+{shlex_quote(sys.executable)} {shlex_quote(os.path.abspath(__file__))} scrub --start || true
+"""
+    # inject env vars for python meta updater using bash exports
+    script = script.replace("python3 - <<'PY2'", 'export JR_META="$META"\nexport JR_SHA="$SHA"\nexport JR_SIZE="$SIZE"\nexport JR_OUT="$OUT"\nexport JR_FROM="$FROM"\npython3 - <<\'PY2\'')
+
+    job = start_job(job_type, script, {"os_id": os_id, "url": url, "out": paths["bin"], "expected_sha256": expect,
+                                       "tier": admit["tier"]["name"] if admit else None, "reserved_bytes": need})
+    if admit:
+        cache_reservation_bind(admit["token"], job["id"])
+    return {"cached": False, "paths": paths, "job": job, "eviction": eviction}
+
+def download_admit(job_id: str) -> int:
+    """
+    The admission start_download_job skipped for a job queued with a wait, run by the job when the wait
+    is over. Prints BLOBDIR= / TMP= for the script to eval; exit 10 when another job is downloading the
+    image, 4 when no tier has room.
+    """
+    job = job_load(job_id) or {}
+    m = job.get("meta") or {}
+    expect = m.get("expected_sha256") or ""
+    if expect and os.path.exists(os_blob_path(expect)):
+        # cached meanwhile (another id, another job): the script just links it
+        print(f"BLOBDIR={shlex_quote(os.path.dirname(os_blob_path(expect)))}\nTMP=")
+        return 0
+    admit = cache_admit(int(m.get("reserved_bytes") or 0), os_cache_paths(m["os_id"], m["url"], expect)["key"])
+    if not admit["ok"]:
+        print(admit["error"], file=sys.stderr)
+        return 10 if "busy" in admit else 4
+    cache_reservation_bind(admit["token"], job_id)
+    m["tier"] = admit["tier"]["name"]
+    m["evicted"] = admit["evicted"]
+    job_save(job)
+    for e in admit["evicted"]:
+        print(f"Evicted: {e['blob']} ({e['size_bytes']} bytes, {e['tier']})", file=sys.stderr)
+    print(f"BLOBDIR={shlex_quote(admit['tier']['blobs'])}\nTMP={shlex_quote(admit['tmp'])}")
+    return 0
+
+def cache_peers() -> list[str]:
+    """Other Golden SD units to ask for blobs: policy.peers plus JR_GOLDEN_SD_PEERS (comma-separated)."""
+    peers = list(load_policy().get("peers") or [])
+    peers += [x for x in os.environ.get("JR_GOLDEN_SD_PEERS", "").split(",")]
+    out = []
+    for p in peers:
+        p = p.strip().rstrip("/")
+        if re.match(r"^https?://[A-Za-z0-9.:\[\]_-]+(/[A-Za-z0-9._/-]*)?$", p) and p not in out:
+            out.append(p)
+    return out
+
+def window_wait_seconds(window: str, now: float | None = None) -> int:
+    """Seconds until the local-time window "HH:MM-HH:MM" opens; 0 inside it or when unset."""
+    m = re.match(r"^\s*(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})\s*$", window or "")
+    if not m:
+        return 0
+    lt = time.localtime(now)
+    cur = lt.tm_hour * 60 + lt.tm_min
+    start = int(m.group(1)) * 60 + int(m.group(2))
+    end = int(m.group(3)) * 60 + int(m.group(4))
+    if start == end:
+        return 0
+    inside = (start <= cur < end) if start < end else (cur >= start or cur < end)
+    if inside:
+        return 0
+    return ((start - cur) % (24 * 60)) * 60 - lt.tm_sec
+
+def prefetch_candidates(catalog: list[dict], patterns: list[str]) -> list[dict]:
+    """Newest release (by release_date) matching each name pattern (fnmatch, case-insensitive)."""
+    import fnmatch
+    out = []
+    for pat in patterns:
+        pat = str(pat).lower()
+        matches = [x for x in catalog if fnmatch.fnmatch((x.get("name") or "").lower(), pat)]
+        if not matches:
+            continue
+        newest = max(matches, key=lambda x: str(x.get("release_date") or ""))
+        if newest not in out:
+            out.append(newest)
+    return out
+
+def prefetch_after_refresh(catalog: list[dict]) -> list[dict]:
+    """
+    policy.prefetch = {"patterns": ["raspberry pi os lite (64-bit)*"], "window": "01:00-06:00",
+                       "rate_limit": "2M", "enabled": true}
+    Queue a low-priority, rate-limited download for each newest release that is not cached yet.
+    The job sleeps until the window opens, so it is cheap to queue right after a refresh.
+    """
+    cfg = load_policy().get("prefetch") or {}
+    patterns = cfg.get("patterns") or []
+    if not cfg.get("enabled", True) or not patterns:
+        return []
+    if detect_mode()["mode"] != "SD":
+        return []
+
+    wait = window_wait_seconds(str(cfg.get("window") or ""))
+    started = []
+    for item in prefetch_candidates(catalog, patterns):
+        paths = os_cache_paths(item["id"], item["url"], item.get("image_download_sha256"))
+        if os.path.exists(paths["bin"]):
+            continue
+        if job_running("prefetch", os_id=item["id"]) or job_running("download_os", os_id=item["id"]):
+            continue
+        res = start_download_job(item, "prefetch", wait_seconds=wait,
+                                 rate_limit=str(cfg.get("rate_limit") or "2M"), low_priority=True)
+        if res["job"]:
+            started.append({"os_id": item["id"], "release_date": item.get("release_date"), "job_id": res["job"]["id"]})
+    return started
+
 
 # ---------------- routes ----------------
 
@@ -527,6 +2699,7 @@ def device_snapshot():
             mps += collect_mountpoints(ch)
         return mps
 
+    tier_disks = cache_tier_disks()
     disks_out = []
     for d in blocks:
         if d.get("type") != "disk":
@@ -547,6 +2720,9 @@ def device_snapshot():
         if mps:
             allowed = False
             why.append("mounted")
+        if name in tier_disks:
+            allowed = False
+            why.append("holds_cache_tier")
 
         # Option A rules
         if mode == "SD":
@@ -573,6 +2749,7 @@ def device_snapshot():
             "ro": d.get("ro"),
             "mountpoints": mps,
             "is_root_parent": is_root_parent,
+            "topology": device_topology(name),
             "allowed_target_option_a": allowed,
             "why_not": why,
         })
@@ -613,6 +2790,7 @@ def safety():
             "target": armed.get("target") if armed else None,
             "os_id": armed.get("os_id") if armed else None,
             "expires_at": armed.get("expires_at") if armed else None,
+            "targets": sorted(load_arms()),
         },
         "state": {
             "mode": s["mode"],
@@ -622,6 +2800,14 @@ def safety():
         "eligible_targets": s["eligible_targets"],
     })
 
+@app.get("/api/thermal")
+def api_thermal():
+    st = thermal_state()
+    pol = thermal_policy()
+    pause_c, resume_c = thermal_limits(pol, st)
+    return jsonify({"ok": True, "thermal": st, "pause_c": pause_c, "resume_c": resume_c,
+                    "hot": thermal_hot(pol, st, False), "paced_job_types": pol.get("pace") or []})
+
 @app.get("/api/disks")
 def disks():
     # backward compat + UI visibility
@@ -665,6 +2851,17 @@ def api_plan_flash():
 
     pol = load_policy()
     url = os_item["url"]
+    cached = os_cache_paths(os_id, url, os_item.get("image_download_sha256"))
+
+    dev = next(x for x in s["eligible_targets"] if x["path"] == target)
+    checkpoint = flash_checkpoint_load(dev)
+    if checkpoint and checkpoint.get("image_id") != (cached["blob"] or None):
+        checkpoint = None
+    predicted = predict_targets([dev])[target]
+    warnings = []
+    if predicted["sharing"] > 1:
+        warnings.append(f"{target} shares {predicted['bus']} with {predicted['sharing'] - 1} running flash target(s); "
+                        f"expect about {predicted['mbps']} MB/s.")
 
     plan = {
         "ok": True,
@@ -688,13 +2885,21 @@ def api_plan_flash():
         "steps": [
             {"step": 1, "action": "Re-check safety", "detail": "Confirm target is not the root disk and SD mode is active."},
             {"step": 2, "action": "Download image", "detail": f"curl -L '{url}' -o cache/os.img (or cache/os.img.xz/zip)"},
-            {"step": 3, "action": "Verify checksum (if available)", "detail": "Compare SHA256 of download/extract if publisher hash is provided."},
-            {"step": 4, "action": "Decompress + write", "detail": f"{guess_decompress_cmd(url)} cache/os.* | sudo dd of={target} bs=4M conv=fsync status=progress"},
+            {"step": 3, "action": "Verify checksum (if available)", "detail": "Download SHA256 is checked when caching; extract SHA256 is hashed on the fly while writing and fails the job before partprobe."},
+            {"step": 4, "action": "Decompress + write", "detail": f"{guess_decompress_cmd(url, cached['bin'])} cache/os/blobs/<sha256> -> flash_engine.py (O_DIRECT writes, periodic fdatasync) -> {target}"},
             {"step": 5, "action": "Sync + re-read partition table", "detail": "sync; sudo partprobe"},
         ],
+        "resume": {
+            "available": bool(checkpoint),
+            "durable_offset": checkpoint.get("durable_offset") if checkpoint else None,
+            "updated_at": checkpoint.get("updated_at") if checkpoint else None,
+        },
+        "topology": dev.get("topology"),
+        "predicted": predicted,
         "warnings": [
             "This plan will destroy all data on the target disk when we enable flashing.",
             "Root disk is always blocked. Target must be explicitly selected and confirmed.",
+            *warnings,
         ]
     }
     return jsonify(plan)
@@ -702,7 +2907,7 @@ def api_plan_flash():
 @app.get("/api/arm_status")
 def arm_status():
     st = load_arm_state()
-    return jsonify({"active": bool(st), "state": st})
+    return jsonify({"active": bool(st), "state": st, "arms": load_arms()})
 
 @app.post("/api/arm")
 def arm():
@@ -747,8 +2952,10 @@ def arm():
 
 @app.post("/api/disarm")
 def disarm():
-    clear_arm_state()
-    return jsonify({"ok": True, "armed": False})
+    body = request.get_json(force=True, silent=True) or {}
+    target = str(body.get("target", "")).strip()
+    clear_arm_state(target or None)
+    return jsonify({"ok": True, "armed": bool(load_arms())})
 
 
 
@@ -760,6 +2967,9 @@ def api_flash():
       - SD mode (safety_state().can_flash_here)
       - policy.flash_enabled == true
       - valid, unexpired ARM token matching target + os_id
+    With "stream": true an image that isn't cached is piped from its URL straight into the engine,
+    which checks both catalog hashes on the fly and zeroes the target's first/last MiB if they fail.
+    With "profile": name the pre-customized copy for that profile is written (409 while it is built).
     """
     body = request.get_json(force=True, silent=True) or {}
     target = str(body.get("target", "")).strip()
@@ -767,6 +2977,11 @@ def api_flash():
     token = str(body.get("token", "")).strip()
     confirm_target = str(body.get("confirm_target", "")).strip()
     serial_suffix = str(body.get("serial_suffix", "")).strip()
+    verify = str(body.get("verify", "")).strip().lower()
+    delta = body.get("delta")
+    resume = bool(body.get("resume", False))
+    stream = bool(body.get("stream", False))
+    profile = str(body.get("profile", "")).strip()
 
     pol = load_policy()
     if not bool(pol.get("flash_enabled", False)):
@@ -777,38 +2992,9 @@ def api_flash():
 
     if not sstate["can_flash_here"]:
         return jsonify({"ok": False, "error": "Not in SD mode. Flashing is only allowed when booted from SD."}), 400
-    if not target or target not in eligible:
-        return jsonify({"ok": False, "error": "Target is not eligible (root disk is blocked)."}), 400
-    if confirm_target and confirm_target != target:
-        return jsonify({"ok": False, "error": "Target confirmation does not match exactly."}), 400
-
-    armed = load_arm_state()
-    if not armed:
-        return jsonify({"ok": False, "error": "Not armed. Call /api/arm first."}), 400
-
-    now = time.time()
-    exp = float(armed.get("expires_at") or 0)
-    if exp <= now:
-        clear_arm_state()
-        return jsonify({"ok": False, "error": "ARM token expired. Re-arm and try again."}), 400
-
-    if armed.get("target") != target:
-        return jsonify({"ok": False, "error": "ARM state target does not match requested target."}), 400
-
-    if not os_id:
-        os_id = str(armed.get("os_id") or "").strip()
-    if not os_id:
-        return jsonify({"ok": False, "error": "os_id required (and must match what you armed with)."}), 400
-    if armed.get("os_id") and armed.get("os_id") != os_id:
-        return jsonify({"ok": False, "error": "ARM state os_id does not match requested os_id."}), 400
-
-    if not token or token != str(armed.get("token") or ""):
-        return jsonify({"ok": False, "error": "Invalid or missing token. Use the token returned by /api/arm."}), 400
-
-    if serial_suffix:
-        actual = (eligible[target].get("serial") or "")
-        if actual and not actual.endswith(serial_suffix):
-            return jsonify({"ok": False, "error": "Serial suffix does not match target disk."}), 400
+    err, os_id = flash_arm_error(target, os_id, token, confirm_target, serial_suffix, eligible)
+    if err:
+        return jsonify({"ok": False, "error": err}), 400
 
     catalog = load_os_catalog()
     os_item = find_os(os_id, catalog)
@@ -816,20 +3002,92 @@ def api_flash():
         return jsonify({"ok": False, "error": "Unknown os_id. Refresh OS list and try again."}), 400
 
     url = os_item["url"]
-    paths = os_cache_paths(os_id, url)
+    paths = os_cache_paths(os_id, url, os_item.get("image_download_sha256"))
     in_path = paths["bin"]
 
-    if not os.path.exists(in_path):
-        return jsonify({"ok": False, "error": "OS image not cached. Call /api/download_os first.", "paths": paths}), 400
+    streaming = stream and not os.path.exists(in_path)
+    if not os.path.exists(in_path) and not streaming:
+        return jsonify({"ok": False, "error": "OS image not cached. Call /api/download_os first (or pass stream: true).",
+                        "paths": paths}), 400
+
+    if streaming:
+        if source_kind(url) == "zip":
+            return jsonify({"ok": False, "error": "zip images can't be streamed; download them first."}), 400
+        if not (norm_sha256(os_item.get("image_download_sha256")) or norm_sha256(os_item.get("extract_sha256"))):
+            return jsonify({"ok": False, "error": "Streaming needs image_download_sha256 or extract_sha256 to verify the image."}), 400
+        if resume:
+            return jsonify({"ok": False, "error": "Streamed flashes can't be resumed; download the image first."}), 400
+        # the engine sniffs the format from the first bytes; the URL suffix only names the decoder to check for
+        source = {"kind": "auto", "path": "-", "decode": decode_cmd(source_kind(url)), "variant": False}
+    elif paths["blob"]:
+        source = pick_flash_source(paths["blob"], url, eligible[target], os_item.get("extract_size"))
+    else:
+        source = {"kind": source_kind(url, in_path), "path": in_path, "decode": decode_cmd(source_kind(url, in_path)), "variant": False}
+    image_id = paths["blob"]
+    custom = None
+    if profile:
+        if streaming:
+            return jsonify({"ok": False, "error": "Customization profiles need the image cached; download it first."}), 400
+        custom = custom_flash_source(os_item, paths, profile)
+        if custom.get("error"):
+            return jsonify({"ok": False, "error": custom["error"], "job": custom.get("job")}), custom["status"]
+        source, paths, os_item, image_id = custom["source"], custom["paths"], custom["os_item"], custom["image_id"]
+    in_path = source["path"]
+    decode = source["decode"]
+
+    engine = flash_engine_settings()
+    if verify:
+        if verify not in FLASH_VERIFY_MODES:
+            return jsonify({"ok": False, "error": f"verify must be one of: {', '.join(FLASH_VERIFY_MODES)}"}), 400
+        engine["verify"] = verify
+    if delta is not None:
+        engine["delta"] = bool(delta)
+    checkpoint = None
+    if resume:
+        checkpoint = flash_checkpoint_load(eligible[target])
+        if engine["engine"] == "dd" or not checkpoint or checkpoint.get("image_id") != (image_id or None):
+            return jsonify({"ok": False, "error": "Nothing to resume for this target and image; start a normal flash."}), 400
+    if streaming:
+        if engine["engine"] != "native":
+            return jsonify({"ok": False, "error": "Streaming needs policy.flash_engine.engine=native."}), 400
+        download_sha = norm_sha256(os_item.get("image_download_sha256"))
+        write_cmd = 'curl -L --fail -sS "$URL" | ' + flash_engine_cmd(engine, source, os_item, paths, '--target "$TARGET"')
+        write_cmd += flash_tune_args(engine, [eligible[target]])
+        write_cmd += (f" --expect-source-sha256 {download_sha}" if download_sha else "") + " --invalidate-on-fail"
+    elif engine["engine"] == "dd":
+        write_cmd = f'{decode} "$IN" | $SUDO dd of="$TARGET" bs=4M conv=fsync status=progress'
+    else:
+        write_cmd = flash_engine_cmd(engine, source, os_item, paths, '--target "$TARGET"')
+        write_cmd += flash_tune_args(engine, [eligible[target]])
+        write_cmd += flash_source_verify_args(source, paths["blob"]) if not resume else ""
+        write_cmd += " ".join([
+            "", f'--checkpoint {shlex_quote(flash_checkpoint_path(eligible[target]))}',
+            f'--target-id {shlex_quote(flash_target_id(eligible[target]))}',
+            *([f'--image-id {image_id}'] if image_id else []),
+            *(["--resume"] if resume else []),
+        ])
+
+    predicted = predict_targets([eligible[target]])
+    bus_wait_cmd = (f'{shlex_quote(sys.executable)} {shlex_quote(os.path.abspath(__file__))} bus-wait "$JR_JOB_ID"'
+                    if bus_topology_settings()["max_per_bus"] else "")
 
     # One-shot: disarm immediately so the token can't be reused.
-    clear_arm_state()
+    clear_arm_state(target)
+    if not streaming:
+        os_blob_touch(paths["blob"], "flash")
+        maybe_start_variant_job(paths["blob"], url)
+        maybe_start_tier_job()
+    if streaming:
+        source_check = 'command -v curl >/dev/null || { echo "ERROR: curl not installed"; exit 21; }'
+    else:
+        source_check = 'if [ ! -f "$IN" ]; then\n  echo "ERROR: cached image missing: $IN"\n  exit 11\nfi'
 
     script = f"""
 echo "=== FLASH JOB ==="
 echo "TARGET={shlex_quote(target)}"
 echo "IN={shlex_quote(in_path)}"
 echo "URL={shlex_quote(url)}"
+echo "SOURCE={"streamed from URL, format sniffed" if streaming else source["kind"]}{f" (customized: profile {profile})" if custom else " (cached variant)" if source["variant"] else ""}"
 
 TARGET={shlex_quote(target)}
 IN={shlex_quote(in_path)}
@@ -844,10 +3102,7 @@ if [ ! -b "$TARGET" ]; then
   echo "ERROR: target is not a block device: $TARGET"
   exit 10
 fi
-if [ ! -f "$IN" ]; then
-  echo "ERROR: cached image missing: $IN"
-  exit 11
-fi
+{source_check}
 
 echo
 echo "=== Unmount anything mounted on target (if any) ==="
@@ -858,18 +3113,9 @@ done
 
 echo
 echo "=== Write image to target (DESTROYS DATA) ==="
-if [[ "$URL" == *.xz ]]; then
-  command -v xz >/dev/null || {{ echo "ERROR: xz not installed"; exit 20; }}
-  xz -dc "$IN" | $SUDO dd of="$TARGET" bs=4M conv=fsync status=progress
-elif [[ "$URL" == *.gz ]]; then
-  command -v gzip >/dev/null || {{ echo "ERROR: gzip not installed"; exit 21; }}
-  gzip -dc "$IN" | $SUDO dd of="$TARGET" bs=4M conv=fsync status=progress
-elif [[ "$URL" == *.zip ]]; then
-  command -v unzip >/dev/null || {{ echo "ERROR: unzip not installed"; exit 22; }}
-  unzip -p "$IN" | $SUDO dd of="$TARGET" bs=4M conv=fsync status=progress
-else
-  cat "$IN" | $SUDO dd of="$TARGET" bs=4M conv=fsync status=progress
-fi
+command -v {decode.split()[0]} >/dev/null || {{ echo "ERROR: {decode.split()[0]} not installed"; exit 20; }}
+{bus_wait_cmd}
+{write_cmd}
 
 echo
 echo "=== Sync + re-read partitions ==="
@@ -884,11 +3130,203 @@ echo "=== FLASH COMPLETE ==="
         "url": url,
         "in": in_path,
         "target": target,
+        "blob": paths["blob"],
+        "source_kind": source["kind"],
+        "source_variant": source["variant"],
+        "stream": streaming,
+        "profile": profile or None,
+        "custom_kind": custom["kind"] if custom else None,
+        "engine": engine,
+        "target_classes": {target: tune_profile_key(eligible[target])},
+        "buses": {target: predicted[target]["bus"]},
+        "predicted": predicted,
+        "resume_from": checkpoint.get("durable_offset") if checkpoint else None,
         "paths": paths,
-    })
+    }, on_exit=f'{shlex_quote(sys.executable)} {shlex_quote(os.path.abspath(__file__))} engine-absorb "$JR_JOB_ID"')
     return jsonify({"ok": True, "job_id": job["id"], "job": job, "paths": paths})
 
 
+@app.post("/api/flash_multi")
+def api_flash_multi():
+    """
+    DESTRUCTIVE: Writes one cached OS image to several targets at once (decoded once, fanned out).
+    Body: {"os_id": ..., "targets": [{"target", "token", "confirm_target"?, "serial_suffix"?}, ...], "verify"?}
+    Every target must pass the same checks as /api/flash against its own arm; rejected targets are
+    reported and left alone. A target that fails mid-write doesn't stop the others.
+    """
+    body = request.get_json(force=True, silent=True) or {}
+    os_id = str(body.get("os_id", "")).strip()
+    verify = str(body.get("verify", "")).strip().lower()
+    delta = body.get("delta")
+    profile = str(body.get("profile", "")).strip()
+    wanted = body.get("targets") if isinstance(body.get("targets"), list) else []
+
+    pol = load_policy()
+    if not bool(pol.get("flash_enabled", False)):
+        return jsonify({"ok": False, "error": "Flashing is disabled (policy.flash_enabled=false)."}), 403
+
+    sstate = safety_state()
+    eligible = {x["path"]: x for x in sstate["eligible_targets"]}
+
+    if not sstate["can_flash_here"]:
+        return jsonify({"ok": False, "error": "Not in SD mode. Flashing is only allowed when booted from SD."}), 400
+    if not os_id:
+        return jsonify({"ok": False, "error": "os_id required (and must match what you armed with)."}), 400
+    if not wanted:
+        return jsonify({"ok": False, "error": "targets required: [{target, token}, ...]"}), 400
+
+    targets, rejected = [], []
+    for t in wanted:
+        t = t if isinstance(t, dict) else {}
+        target = str(t.get("target", "")).strip()
+        if target in targets:
+            rejected.append({"target": target, "error": "Target listed twice."})
+            continue
+        err, _ = flash_arm_error(target, os_id, str(t.get("token", "")).strip(),
+                                 str(t.get("confirm_target", "")).strip(), str(t.get("serial_suffix", "")).strip(), eligible)
+        if err:
+            rejected.append({"target": target, "error": err})
+        else:
+            targets.append(target)
+    if not targets:
+        return jsonify({"ok": False, "error": "No target passed the arm checks.", "rejected": rejected}), 400
+
+    catalog = load_os_catalog()
+    os_item = find_os(os_id, catalog)
+    if not os_item:
+        return jsonify({"ok": False, "error": "Unknown os_id. Refresh OS list and try again."}), 400
+
+    url = os_item["url"]
+    paths = os_cache_paths(os_id, url, os_item.get("image_download_sha256"))
+    in_path = paths["bin"]
+
+    if not os.path.exists(in_path):
+        return jsonify({"ok": False, "error": "OS image not cached. Call /api/download_os first.", "paths": paths}), 400
+
+    # the slowest target bounds a fan-out (targets on one bus split its link), so pick the source for it
+    predicted = predict_targets([eligible[t] for t in targets])
+    slowest = min(targets, key=lambda t: predicted[t]["mbps"])
+    source = pick_flash_source(paths["blob"], url, eligible[slowest], os_item.get("extract_size")) if paths["blob"] else {
+        "kind": source_kind(url, in_path), "path": in_path, "decode": decode_cmd(source_kind(url, in_path)), "variant": False,
+    }
+    custom = None
+    if profile:
+        custom = custom_flash_source(os_item, paths, profile)
+        if custom.get("error"):
+            return jsonify({"ok": False, "error": custom["error"], "job": custom.get("job")}), custom["status"]
+        source, paths, os_item = custom["source"], custom["paths"], custom["os_item"]
+    in_path = source["path"]
+    decode = source["decode"]
+
+    engine = flash_engine_settings()
+    if verify:
+        if verify not in FLASH_VERIFY_MODES:
+            return jsonify({"ok": False, "error": f"verify must be one of: {', '.join(FLASH_VERIFY_MODES)}"}), 400
+        engine["verify"] = verify
+    if delta is not None:
+        engine["delta"] = bool(delta)
+    if engine["engine"] != "native":
+        return jsonify({"ok": False, "error": "Fan-out flashing needs policy.flash_engine.engine=native."}), 400
+    write_cmd = flash_engine_cmd(engine, source, os_item, paths, '"${TARGET_ARGS[@]}"')
+    write_cmd += flash_tune_args(engine, [eligible[t] for t in targets])
+    write_cmd += flash_source_verify_args(source, paths["blob"])
+
+    bus_wait_cmd = (f'{shlex_quote(sys.executable)} {shlex_quote(os.path.abspath(__file__))} bus-wait "$JR_JOB_ID"'
+                    if bus_topology_settings()["max_per_bus"] else "")
+
+    # One-shot per target, as in /api/flash.
+    for target in targets:
+        clear_arm_state(target)
+    os_blob_touch(paths["blob"], "flash")
+    maybe_start_variant_job(paths["blob"], url)
+    maybe_start_tier_job()
+
+    script = f"""
+echo "=== FLASH JOB (fan-out: {len(targets)} targets) ==="
+TARGETS=({" ".join(shlex_quote(t) for t in targets)})
+IN={shlex_quote(in_path)}
+URL={shlex_quote(url)}
+OKLIST="$JR_ENGINE_STATUS.ok"
+echo "TARGETS=${{TARGETS[*]}}"
+echo "IN=$IN"
+echo "URL=$URL"
+echo "SOURCE={source["kind"]}{" (cached variant)" if source["variant"] else ""}"
+
+SUDO=""
+if [ "$(id -u)" -ne 0 ]; then
+  SUDO="sudo -n"
+fi
+
+TARGET_ARGS=()
+for TARGET in "${{TARGETS[@]}}"; do
+  if [ ! -b "$TARGET" ]; then
+    echo "ERROR: target is not a block device: $TARGET"
+    exit 10
+  fi
+  TARGET_ARGS+=(--target "$TARGET")
+done
+if [ ! -f "$IN" ]; then
+  echo "ERROR: cached image missing: $IN"
+  exit 11
+fi
+
+echo
+echo "=== Unmount anything mounted on targets (if any) ==="
+for TARGET in "${{TARGETS[@]}}"; do
+  lsblk -nrpo NAME,MOUNTPOINT "$TARGET" | awk 'NF>=2 && $2!="" {{print $1}}' | while read -r dev; do
+    echo "umount $dev"
+    $SUDO umount "$dev" 2>/dev/null || true
+  done
+done
+
+echo
+echo "=== Write image to targets (DESTROYS DATA) ==="
+command -v {decode.split()[0]} >/dev/null || {{ echo "ERROR: {decode.split()[0]} not installed"; exit 20; }}
+rm -f "$OKLIST"
+{bus_wait_cmd}
+set +e
+{write_cmd} --ok-list "$OKLIST"
+RC=$?
+set -e
+
+echo
+echo "=== Sync + re-read partitions (targets that finished cleanly) ==="
+$SUDO sync
+if [ -f "$OKLIST" ]; then
+  while read -r TARGET; do
+    $SUDO partprobe "$TARGET" 2>/dev/null || true
+  done < "$OKLIST"
+fi
+$SUDO udevadm settle 2>/dev/null || true
+if [ "$RC" -ne 0 ]; then
+  echo "=== FLASH FINISHED WITH ERRORS (engine rc=$RC) ==="
+  exit "$RC"
+fi
+echo "=== FLASH COMPLETE ==="
+"""
+
+    job = start_job("flash", script, {
+        "os_id": os_id,
+        "url": url,
+        "in": in_path,
+        "target": targets[0],
+        "targets": targets,
+        "target_classes": {t: tune_profile_key(eligible[t]) for t in targets},
+        "buses": {t: predicted[t]["bus"] for t in targets},
+        "predicted": predicted,
+        "rejected": rejected,
+        "blob": paths["blob"],
+        "source_kind": source["kind"],
+        "source_variant": source["variant"],
+        "profile": profile or None,
+        "custom_kind": custom["kind"] if custom else None,
+        "engine": engine,
+        "paths": paths,
+    }, on_exit=f'{shlex_quote(sys.executable)} {shlex_quote(os.path.abspath(__file__))} engine-absorb "$JR_JOB_ID"')
+    return jsonify({"ok": True, "job_id": job["id"], "job": job, "paths": paths, "targets": targets, "rejected": rejected,
+                    "predicted": predicted})
+
+
 @app.get("/api/job/<job_id>")
 def api_job(job_id: str):
     # JOB_ID_VALIDATE_API_JOB: job_id is used to form filenames; keep it boring
@@ -902,7 +3340,7 @@ def api_job(job_id: str):
     # JOB_STATUS_RC_WINS_API_JOB: rc file wins over stale 'running' state
     try:
         from pathlib import Path
-        rc_path = Path('cache/jobs') / f"{job_id}.rc"
+        rc_path = Path(jobs_dir()) / f"{job_id}.rc"
         if rc_path.exists():
             rc_txt = rc_path.read_text(encoding='utf-8', errors='ignore').strip()
             try:
@@ -921,6 +3359,14 @@ def api_job(job_id: str):
                 job['status'] = 'stale'
     except Exception as e:
         job.setdefault('status_note', f"status_enrich_error: {e}")
+    engine = job_engine_status(job)
+    if engine is not None:
+        job["engine"] = engine
+    telemetry = job_telemetry(job)
+    if telemetry is not None:
+        job["telemetry"] = telemetry
+        if telemetry.get("paused") and job.get("status") == "running":
+            job["status_note"] = "paused: SoC near its thermal limit"
     # Don't spam huge logs in JSON; provide log path and let caller fetch tail via ssh if needed
     return jsonify({"ok": True, "job": job})
 
@@ -940,7 +3386,7 @@ def api_job_tail(job_id):
     n = 200
   n = max(1, min(n, 2000))
 
-  log_path = Path("cache/jobs") / f"{job_id}.log"
+  log_path = Path(jobs_dir()) / f"{job_id}.log"
   if not log_path.exists():
     return jsonify({"job_id": job_id, "exists": False, "lines": []}), 404
 
@@ -980,17 +3426,125 @@ def api_os_cache():
     os_item = find_os(os_id, catalog)
     if not os_item:
         return jsonify({"ok": False, "error": "Unknown os_id"}), 404
-    paths = os_cache_paths(os_id, os_item["url"])
-    meta = {}
-    if os.path.exists(paths["meta"]):
-        try:
-            with open(paths["meta"], "r", encoding="utf-8") as f:
-                meta = json.load(f)
-        except Exception:
-            meta = {}
+    paths = os_cache_paths(os_id, os_item["url"], os_item.get("image_download_sha256"))
+    meta = os_meta_load(paths["meta"])
     exists = os.path.exists(paths["bin"])
     size = os.path.getsize(paths["bin"]) if exists else 0
-    return jsonify({"ok": True, "cached": bool(exists), "size_bytes": size, "paths": paths, "meta": meta})
+    verified = verify_job = None
+    if exists and paths["blob"]:
+        verified = os_blob_memo(paths["blob"])
+        # ?verify=1 without a memo that still matches the file: a rate-limited scrub job rehashes it
+        if request.args.get("verify") in ("1", "true") and not verified:
+            verify_job = start_blob_scrub_job(paths["blob"])
+    return jsonify({"ok": True, "cached": bool(exists), "size_bytes": size, "paths": paths, "meta": meta,
+                    "verified": verified, **({"verify_job_id": verify_job["id"]} if verify_job else {})})
+
+@app.get("/api/os_cache/inspect")
+def api_os_cache_inspect():
+    os_id = request.args.get("os_id", "").strip()
+    if not os_id:
+        return jsonify({"ok": False, "error": "os_id required"}), 400
+    partition = request.args.get("partition", "").strip()
+    if partition and not re.fullmatch(r"[0-9]{1,3}", partition):
+        return jsonify({"ok": False, "error": "partition must be a partition number"}), 400
+    os_item = find_os(os_id, load_os_catalog())
+    if not os_item:
+        return jsonify({"ok": False, "error": "Unknown os_id"}), 404
+    paths = os_cache_paths(os_id, os_item["url"], os_item.get("image_download_sha256"))
+    if not paths["blob"] or not os.path.exists(paths["bin"]):
+        return jsonify({"ok": False, "error": "OS image not cached. Call /api/download_os first."}), 400
+    t0 = time.time()
+    idx = os_blob_index(paths["blob"])
+    if idx is None:
+        job = maybe_start_index_job(paths["blob"])
+        return jsonify({"ok": True, "pending": True, "blob": paths["blob"], "job_id": job["id"], "job": job}), 202
+    out = {
+        "ok": True, "blob": paths["blob"], "format": idx["format"], "seekable": idx["seekable"],
+        "units": len(idx["units"]), "image_bytes": idx.get("image_bytes"), "note": idx.get("note"),
+        "build_s": idx.get("build_s"), "inspect": idx["inspect"],
+        "init_format": {"catalog": os_item.get("init_format"), "image": idx["inspect"].get("init_format")},
+    }
+    want = request.args.get("file", "").strip()
+    if want:
+        # ?file=/overlays/README[&partition=N]: read one file via the index (default: the boot partition)
+        num = int(partition or idx["inspect"].get("boot_partition") or 0)
+        part = next((p for p in idx["inspect"]["partitions"] if p["number"] == num and "files" in p), None)
+        if not part:
+            return jsonify({"ok": False, "error": f"partition {num} is not a FAT partition"}), 400
+        data = os_blob_read_file(paths["blob"], idx, part, want, 1024 * 1024)
+        if data is None:
+            return jsonify({"ok": False, "error": f"{want}: no such file"}), 404
+        out["file"] = {"partition": num, "path": want, "size_bytes": len(data), "text": data.decode("utf-8", "replace")}
+    out["elapsed_ms"] = round((time.time() - t0) * 1000, 1)
+    return jsonify(out)
+
+@app.get("/api/custom_profiles")
+def api_custom_profiles():
+    # secrets stay on the box: the psk and password hash are only reported as set / not set
+    out = {}
+    for name, p in custom_profiles().items():
+        p = json.loads(json.dumps(p))
+        if (p.get("wifi") or {}).get("psk"):
+            p["wifi"]["psk"] = "***"
+        if (p.get("user") or {}).get("password_hash"):
+            p["user"]["password_hash"] = "***"
+        out[name] = p
+    return jsonify({"ok": True, "profiles": out})
+
+@app.post("/api/custom_profiles")
+def api_custom_profiles_save():
+    body = request.get_json(force=True, silent=True) or {}
+    name = str(body.get("name", "")).strip()
+    if not re.fullmatch(r"[A-Za-z0-9_.-]{1,64}", name):
+        return jsonify({"ok": False, "error": "name required (letters, digits, '_', '.', '-')"}), 400
+    p = {k: body[k] for k in ("hostname", "user", "ssh", "wifi", "timezone", "keymap", "boot_path") if body.get(k)}
+    err = custom_profile_check(p)
+    if err:
+        return jsonify({"ok": False, "error": err}), 400
+    profiles = custom_profiles()
+    profiles[name] = {**p, "updated_at": time.time()}
+    os_meta_save(custom_profiles_path(), profiles)
+    return jsonify({"ok": True, "name": name})
+
+@app.post("/api/custom_profiles/delete")
+def api_custom_profiles_delete():
+    # customized images already built for it stay cached until evicted with their blob
+    name = str((request.get_json(force=True, silent=True) or {}).get("name", "")).strip()
+    profiles = custom_profiles()
+    if profiles.pop(name, None) is None:
+        return jsonify({"ok": False, "error": "Unknown profile"}), 404
+    os_meta_save(custom_profiles_path(), profiles)
+    return jsonify({"ok": True})
+
+@app.post("/api/os_custom")
+def api_os_custom():
+    """Build (or report) the customized image for {os_id, profile} ahead of flashing."""
+    body = request.get_json(force=True, silent=True) or {}
+    os_item = find_os(str(body.get("os_id", "")).strip(), load_os_catalog())
+    if not os_item:
+        return jsonify({"ok": False, "error": "Unknown os_id"}), 404
+    paths = os_cache_paths(os_item["id"], os_item["url"], os_item.get("image_download_sha256"))
+    c = custom_prepare(os_item, paths, str(body.get("profile", "")).strip())
+    if c.get("error"):
+        return jsonify({"ok": False, **c}), c["status"]
+    return jsonify({"ok": True, **c})
+
+@app.get("/api/os_cache/usage")
+def api_os_cache_usage():
+    return jsonify({"ok": True, **os_cache_usage()})
+
+@app.get("/api/blobs/<sha256>")
+def api_blob(sha256: str):
+    # LAN peer cache: other units fetch blobs by hash (Range + ETag handled by send_file)
+    sha = norm_sha256(sha256)
+    if not sha or sha != sha256:
+        return jsonify({"ok": False, "error": "invalid sha256"}), 400
+    path = os_blob_path(sha)
+    if not os.path.exists(path):
+        return jsonify({"ok": False, "error": "blob not cached"}), 404
+    if request.method == "GET" and not request.headers.get("Range"):
+        os_blob_touch(sha, "peer")
+    return send_file(path, mimetype="application/octet-stream", conditional=True, etag=sha, max_age=0)
 
 @app.post("/api/download_os")
 def api_download_os():
@@ -1010,68 +3564,15 @@ def api_download_os():
     if not os_item:
         return jsonify({"ok": False, "error": "Unknown os_id. Refresh OS list and try again."}), 400
 
-    url = os_item["url"]
-    expect = os_item.get("image_download_sha256") or ""
-    paths = os_cache_paths(os_id, url)
-
-    # If already cached, return cache info
-    if os.path.exists(paths["bin"]) and os.path.exists(paths["meta"]):
-        return jsonify({"ok": True, "cached": True, "paths": paths})
-
-    # Write meta stub now (job will fill in actual sha/size)
-    meta = {
-        "os_id": os_id,
-        "name": os_item.get("name"),
-        "provider": os_item.get("provider_label"),
-        "url": url,
-        "expected_sha256": expect,
-        "created_at": time.time(),
-        "path": paths["bin"],
-    }
-    with open(paths["meta"], "w", encoding="utf-8") as f:
-        json.dump(meta, f)
-
-    script = f"""
-echo "Downloading: {shlex_quote(url)}"
-OUT={shlex_quote(paths["bin"])}
-TMP="$OUT.tmp"
-META={shlex_quote(paths["meta"])}
-EXPECT={shlex_quote(expect)}
-
-mkdir -p {shlex_quote(os_cache_dir())}
-
-curl -L --fail --retry 3 --retry-delay 2 -o "$TMP" {shlex_quote(url)}
-SHA=$(sha256sum "$TMP" | awk '{{print $1}}')
-SIZE=$(stat -c %s "$TMP" || wc -c < "$TMP")
-
-if [ -n "$EXPECT" ] && [ "$SHA" != "$EXPECT" ]; then
-  echo "SHA256 MISMATCH"
-  echo "expected=$EXPECT"
-  echo "actual=$SHA"
-  exit 2
-fi
-
-mv "$TMP" "$OUT"
-
-python3 - <<'PY2'
-import json, os, time
-meta_path = os.environ.get("JR_META")
-sha = os.environ.get("JR_SHA")
-size = int(os.environ.get("JR_SIZE") or "0")
-with open(meta_path, "r", encoding="utf-8") as f:
-    m = json.load(f)
-m["downloaded_at"] = time.time()
-m["sha256_actual"] = sha
-m["size_bytes"] = size
-with open(meta_path, "w", encoding="utf-8") as f:
-    json.dump(m, f)
-print("META_UPDATED")
-PY2
-"""
-    # inject env vars for python meta updater using bash exports
-    script = script.replace("python3 - <<'PY2'", 'export JR_META="$META"\nexport JR_SHA="$SHA"\nexport JR_SIZE="$SIZE"\npython3 - <<\'PY2\'')
-
-    job = start_job("download_os", script, {"os_id": os_id, "url": url, "out": paths["bin"]})
+    res = start_download_job(os_item)
+    if res["cached"]:
+        return jsonify({"ok": True, "cached": True, "paths": res["paths"]})
+    if res.get("rejected"):
+        code = 409 if res.get("existing") else 507
+        return jsonify({"ok": False, "error": res["rejected"], "room": res["room"], "eviction": res["eviction"]}), code
+    job = res["job"]
+    return jsonify({"ok": True, "cached": False, "job_id": job["id"], "job": job, "paths": res["paths"],
+                    "eviction": res["eviction"], "existing": bool(res.get("existing"))})
 
 @app.get("/api/qr")
 def api_qr():
@@ -1092,3 +3593,104 @@ def index():
 @app.get("/assets/<path:p>")
 def assets(p):
     return send_from_directory(app.static_folder, p)
+
+# ---------------- CLI (called back from job scripts) ----------------
+
+def cli_main(argv: list[str]) -> int:
+    import argparse
+    ap = argparse.ArgumentParser(prog="app.py", description="jr-golden-sd maintenance commands")
+    sub = ap.add_subparsers(dest="cmd", required=True)
+    p = sub.add_parser("os-variant", help="start a variant job for a cached blob if policy wants one")
+    p.add_argument("blob")
+    p.add_argument("--url", default="")
+    p = sub.add_parser("telemetry", help="sample thermal/throttle state for a job (and pace it if low priority)")
+    p.add_argument("job_id")
+    p.add_argument("--pid", type=int, required=True)
+    p.add_argument("--type", default="")
+    p = sub.add_parser("customize-image", help="write a rendered profile into a raw image's boot partition (os_custom jobs)")
+    p.add_argument("image")
+    p.add_argument("render")
+    p = sub.add_parser("download-admit", help="reserve cache room for a download job whose wait is over (prefetch)")
+    p.add_argument("job_id")
+    p = sub.add_parser("os-index", help="build a blob's random-access index and inspection (download jobs)")
+    p.add_argument("blob")
+    p = sub.add_parser("engine-absorb", help="record a finished engine run in its job (flash jobs, on exit)")
+    p.add_argument("job_id")
+    p = sub.add_parser("blob-verified", help="record that a blob just hashed to its name (download jobs)")
+    p.add_argument("blob")
+    p = sub.add_parser("scrub", help="rehash blobs whose verification is due (--start: as a background job)")
+    p.add_argument("--rate-mbps", type=float, default=0)
+    p.add_argument("--start", action="store_true")
+    p.add_argument("--blob", default="", help="just this blob")
+    p = sub.add_parser("cache-tier", help="start a cache_tier job if blobs should move between tiers (--apply: do it)")
+    p.add_argument("--apply", action="store_true")
+    p = sub.add_parser("bus-wait", help="block a flash job until its targets' buses have room (policy.bus.max_per_bus)")
+    p.add_argument("job_id")
+    sub.add_parser("thermal", help="print one thermal/throttle sample as JSON")
+    p = sub.add_parser("sink", help="copy stdin to a file without filling the page cache; prints its sha256")
+    p.add_argument("out")
+    p.add_argument("--prealloc", type=int, default=0, help="fallocate this many bytes first")
+    args = ap.parse_args(argv)
+
+    if args.cmd == "telemetry":
+        return job_telemetry_loop(args.job_id, args.pid, args.type)
+
+    if args.cmd == "customize-image":
+        print(json.dumps(custom_apply(args.image, args.render)))
+        return 0
+
+    if args.cmd == "download-admit":
+        return download_admit(args.job_id)
+
+    if args.cmd == "os-index":
+        idx = os_blob_index(args.blob, build=True)
+        print(json.dumps({k: idx.get(k) for k in ("format", "seekable", "build_s")} | {"units": len(idx["units"])}))
+        return 0
+
+    if args.cmd == "engine-absorb":
+        job = job_load(args.job_id)
+        engine = job_engine_status(job) if job else None
+        if engine is not None:
+            job_absorb_engine(job, engine)
+        return 0
+
+    if args.cmd == "blob-verified":
+        os_blob_memo_record(args.blob, args.blob, "download")
+        return 0
+
+    if args.cmd == "scrub":
+        if args.start:
+            job = maybe_start_scrub_job()
+            print(json.dumps({"started": bool(job), "job_id": job["id"] if job else None}))
+            return 0
+        if args.blob and not norm_sha256(args.blob):
+            print(f"not a sha256: {args.blob}", file=sys.stderr)
+            return 2
+        return scrub_run(args.rate_mbps, norm_sha256(args.blob))
+
+    if args.cmd == "cache-tier":
+        if args.apply:
+            return cache_tier_apply()
+        job = maybe_start_tier_job()
+        print(json.dumps({"started": bool(job), "job_id": job["id"] if job else None}))
+        return 0
+
+    if args.cmd == "bus-wait":
+        return bus_wait(args.job_id)
+
+    if args.cmd == "thermal":
+        print(json.dumps(thermal_state()))
+        return 0
+
+    if args.cmd == "sink":
+        sha, _ = flash_engine.sink_stream(sys.stdin.buffer, args.out, args.prealloc)
+        print(sha)
+        return 0
+
+    if args.cmd == "os-variant":
+        job = maybe_start_variant_job(args.blob, args.url)
+        print(json.dumps({"started": bool(job), "job_id": job["id"] if job else None}))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(cli_main(sys.argv[1:]))
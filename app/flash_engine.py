@@ -0,0 +1,1559 @@
+#!/usr/bin/env python3
+"""
+Native flash engine for jr-golden-sd flash jobs (stdlib only).
+
+Runs inside a supervised flash job, usually as root via the job's bash script:
+
+    python3 app/flash_engine.py --source IMG --format xz --target /dev/nvme0n1 --status JOB.engine.json
+
+Pipeline:
+  decoder thread  -> reads the decompressor's stdout into a ring of page-aligned buffers
+  writer threads  -> queue_depth concurrent pwrite()s at their own offsets (O_DIRECT when possible)
+  sync thread     -> fdatasync every sync_mb so the device cache never has to flush GBs at the end
+
+--target may be repeated (fan-out): the image is decoded once and every buffer is queued to each
+target's own writers. Targets fail independently (I/O error, verify mismatch, or no progress for
+--stall-timeout seconds while the ring is exhausted) without stopping the others. A buffer goes back
+to the ring only once every target has written it, so the whole fan-out runs at the pace of its
+slowest target that still makes progress; such a target is never dropped for being slow.
+
+The decompressed stream is SHA-256'd as it passes (--expect-sha256); a mismatch fails the run.
+--verify sample|full then reads the target back with O_DIRECT and compares per-buffer hashes.
+
+--delta reads each chunk back from the target first and writes only the chunks that differ, switching
+to plain writes once more than --delta-max-ratio of the data compared has changed.
+
+--checkpoint records, at every durable sync of a single-target run, how far the target is safely written
+and the SHA-256 of the image up to there. --resume re-decodes from the start (compressed streams can't be
+entered mid-way), checks that prefix hash, re-reads the last --resume-verify-mb before the checkpoint
+(rewriting anything that differs) and only writes from there on. The checkpoint is removed on success.
+
+--trim auto uses the device's own discard / write-zeroes support (sysfs queue limits): the image area is
+discarded before writing, and all-zero chunks and block-map holes are zeroed with BLKZEROOUT instead of
+being written from the host. It is skipped for delta and resumed runs, which rely on existing contents.
+
+Each target pwrite()s in --write-size pieces with up to --queue-depth writes in flight. --tune spends
+the first seconds trying a few sizes and depths on targets without a --profile and keeps the fastest;
+the app stores the result per device model/transport and passes it back as --profile next time.
+
+With a block map (--bmap, bmaptool XML) only mapped ranges are written; without one, --bmap-out
+records the non-zero 4 KiB blocks of the stream. Holes in such a generated map are zeros the image needs
+(FAT tables, directories, partition gaps), so the next flash has the device zero them (BLKZEROOUT) and
+writes them where it can't; only a publisher's map may leave its holes untouched.
+
+--source - streams the image from stdin (e.g. curl | flash_engine.py): the format is sniffed from the
+first bytes, --expect-source-sha256 hashes the compressed bytes as they pass, and --invalidate-on-fail
+zeroes the first and last MiB of the targets when the stream turns out bad (decode error, hash or size
+mismatch), so a half-written or unverified image can't boot.
+
+Page cache: the engine reads the source itself and pipes it into the decoder, dropping consumed ranges
+(posix_fadvise DONTNEED) as it goes; buffered (non-O_DIRECT) targets get sync_file_range() writeback per
+piece and are dropped after each sync. A multi-GB flash then doesn't push the web UI out of RAM.
+sink_stream() does the same for downloads (app.py sink).
+
+Progress and the final result are written as JSON to --status; /api/job merges it into the job record.
+"""
+import argparse, bisect, ctypes, errno, fcntl, hashlib, json, mmap, os, queue, random, shutil, stat, struct, subprocess, sys, threading, time
+from concurrent.futures import ThreadPoolExecutor
+
+ALIGN = 4096
+MIB = 1024 * 1024
+DELTA_PROBE = 64 * MIB   # compare at least this much before judging whether delta mode pays off
+
+BLKGETSIZE64 = 0x80081272
+BLKFLSBUF = 0x1261
+BLKDISCARD = 0x1277
+BLKZEROOUT = 0x127f
+SYSFS = os.environ.get("JR_SYSFS_ROOT") or "/sys"
+
+# --tune: write sizes and queue depths tried for TUNE_TRIAL_S each (the current setting first; a later
+# candidate has to beat the best so far by TUNE_MARGIN to be chosen, so ties keep the defaults)
+TUNE_SIZES = (256 * 1024, 1 * MIB, 4 * MIB, 8 * MIB)
+TUNE_DEPTHS = (1, 2, 4, 8)
+TUNE_TRIAL_S = 1.5
+TUNE_MARGIN = 1.05
+RANGE_STEP = 1024 * MIB   # split discard / zero-out ioctls so progress and stall checks keep moving
+
+# Container magic -> format. Anything else is treated as a raw image.
+MAGIC = [
+    (b"\xfd7zXZ\x00", "xz"),
+    (b"\x28\xb5\x2f\xfd", "zstd"),
+    (b"\x1f\x8b", "gzip"),
+    (b"PK\x03\x04", "zip"),
+    (b"BZh", "bzip2"),
+]
+FORMATS = ["xz", "zstd", "gzip", "zip", "bzip2", "raw"]
+
+# Preferred decoder per format, best first. "{n}" is replaced by the thread count.
+#   xz    >= 5.4 decodes multi-block streams in parallel with -T (older xz ignores it)
+#   gzip  pigz overlaps inflate with read, write and CRC on separate threads
+#   bzip2 lbzip2/pbzip2 decode blocks in parallel
+#   zstd  decode is single-threaded by design but already runs at several hundred MB/s
+DECODERS = {
+    "xz": [["xz", "-dc", "-T{n}"]],
+    "zstd": [["zstd", "-dc", "-q"]],
+    "gzip": [["pigz", "-dc", "-p", "{n}"], ["gzip", "-dc"]],
+    "zip": [["unzip", "-p"]],
+    "bzip2": [["lbzip2", "-dc", "-n", "{n}"], ["pbzip2", "-dc", "-p{n}"], ["bzip2", "-dc"]],
+    "raw": [["cat"]],
+}
+
+
+def align_up(n: int, a: int = ALIGN) -> int:
+    return (n + a - 1) // a * a
+
+
+def log(msg: str):
+    print(msg, flush=True)
+
+
+def sniff_format(path: str) -> str:
+    """Image container format from its first bytes (not the URL suffix)."""
+    try:
+        with open(path, "rb") as f:
+            head = f.read(8)
+    except OSError:
+        return "raw"
+    return sniff_bytes(head)
+
+
+def sniff_bytes(head: bytes) -> str:
+    for magic, fmt in MAGIC:
+        if head.startswith(magic):
+            return fmt
+    return "raw"
+
+
+def decoder_argv(fmt: str, threads: int = 0) -> list[str]:
+    """First installed decoder for fmt; falls back to the last (baseline) tool."""
+    n = str(threads or os.cpu_count() or 1)
+    choices = DECODERS.get(fmt) or DECODERS["raw"]
+    pick = choices[-1]
+    for argv in choices:
+        if shutil.which(argv[0]):
+            pick = argv
+            break
+    return [x.replace("{n}", n) for x in pick]
+
+
+class StatusFile:
+    def __init__(self, path: str):
+        self.path = path
+
+    def write(self, obj: dict):
+        if not self.path:
+            return
+        tmp = self.path + ".tmp"
+        try:
+            with open(tmp, "w", encoding="utf-8") as f:
+                json.dump(obj, f)
+            os.chmod(tmp, 0o644)
+            os.replace(tmp, self.path)
+        except OSError:
+            pass
+
+
+class Ring:
+    """Fixed pool of page-aligned buffers handed from the decoder to every target's writers."""
+
+    def __init__(self, count: int, size: int):
+        self.size = size
+        self.bufs = [mmap.mmap(-1, size) for _ in range(count)]
+        self.free = queue.Queue()
+        for i in range(count):
+            self.free.put(i)
+
+
+class Progress:
+    """Byte counters plus the contiguous written prefix (writers complete out of order)."""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.written = 0
+        self.skipped = 0
+        self.contiguous = 0
+        self.durable = 0
+        self.syncs = 0
+        self._ends = {}
+
+    def complete(self, offset: int, length: int, skipped: int = 0):
+        with self.lock:
+            self.written += length
+            self.skipped += skipped
+            self._ends[offset] = offset + length
+            while self.contiguous in self._ends:
+                self.contiguous = self._ends.pop(self.contiguous)
+
+
+SYNC_FILE_RANGE_WAIT_BEFORE = 1
+SYNC_FILE_RANGE_WRITE = 2
+SYNC_FILE_RANGE_WAIT_AFTER = 4
+DROP_STEP = 32 * MIB   # page-cache window kept for streamed files before it is written back and dropped
+_libc = None
+
+
+def libc():
+    global _libc
+    if _libc is None:
+        try:
+            _libc = ctypes.CDLL(None, use_errno=True)
+            _libc.sync_file_range.argtypes = [ctypes.c_int, ctypes.c_int64, ctypes.c_int64, ctypes.c_uint]
+            _libc.fallocate.argtypes = [ctypes.c_int, ctypes.c_int, ctypes.c_int64, ctypes.c_int64]
+        except (OSError, AttributeError):
+            _libc = False
+    return _libc
+
+
+def sync_range(fd: int, offset: int, length: int, flags: int = SYNC_FILE_RANGE_WRITE) -> bool:
+    """sync_file_range(2) through libc (Linux); False when unavailable so callers can fall back."""
+    if not libc():
+        return False
+    return libc().sync_file_range(fd, offset, length, flags) == 0
+
+
+def preallocate(fd: int, length: int) -> bool:
+    """
+    fallocate(2): reserve length bytes as (mostly contiguous) unwritten extents. Unlike posix_fallocate
+    there is no zero-writing fallback, so filesystems without support just return False.
+    """
+    if not libc() or length <= 0:
+        return False
+    return libc().fallocate(fd, 0, 0, length) == 0
+
+
+def drop_cache(fd: int, offset: int = 0, length: int = 0):
+    try:
+        os.posix_fadvise(fd, offset, length, os.POSIX_FADV_DONTNEED)
+    except (OSError, AttributeError):
+        pass
+
+
+def sink_stream(src, path: str, prealloc: int = 0) -> tuple[str, int]:
+    """
+    Copy src (a binary file object, e.g. stdin) to path with bounded dirty data: each DROP_STEP window
+    is queued for writeback, the one before it waited on and dropped from the page cache.
+    prealloc reserves that many bytes up front (fallocate) and is trimmed to the real size at the end.
+    Returns (sha256, size) of the bytes written.
+    """
+    h = hashlib.sha256()
+    size = 0
+    flushed = 0
+    buf = bytearray(MIB)
+    mv = memoryview(buf)
+    fd = os.open(path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC | getattr(os, "O_CLOEXEC", 0), 0o644)
+    try:
+        if prealloc and not preallocate(fd, prealloc) and ctypes.get_errno() == errno.ENOSPC:
+            raise OSError(errno.ENOSPC, f"can't reserve {prealloc} bytes", path)
+        while True:
+            n = src.readinto(buf)
+            if not n:
+                break
+            h.update(mv[:n])
+            done = 0
+            while done < n:
+                done += os.write(fd, mv[done:n])
+            size += n
+            if size - flushed >= DROP_STEP:
+                sync_range(fd, flushed, size - flushed, SYNC_FILE_RANGE_WRITE)
+                if flushed >= DROP_STEP:
+                    prev = flushed - DROP_STEP
+                    sync_range(fd, prev, DROP_STEP, SYNC_FILE_RANGE_WAIT_BEFORE | SYNC_FILE_RANGE_WRITE | SYNC_FILE_RANGE_WAIT_AFTER)
+                    drop_cache(fd, prev, DROP_STEP)
+                flushed = size
+        if prealloc:
+            os.ftruncate(fd, size)   # drop the reserved tail the stream didn't fill
+        os.fsync(fd)
+        drop_cache(fd)
+    finally:
+        os.close(fd)
+    return h.hexdigest(), size
+
+
+def read_full(f, mv: memoryview) -> int:
+    got = 0
+    while got < len(mv):
+        n = f.readinto(mv[got:])
+        if not n:
+            break
+        got += n
+    return got
+
+
+def merge_ranges(ranges: list) -> list:
+    out = []
+    for a, b in sorted(ranges):
+        if out and a <= out[-1][1]:
+            out[-1] = (out[-1][0], max(out[-1][1], b))
+        else:
+            out.append((a, b))
+    return out
+
+
+class BlockMap:
+    """
+    Mapped byte ranges of an image (bmaptool XML), widened to ALIGN for O_DIRECT. A publisher's map
+    means its holes don't matter; one this engine generated (--bmap-out) only says they are zero.
+    """
+
+    GENERATED = "generated by jr-golden-sd flash_engine.py"
+
+    def __init__(self, image_size: int, ranges: list, generated: bool = False):
+        self.image_size = image_size
+        self.ranges = merge_ranges(ranges)
+        self.starts = [a for a, _ in self.ranges]
+        self.generated = generated
+
+    @property
+    def mapped_bytes(self) -> int:
+        return sum(b - a for a, b in self.ranges)
+
+    @classmethod
+    def load(cls, path: str) -> "BlockMap":
+        import xml.etree.ElementTree as ET
+        with open(path, "r", encoding="utf-8") as f:
+            text = f.read()
+        root = ET.fromstring(text)
+        size = int((root.findtext("ImageSize") or "0").strip())
+        bs = int((root.findtext("BlockSize") or "0").strip())
+        if size <= 0 or bs <= 0:
+            raise ValueError("bmap without ImageSize/BlockSize")
+        ranges = []
+        for r in root.iter("Range"):
+            first, _, last = (r.text or "").strip().partition("-")
+            a, b = int(first) * bs, (int(last or first) + 1) * bs
+            ranges.append(((a // ALIGN) * ALIGN, min(align_up(b), size)))
+        return cls(size, ranges, cls.GENERATED in text)
+
+    def save(self, path: str, block: int = ALIGN):
+        blocks = (self.image_size + block - 1) // block
+        mapped = sum((b - a + block - 1) // block for a, b in self.ranges)
+        lines = [
+            '<?xml version="1.0" ?>',
+            f"<!-- {self.GENERATED} (all-zero blocks unmapped) -->",
+            '<bmap version="2.0">',
+            f"    <ImageSize> {self.image_size} </ImageSize>",
+            f"    <BlockSize> {block} </BlockSize>",
+            f"    <BlocksCount> {blocks} </BlocksCount>",
+            f"    <MappedBlocksCount> {mapped} </MappedBlocksCount>",
+            "    <BlockMap>",
+        ]
+        for a, b in self.ranges:
+            first, last = a // block, (b - 1) // block
+            lines.append(f"        <Range> {first}-{last} </Range>" if last > first else f"        <Range> {first} </Range>")
+        lines += ["    </BlockMap>", "</bmap>", ""]
+        tmp = path + ".tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            f.write("\n".join(lines))
+        os.chmod(tmp, 0o644)
+        os.replace(tmp, path)
+
+    def pieces(self, offset: int, n: int) -> list:
+        """Sub-ranges of [offset, offset+n) that are mapped."""
+        end = offset + n
+        out = []
+        i = max(0, bisect.bisect_right(self.starts, offset) - 1)
+        while i < len(self.ranges) and self.ranges[i][0] < end:
+            a, b = self.ranges[i]
+            a, b = max(a, offset), min(b, end)
+            if a < b:
+                out.append((a, b - a))
+            i += 1
+        return out
+
+    def split(self, offset: int, n: int) -> list:
+        """All of [offset, offset+n), cut at the map's boundaries: mapped pieces and the holes between them."""
+        out, pos = [], offset
+        for a, length in self.pieces(offset, n) + [(offset + n, 0)]:
+            if a > pos:
+                out.append((pos, a - pos))
+            if length:
+                out.append((a, length))
+            pos = a + length
+        return out
+
+
+ZERO_BLOCK = bytes(ALIGN)
+
+
+def chunk_hash(buf, rel_pieces: list) -> bytes:
+    """Hash of the given (relative offset, length) pieces of buf; used to check read-back."""
+    h = hashlib.blake2b(digest_size=16)
+    mv = memoryview(buf)
+    for rel, length in rel_pieces:
+        h.update(mv[rel:rel + length])
+    mv.release()
+    return h.digest()
+
+
+def nonzero_ranges(buf, n: int, offset: int) -> list:
+    """Byte ranges (absolute) of the non-zero ALIGN blocks in buf[:n]."""
+    mv = memoryview(buf)
+    out = []
+    start = None
+    for pos in range(0, n, ALIGN):
+        blk = mv[pos:min(pos + ALIGN, n)]
+        zero = blk == ZERO_BLOCK[:len(blk)]
+        if not zero and start is None:
+            start = pos
+        elif zero and start is not None:
+            out.append((offset + start, offset + pos))
+            start = None
+    if start is not None:
+        out.append((offset + start, offset + n))
+    mv.release()
+    return out
+
+
+def device_size(fd: int) -> int:
+    st = os.fstat(fd)
+    if stat.S_ISBLK(st.st_mode):
+        buf = fcntl.ioctl(fd, BLKGETSIZE64, b"\0" * 8)
+        return struct.unpack("Q", buf)[0]
+    return 0
+
+
+def queue_limits(fd: int) -> dict:
+    """discard_max_bytes / write_zeroes_max_bytes of a block device's request queue (empty for files)."""
+    st = os.fstat(fd)
+    if not stat.S_ISBLK(st.st_mode):
+        return {}
+    d = os.path.join(SYSFS, "dev", "block", f"{os.major(st.st_rdev)}:{os.minor(st.st_rdev)}")
+    if os.path.exists(os.path.join(d, "partition")):
+        d = os.path.join(os.path.realpath(d), "..")
+    out = {}
+    for k in ("discard_max_bytes", "discard_granularity", "write_zeroes_max_bytes", "logical_block_size"):
+        try:
+            with open(os.path.join(d, "queue", k), "r", encoding="utf-8") as f:
+                out[k] = int(f.read().strip() or 0)
+        except (OSError, ValueError):
+            out[k] = 0
+    return out
+
+
+def range_ioctl(fd: int, req: int, start: int, length: int, max_bytes: int = 0):
+    """BLKDISCARD / BLKZEROOUT over [start, start+length), in steps the kernel and our monitor can digest."""
+    step = min(RANGE_STEP, max_bytes) if max_bytes else RANGE_STEP
+    end = start + length
+    while start < end:
+        n = min(step, end - start)
+        fcntl.ioctl(fd, req, struct.pack("QQ", start, n))
+        start += n
+
+
+def open_target(path: str, direct: bool, allow_file: bool, readable: bool = False) -> tuple[int, bool]:
+    st = os.stat(path)
+    if not stat.S_ISBLK(st.st_mode) and not allow_file:
+        raise RuntimeError(f"target is not a block device: {path}")
+    flags = (os.O_RDWR if readable else os.O_WRONLY) | getattr(os, "O_CLOEXEC", 0)
+    if direct and hasattr(os, "O_DIRECT"):
+        try:
+            return os.open(path, flags | os.O_DIRECT), True
+        except OSError:
+            log("O_DIRECT not supported on target; falling back to buffered writes")
+    return os.open(path, flags), False
+
+
+class Target:
+    """One destination device: its own writers, progress, sync cadence, verification and failure state."""
+
+    def __init__(self, engine: "Engine", path: str):
+        self.engine = engine
+        self.path = path
+        self.fd = -1
+        self.direct = False
+        self.queue = queue.Queue()
+        self.progress = Progress()
+        self.errors = []
+        self.failed = threading.Event()
+        self.phase = "starting"
+        self.started = time.time()
+        self.last_progress = time.monotonic()
+        self.readback = None
+        self.threads = []
+        self.local = threading.local()
+        eng = engine
+        self.write_size = eng.block
+        self.active_depth = eng.depth
+        prof = eng.profiles.get(path)
+        if prof:
+            self.write_size = min(eng.block, max(ALIGN, align_up(prof[0])))
+            self.active_depth = max(1, prof[1])
+        elif engine.args.write_size:
+            self.write_size = min(eng.block, max(ALIGN, align_up(int(engine.args.write_size))))
+        self.tune = {"mode": "profile" if prof else ("trial" if engine.args.tune else "fixed"), "trials": []}
+        self.max_depth = max(self.active_depth, max(TUNE_DEPTHS) if self.tune["mode"] == "trial" else 0)
+        self.gate = threading.Condition()
+        self.inflight = 0
+        self.limits = {}
+        self.trim = None
+        self.pwrite_s = 0.0
+        self.delta = None
+        if engine.args.delta:
+            self.delta = {"active": True, "bytes_compared": 0, "bytes_unchanged": 0, "bytes_changed": 0,
+                          "read_s": 0.0, "fallback": None}
+
+    def fail(self, where: str, e):
+        if not self.failed.is_set():
+            self.errors.append(f"{where}: {e}")
+        self.failed.set()
+        self.phase = "failed"
+        # hand back buffers still queued for this target; writers stuck in pwrite keep theirs
+        while True:
+            try:
+                item = self.queue.get_nowait()
+            except queue.Empty:
+                return
+            if item is None:
+                self.queue.put(None)
+                return
+            self.engine.release(item[0])
+
+    @property
+    def ok(self) -> bool:
+        return not self.failed.is_set()
+
+    def open(self):
+        a = self.engine.args
+        try:
+            self.fd, self.direct = open_target(self.path, a.direct, a.allow_file, readable=bool(self.delta or a.resume))
+            cap = device_size(self.fd)
+            if cap and a.expect_size and int(a.expect_size) > cap:
+                raise RuntimeError(f"image ({a.expect_size} bytes) is larger than target ({cap} bytes)")
+            self.limits = queue_limits(self.fd)
+        except Exception as e:
+            self.fail("open", e)
+
+    def prepare(self):
+        """
+        Before any write: decide on discard / write-zeroes offload and run the discard pass.
+        Not for delta or resumed runs, whose point is to keep what is already on the target.
+        """
+        eng = self.engine
+        a = eng.args
+        if a.trim == "off" or self.delta or eng.resume_at or not self.limits:
+            return
+        self.trim = {
+            "discard_supported": self.limits["discard_max_bytes"] > 0,
+            "zeroout_supported": self.limits["write_zeroes_max_bytes"] > 0,
+            "discard_bytes": 0, "discard_s": 0.0,
+            "zeroed_bytes": 0, "zeroout_s": 0.0, "saved_s": None,
+            "note": None,
+        }
+        size = int(a.expect_size or 0)
+        if not self.trim["discard_supported"]:
+            return
+        if not size:
+            self.trim["note"] = "no discard: image size unknown"
+            return
+        gran = max(self.limits["discard_granularity"], self.limits["logical_block_size"], 512)
+        length = min(align_up(size, gran), device_size(self.fd) or align_up(size, gran))
+        t0 = time.monotonic()
+        try:
+            range_ioctl(self.fd, BLKDISCARD, 0, length, self.limits["discard_max_bytes"])
+            self.trim["discard_bytes"] = length
+        except OSError as e:
+            self.trim["note"] = f"discard failed: {e}"
+        self.trim["discard_s"] = round(time.monotonic() - t0, 2)
+        self.last_progress = time.monotonic()
+        log(f"engine: {self.path}: discarded {self.trim['discard_bytes'] // MIB} MiB in {self.trim['discard_s']}s")
+
+    def zero_out(self, start: int, length: int) -> bool:
+        """Let the device zero [start, start+length) (BLKZEROOUT). False when the caller must write instead."""
+        t = self.trim
+        lbs = max(self.limits.get("logical_block_size") or 0, 512)
+        if not t or not t["zeroout_supported"] or start % lbs or length % lbs:
+            return False
+        t0 = time.monotonic()
+        try:
+            range_ioctl(self.fd, BLKZEROOUT, start, length, self.limits["write_zeroes_max_bytes"])
+        except OSError as e:
+            t["zeroout_supported"] = False
+            t["note"] = f"zero-out disabled: {e}"
+            return False
+        with self.progress.lock:
+            t["zeroed_bytes"] += length
+            t["zeroout_s"] += time.monotonic() - t0
+        return True
+
+    def start(self):
+        self.phase = "writing"
+        self.threads = [threading.Thread(target=self.writer, name=f"write:{self.path}:{i}", daemon=True)
+                        for i in range(self.max_depth)]
+        self.threads.append(threading.Thread(target=self.syncer, name=f"sync:{self.path}", daemon=True))
+        if self.tune["mode"] == "trial" and not self.delta and not self.engine.resume_at:
+            self.threads.append(threading.Thread(target=self.tuner, name=f"tune:{self.path}", daemon=True))
+        elif self.tune["mode"] == "trial":
+            self.tune["mode"] = "fixed"   # delta / resume writes say nothing about the device
+        for t in self.threads:
+            t.start()
+
+    def writer(self):
+        eng = self.engine
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            idx, offset, n = item
+            with self.gate:
+                while self.inflight >= self.active_depth and self.ok:
+                    self.gate.wait(0.5)
+                self.inflight += 1
+            try:
+                if self.ok:
+                    buf = eng.ring.bufs[idx]
+                    if not eng.bmap:
+                        pieces = [(offset, n)]
+                    elif eng.bmap.generated:
+                        # our own map's holes are zeros the image needs: zeroed by the device below, else written
+                        pieces = eng.bmap.split(offset, n)
+                    else:
+                        pieces = eng.bmap.pieces(offset, n)
+                    written = 0
+                    resumed = eng.resume_at and offset + n <= eng.resume_at
+                    for start, length in pieces:
+                        if resumed and not self.resume_check(buf, start - offset, start, length):
+                            continue
+                        if not resumed and self.delta and self.delta["active"] and self.unchanged(buf, start - offset, start, length):
+                            continue
+                        if (self.trim and self.trim["zeroout_supported"]
+                                and buf[start - offset:start - offset + length] == eng.zeros[:length]
+                                and self.zero_out(start, length)):
+                            continue
+                        self.write_piece(buf, offset, start - offset, length)
+                        written += length
+                    if self.trim and eng.bmap and not eng.bmap.generated:
+                        # publisher map holes don't matter; still have the device zero them when it can
+                        pos = offset
+                        for start, length in pieces + [(offset + n, 0)]:
+                            if start > pos:
+                                self.zero_out(pos, start - pos)
+                            pos = start + length
+                    eng.note_chunk(buf, offset, pieces)
+                    self.progress.complete(offset, n, n - written)
+                    self.last_progress = time.monotonic()
+            except Exception as e:
+                self.fail("write", e)
+            finally:
+                with self.gate:
+                    self.inflight -= 1
+                    self.gate.notify_all()
+                eng.release(idx)
+
+    def matches(self, buf, rel: int, start: int, length: int) -> bool:
+        """Read [start, start+length) from the target and compare it with buf[rel:rel+length]."""
+        if not hasattr(self.local, "buf"):
+            self.local.buf = mmap.mmap(-1, self.engine.block + ALIGN)
+        rlen = align_up(length) if self.direct else length
+        mv = memoryview(self.local.buf)[:rlen]
+        got = 0
+        try:
+            while got < rlen:
+                k = os.preadv(self.fd, [mv[got:]], start + got)
+                if not k:
+                    break
+                got += k
+        finally:
+            mv.release()
+        return got >= length and self.local.buf[:length] == buf[rel:rel + length]
+
+    def unchanged(self, buf, rel: int, start: int, length: int) -> bool:
+        """
+        Delta mode: skip the write when the target already holds these bytes.
+        Gives up on comparing (plain writes from then on) once too much of the image turns out to differ.
+        """
+        t0 = time.monotonic()
+        same = self.matches(buf, rel, start, length)
+        d = self.delta
+        with self.progress.lock:
+            d["read_s"] += time.monotonic() - t0
+            d["bytes_compared"] += length
+            d["bytes_unchanged" if same else "bytes_changed"] += length
+            if d["active"] and d["bytes_compared"] >= DELTA_PROBE:
+                ratio = d["bytes_changed"] / d["bytes_compared"]
+                if ratio > self.engine.args.delta_max_ratio:
+                    d["active"] = False
+                    d["fallback"] = f"{ratio:.0%} of the first {d['bytes_compared'] // MIB} MiB differed; writing everything"
+                    log(f"engine: {self.path}: delta: {d['fallback']}")
+        return same
+
+    def resume_check(self, buf, rel: int, start: int, length: int) -> bool:
+        """
+        Below the checkpoint: trust it, except for the last --resume-verify-mb, which is read back.
+        Returns True when the piece has to be (re)written.
+        """
+        eng = self.engine
+        if start + length <= eng.resume_at - eng.resume_tail:
+            return False
+        same = self.matches(buf, rel, start, length)
+        with self.progress.lock:
+            eng.resume["tail_verified"] += length
+            if not same:
+                eng.resume["tail_repaired"] += length
+        return not same
+
+    def write_piece(self, buf, buf_offset: int, rel: int, length: int):
+        """pwrite buf[rel:rel+length] to buf_offset+rel, looping over short writes."""
+        # O_DIRECT needs aligned lengths; padding the image's final partial block would write past the
+        # image end (and into the ring buffer every fan-out target reads), so that tail goes buffered
+        wlen = length - length % ALIGN if self.direct else length
+        mv = memoryview(buf)[rel:rel + length]
+        t0 = time.monotonic()
+        done = 0
+        while done < wlen:
+            done += os.pwrite(self.fd, mv[done:min(wlen, done + self.write_size)], buf_offset + rel + done)
+        if wlen < length:
+            self.write_tail(mv[wlen:], buf_offset + rel + wlen)
+        mv.release()
+        if not self.direct:
+            # start writeback now instead of letting GBs of dirty pages pile up until the next sync
+            sync_range(self.fd, buf_offset + rel, wlen)
+        with self.progress.lock:
+            self.pwrite_s += time.monotonic() - t0
+
+    def write_tail(self, data, offset: int):
+        """The unaligned end of the image on an O_DIRECT target: a buffered write, synced before returning."""
+        fd = os.open(self.path, os.O_WRONLY | getattr(os, "O_CLOEXEC", 0))
+        try:
+            done = 0
+            while done < len(data):
+                done += os.pwrite(fd, data[done:], offset + done)
+            os.fdatasync(fd)
+        finally:
+            os.close(fd)
+
+    def tuner(self):
+        """
+        Try write sizes at the current depth, then depths at the best size, for TUNE_TRIAL_S each while
+        the real image is being written, and keep the fastest. Stops early when the write ends.
+        """
+        eng = self.engine
+
+        def set_params(ws: int, depth: int):
+            with self.gate:
+                self.write_size, self.active_depth = ws, depth
+                self.gate.notify_all()
+
+        def host_bytes() -> int:
+            with self.progress.lock:
+                return self.progress.written - self.progress.skipped
+
+        def trial(ws: int, depth: int) -> float | None:
+            set_params(ws, depth)
+            b0, t0 = host_bytes(), time.monotonic()
+            while self.ok and self.phase == "writing" and time.monotonic() - t0 < TUNE_TRIAL_S:
+                time.sleep(0.05)
+            if not (self.ok and self.phase == "writing"):
+                return None
+            mbps = (host_bytes() - b0) / MIB / (time.monotonic() - t0)
+            self.tune["trials"].append({"write_size": ws, "queue_depth": depth, "mbps": round(mbps, 2)})
+            return mbps
+
+        best = (self.write_size, self.active_depth, 0.0)
+        time.sleep(0.5)   # let the decoder and the device queue fill before measuring
+        sizes = [best[0]] + [w for w in TUNE_SIZES if w <= eng.block and w != best[0]]
+        for ws in sizes:
+            m = trial(ws, best[1])
+            if m is None:
+                break
+            if m > best[2] * TUNE_MARGIN:
+                best = (ws, best[1], m)
+        else:
+            for depth in [d for d in TUNE_DEPTHS if d != best[1]]:
+                m = trial(best[0], depth)
+                if m is None:
+                    break
+                if m > best[2] * TUNE_MARGIN:
+                    best = (best[0], depth, m)
+        set_params(best[0], best[1])
+        self.tune["chosen_mbps"] = round(best[2], 2) if best[2] else None
+        if best[2]:
+            log(f"engine: {self.path}: tuned to {best[0] // 1024} KiB writes x {best[1]} in flight ({best[2]:.1f} MB/s)")
+
+    def syncer(self):
+        last = 0
+        sync_bytes = self.engine.sync_bytes
+        while self.ok and self.phase == "writing":
+            time.sleep(0.05)
+            if not sync_bytes:
+                continue
+            with self.progress.lock:
+                written, contiguous = self.progress.written, self.progress.contiguous
+            if written - last >= sync_bytes:
+                try:
+                    os.fdatasync(self.fd)
+                except OSError as e:
+                    self.fail("sync", e)
+                    return
+                last = written
+                with self.progress.lock:
+                    self.progress.durable = max(self.progress.durable, contiguous)
+                    self.progress.syncs += 1
+                    durable = self.progress.durable
+                self.engine.checkpoint(durable)
+                if not self.direct:
+                    drop_cache(self.fd, 0, durable)
+
+    def join_writers(self):
+        for _ in range(self.max_depth):
+            self.queue.put(None)
+        self.phase = "syncing" if self.ok else self.phase
+        deadline = time.monotonic() + 5
+        for t in self.threads:
+            # a stalled device can leave a writer in uninterruptible pwrite; don't wait on it forever
+            t.join(timeout=None if self.ok else max(0, deadline - time.monotonic()))
+
+    def finish(self):
+        """Final flush; the fd stays open only as long as writes do."""
+        if self.ok and self.fd >= 0:
+            try:
+                os.fdatasync(self.fd)
+                with self.progress.lock:
+                    self.progress.durable = self.progress.contiguous
+                    self.progress.syncs += 1
+                    durable = self.progress.durable
+                self.engine.checkpoint(durable)
+                if not self.direct:
+                    drop_cache(self.fd)
+            except OSError as e:
+                self.fail("sync", e)
+        if self.fd >= 0:
+            os.close(self.fd)
+            self.fd = -1
+
+    def invalidate(self):
+        """Zero the first and last MiB (partition table, boot sector, backup GPT) so a bad image can't boot."""
+        a = self.engine.args
+        fd, _ = open_target(self.path, a.direct, a.allow_file)
+        try:
+            cap = device_size(fd) or os.fstat(fd).st_size
+            zero = mmap.mmap(-1, MIB)   # page-aligned for O_DIRECT
+            for off in sorted({0, max(0, (cap - MIB) // ALIGN * ALIGN)}):
+                os.pwrite(fd, zero, off)
+            os.fdatasync(fd)
+        finally:
+            os.close(fd)
+        log(f"engine: {self.path}: invalidated (first and last MiB zeroed)")
+
+    def verify_readback(self):
+        """
+        Read written chunks back from the media and compare hashes: all of them ("full") or
+        --verify-samples random ones plus the first and last ("sample"). O_DIRECT bypasses the
+        page cache; a dropper thread also keeps flushing the device's buffer cache meanwhile, so
+        buffered fallbacks and other readers can't serve the check from RAM.
+        """
+        eng = self.engine
+        a = eng.args
+        self.phase = "verifying"
+        with eng.lock:
+            chunks = dict(eng.chunks)
+        offsets = sorted(chunks)
+        if a.verify == "sample" and len(offsets) > a.verify_samples + 2:
+            picks = set(random.SystemRandom().sample(offsets[1:-1], a.verify_samples))
+            offsets = [o for o in offsets if o in picks or o in (offsets[0], offsets[-1])]
+
+        flags = os.O_RDONLY | getattr(os, "O_CLOEXEC", 0)
+        direct = False
+        if a.direct and hasattr(os, "O_DIRECT"):
+            try:
+                fd = os.open(self.path, flags | os.O_DIRECT)
+                direct = True
+            except OSError:
+                fd = os.open(self.path, flags)
+        else:
+            fd = os.open(self.path, flags)
+
+        def drop_caches():
+            try:
+                fcntl.ioctl(fd, BLKFLSBUF)
+            except OSError:
+                pass
+            try:
+                os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+            except OSError:
+                pass
+
+        stop = threading.Event()
+
+        def dropper():
+            while not stop.wait(0.5):
+                drop_caches()
+
+        local = threading.local()
+        mismatches = []
+        counters = {"bytes": 0, "chunks": 0}
+        lock = threading.Lock()
+
+        def check(offset: int):
+            if not hasattr(local, "buf"):
+                local.buf = mmap.mmap(-1, eng.block + ALIGN)
+            pieces, want = chunks[offset]
+            rel_pieces = []
+            nread = 0
+            for start, length in pieces:
+                rel = start - offset
+                rlen = align_up(length) if direct else length
+                mv = memoryview(local.buf)[rel:rel + rlen]
+                got = 0
+                while got < rlen:
+                    n = os.preadv(fd, [mv[got:]], start + got)
+                    if not n:
+                        break
+                    got += n
+                mv.release()
+                rel_pieces.append((rel, length))
+                nread += got
+            ok = chunk_hash(local.buf, rel_pieces) == want
+            with lock:
+                counters["bytes"] += nread
+                counters["chunks"] += 1
+                if not ok:
+                    mismatches.append(offset)
+
+        t0 = time.time()
+        drop_caches()
+        dt = threading.Thread(target=dropper, name=f"dropcache:{self.path}", daemon=True)
+        dt.start()
+        try:
+            with ThreadPoolExecutor(max_workers=eng.depth) as ex:
+                for _ in ex.map(check, offsets):
+                    pass
+        finally:
+            stop.set()
+            dt.join()
+            os.close(fd)
+        elapsed = max(1e-6, time.time() - t0)
+        mismatches.sort()
+        self.readback = {
+            "mode": a.verify,
+            "direct_io": direct,
+            "chunks_total": len(chunks),
+            "chunks_checked": counters["chunks"],
+            "bytes_read": counters["bytes"],
+            "elapsed_s": round(elapsed, 2),
+            "mbps": round(counters["bytes"] / MIB / elapsed, 2),
+            "mismatch_count": len(mismatches),
+            "mismatch_offsets": mismatches[:100],
+            "ok": not mismatches,
+        }
+        log(f"engine: {self.path}: read back {counters['bytes']} bytes from {counters['chunks']} chunks "
+            f"at {self.readback['mbps']} MB/s, {len(mismatches)} mismatches")
+        if mismatches:
+            self.fail("readback", f"{len(mismatches)} of {counters['chunks']} chunks differ on the target "
+                                  f"(first at byte {mismatches[0]})")
+
+    def trim_snapshot(self) -> dict | None:
+        """Discard / zero-out counters; saved_s estimates host writes avoided at this target's pwrite rate."""
+        if not self.trim:
+            return None
+        with self.progress.lock:
+            t = dict(self.trim)
+            written = self.progress.written - self.progress.skipped
+            pwrite_s = self.pwrite_s
+        if t["zeroed_bytes"] and written and pwrite_s > 0:
+            # pwrite_s is summed over concurrent writers; divide by depth for wall time
+            rate = written / (pwrite_s / self.engine.depth)
+            t["saved_s"] = round(t["zeroed_bytes"] / rate - t["zeroout_s"], 2)
+        t["zeroout_s"] = round(t["zeroout_s"], 2)
+        return t
+
+    def delta_snapshot(self) -> dict | None:
+        if not self.delta:
+            return None
+        with self.progress.lock:
+            d = dict(self.delta)
+        d["read_s"] = round(d["read_s"], 2)
+        d["changed_ratio"] = round(d["bytes_changed"] / d["bytes_compared"], 4) if d["bytes_compared"] else None
+        return d
+
+    def snapshot(self) -> dict:
+        p = self.progress
+        with p.lock:
+            written, durable, syncs, skipped = p.written, p.durable, p.syncs, p.skipped
+        elapsed = max(1e-6, time.time() - self.started)
+        total = int(self.engine.args.expect_size or 0)
+        mbps = written / MIB / elapsed
+        eta = None
+        if total and mbps > 0 and written < total and self.ok:
+            eta = round((total - written) / MIB / mbps, 1)
+        return {
+            "target": self.path,
+            "phase": self.phase,
+            "ok": self.ok,
+            "direct_io": self.direct,
+            "bytes_done": written,
+            "bytes_written": written - skipped,
+            "bytes_skipped": skipped,
+            "bytes_durable": durable,
+            "syncs": syncs,
+            "mbps": round(mbps, 2),
+            "eta_s": eta,
+            "readback": self.readback,
+            "delta": self.delta_snapshot(),
+            "trim": self.trim_snapshot(),
+            "tune": {**self.tune, "write_size": self.write_size, "queue_depth": self.active_depth},
+            "errors": list(self.errors),
+        }
+
+
+class Engine:
+    def __init__(self, args):
+        self.args = args
+        self.block = align_up(max(64 * 1024, int(args.block_size)))
+        self.depth = max(1, int(args.queue_depth))
+        self.sync_bytes = max(0, int(args.sync_mb)) * MIB
+        self.profiles = {}
+        for spec in args.profile or []:
+            # PATH=WRITE_SIZE:DEPTH, learned by an earlier --tune on the same kind of device
+            try:
+                path, _, params = spec.rpartition("=")
+                ws, depth = params.split(":")
+                self.profiles[path] = (int(ws), int(depth))
+            except ValueError:
+                log(f"WARNING: ignoring bad --profile {spec!r}")
+        self.targets = [Target(self, t) for t in dict.fromkeys(args.target)]
+        # every target holds its own queue of buffers, so the ring grows with the fan-out
+        nbuf = max(int(args.buffers), 2 + sum(t.max_depth for t in self.targets))
+        self.ring = Ring(nbuf, self.block)
+        self.refs = [0] * nbuf
+        self.lock = threading.Lock()
+        self.status = StatusFile(args.status)
+        self.abort = threading.Event()
+        self.errors = []
+        self.started = time.time()
+        self.phase = "starting"
+        self.proc = None
+        self.format = args.format
+        self.decoder_argv = []
+        self.decode_busy = 0.0
+        self.decoded = 0
+        self.bmap = None
+        self.bmap_note = None
+        self.bmap_found = [] if args.bmap_out else None
+        self.hasher = hashlib.sha256()
+        self.bytes_hashed = 0
+        self.actual_sha256 = None
+        self.chunks = {} if args.verify != "none" else None
+        # checkpoint/resume (single target only): image sha256 at each buffer end, until durable
+        self.cp = StatusFile(args.checkpoint) if args.checkpoint and len(self.targets) == 1 else None
+        self.prefixes = {}
+        self.resume_at = 0
+        self.resume_tail = max(0, int(args.resume_verify_mb)) * MIB
+        self.resume = None
+        self.zeros = bytes(self.block)
+        self.source_fd = -1
+        self.source_head = b""
+        self.source_bytes = 0
+        self.source_hasher = hashlib.sha256() if args.expect_source_sha256 else None
+        self.source_sha256 = None
+
+    def live_targets(self) -> list:
+        return [t for t in self.targets if t.ok]
+
+    # -- buffers --
+
+    def release(self, idx: int):
+        with self.lock:
+            self.refs[idx] -= 1
+            free = self.refs[idx] <= 0
+        if free:
+            self.ring.free.put(idx)
+
+    def take_buffer(self) -> int | None:
+        """
+        Next free buffer. While the ring is exhausted, a target that has not completed a write for
+        --stall-timeout seconds is failed so the others can go on.
+        """
+        while not self.abort.is_set():
+            try:
+                return self.ring.free.get(timeout=1.0)
+            except queue.Empty:
+                pass
+            now = time.monotonic()
+            for t in self.live_targets():
+                if now - t.last_progress > self.args.stall_timeout:
+                    t.fail("stall", f"no write completed for {self.args.stall_timeout}s")
+            if not self.live_targets():
+                return None
+        return None
+
+    def checkpoint(self, durable: int):
+        """Record that the target holds the image up to durable (called right after an fdatasync)."""
+        if not self.cp or durable <= 0:
+            return
+        with self.lock:
+            prefix = self.prefixes.get(durable)
+            for end in [e for e in self.prefixes if e < durable]:
+                del self.prefixes[end]
+        if not prefix:
+            return
+        a = self.args
+        try:
+            self.cp.write({
+                "version": 1,
+                "target": self.targets[0].path,
+                "target_id": a.target_id or None,
+                "image_id": a.image_id or None,
+                "expect_size": int(a.expect_size or 0) or None,
+                "expect_sha256": (a.expect_sha256 or "").lower() or None,
+                "block_size": self.block,
+                "durable_offset": durable,
+                "prefix_sha256": prefix,
+                "updated_at": time.time(),
+            })
+        except OSError as e:
+            log(f"WARNING: could not write checkpoint: {e}")
+
+    def load_resume(self):
+        """Adopt the checkpoint if it was written for this image, block size and target."""
+        a = self.args
+        try:
+            with open(a.checkpoint, "r", encoding="utf-8") as f:
+                cp = json.load(f)
+        except (OSError, ValueError) as e:
+            self.resume = {"from": 0, "note": f"no usable checkpoint: {e}"}
+            return
+        want = {
+            "target_id": a.target_id or None,
+            "image_id": a.image_id or None,
+            "expect_size": int(a.expect_size or 0) or None,
+            "expect_sha256": (a.expect_sha256 or "").lower() or None,
+            "block_size": self.block,
+        }
+        bad = [k for k, v in want.items() if cp.get(k) != v]
+        offset = int(cp.get("durable_offset") or 0)
+        if bad or not cp.get("prefix_sha256") or offset % self.block and offset != want["expect_size"]:
+            self.resume = {"from": 0, "note": f"checkpoint ignored ({', '.join(bad) or 'offset'} differs)"}
+            return
+        self.resume_at = offset
+        self.resume = {"from": offset, "prefix_sha256": cp["prefix_sha256"], "tail_verified": 0,
+                       "tail_repaired": 0, "note": None}
+
+    def note_chunk(self, buf, offset: int, pieces: list):
+        """Remember what was written at offset (once, for all targets) for read-back verification."""
+        if self.chunks is None or not pieces or offset in self.chunks:
+            return
+        h = chunk_hash(buf, [(start - offset, length) for start, length in pieces])
+        with self.lock:
+            self.chunks[offset] = (pieces, h)
+
+    # -- threads --
+
+    def decoder(self):
+        offset = 0
+        try:
+            src = self.proc.stdout
+            while not self.abort.is_set():
+                idx = self.take_buffer()
+                if idx is None:
+                    break
+                t0 = time.monotonic()
+                n = read_full(src, memoryview(self.ring.bufs[idx]))
+                # time blocked on the pipe = time the decoder needed to produce n bytes
+                self.decode_busy += time.monotonic() - t0
+                if n == 0:
+                    self.ring.free.put(idx)
+                    break
+                buf = self.ring.bufs[idx]
+                with memoryview(buf)[:n] as mv:
+                    self.hasher.update(mv)
+                self.bytes_hashed += n
+                if self.cp:
+                    prefix = self.hasher.copy().hexdigest()
+                    with self.lock:
+                        self.prefixes[offset + n] = prefix
+                    if offset < self.resume_at <= offset + n and (
+                            offset + n != self.resume_at or prefix != self.resume["prefix_sha256"]):
+                        raise RuntimeError(f"resume: image up to byte {self.resume_at} does not match the checkpoint")
+                if self.bmap_found is not None:
+                    self.bmap_found.extend(nonzero_ranges(buf, n, offset))
+                live = self.live_targets()
+                if not live:
+                    self.ring.free.put(idx)
+                    break
+                with self.lock:
+                    self.refs[idx] = len(live)
+                for t in live:
+                    t.queue.put((idx, offset, n))
+                offset += n
+                self.decoded = offset
+                if n < self.ring.size:
+                    break
+        except Exception as e:
+            self.errors.append(f"decode: {e}")
+            self.abort.set()
+
+    def feeder(self):
+        """Pipe the source into the decoder, dropping what was consumed from the page cache."""
+        pos = dropped = 0
+        buf = bytearray(MIB)
+        mv = memoryview(buf)
+        stdin = self.proc.stdin
+        try:
+            os.posix_fadvise(self.source_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
+        except (OSError, AttributeError):
+            pass
+        try:
+            if self.source_head:
+                stdin.write(self.source_head)
+                self.source_bytes += len(self.source_head)
+                if self.source_hasher:
+                    self.source_hasher.update(self.source_head)
+            while not self.abort.is_set() and self.live_targets():
+                n = os.readv(self.source_fd, [buf])
+                if not n:
+                    break
+                if self.source_hasher:
+                    self.source_hasher.update(mv[:n])
+                self.source_bytes += n
+                done = 0
+                while done < n:
+                    done += stdin.write(mv[done:n])
+                pos += n
+                if pos - dropped >= DROP_STEP:
+                    drop_cache(self.source_fd, dropped, pos - dropped)
+                    dropped = pos
+        except (BrokenPipeError, ValueError):
+            pass   # the decoder stopped early; its exit status tells why
+        except OSError as e:
+            self.errors.append(f"read: {e}")
+            self.abort.set()
+        finally:
+            drop_cache(self.source_fd)
+            os.close(self.source_fd)
+            try:
+                stdin.close()
+            except OSError:
+                pass
+
+    # -- reporting --
+
+    def snapshot(self) -> dict:
+        targets = [t.snapshot() for t in self.targets]
+        # top-level progress follows the slowest target still going (or the first, if all failed)
+        live = [x for x in targets if x["ok"]] or targets
+        lead = min(live, key=lambda x: x["bytes_done"]) if live else {}
+        elapsed = max(1e-6, time.time() - self.started)
+        exp = (self.args.expect_sha256 or "").lower()
+        return {
+            "engine": "native",
+            "phase": self.phase,
+            "pid": os.getpid(),
+            "source": self.args.source,
+            "format": self.format,
+            "source_verify": {
+                "expected_sha256": (self.args.expect_source_sha256 or "").lower() or None,
+                "actual_sha256": self.source_sha256,
+                "bytes_read": self.source_bytes,
+                "match": (self.source_sha256 == self.args.expect_source_sha256.lower()) if self.source_sha256 else None,
+            } if self.source_hasher else None,
+            "decoder": {
+                "argv": self.decoder_argv,
+                "threads": self.args.threads or os.cpu_count(),
+                "busy_s": round(self.decode_busy, 2),
+                "mbps": round(self.decoded / MIB / self.decode_busy, 2) if self.decode_busy > 0 else None,
+            },
+            "target": lead.get("target"),
+            "direct_io": lead.get("direct_io"),
+            "block_size": self.block,
+            "queue_depth": self.depth,
+            "sync_bytes": self.sync_bytes,
+            "bytes_decoded": self.decoded,
+            "bytes_done": lead.get("bytes_done", 0),
+            "bytes_written": lead.get("bytes_written", 0),
+            "bytes_skipped": lead.get("bytes_skipped", 0),
+            "bytes_durable": lead.get("bytes_durable", 0),
+            "bytes_total": int(self.args.expect_size or 0) or None,
+            "syncs": lead.get("syncs", 0),
+            "elapsed_s": round(elapsed, 2),
+            "mbps": lead.get("mbps", 0),
+            "eta_s": lead.get("eta_s"),
+            "targets": targets,
+            "targets_ok": sum(1 for x in targets if x["ok"]),
+            "extract_verify": {
+                "expected_sha256": exp or None,
+                "actual_sha256": self.actual_sha256,
+                "bytes_hashed": self.bytes_hashed,
+                "size_match": (self.bytes_hashed == int(self.args.expect_size)) if self.actual_sha256 and self.args.expect_size else None,
+                "match": (self.actual_sha256 == exp) if self.actual_sha256 and exp else None,
+            },
+            "readback": lead.get("readback"),
+            "delta": lead.get("delta"),
+            "trim": lead.get("trim"),
+            "resume": self.resume,
+            "bmap": {
+                "used": bool(self.bmap),
+                "path": self.args.bmap if self.bmap else None,
+                "mapped_bytes": self.bmap.mapped_bytes if self.bmap else None,
+                "generated": self.args.bmap_out if self.bmap_found is not None and self.phase == "done" else None,
+                "note": self.bmap_note,
+            },
+            "errors": list(self.errors) + [f"{x['target']}: {e}" for x in targets for e in x["errors"]],
+            "updated_at": time.time(),
+        }
+
+    def report(self):
+        self.status.write(self.snapshot())
+
+    def load_bmap(self, path: str):
+        """Use a block map only if it describes exactly this image; a wrong map would corrupt the flash."""
+        try:
+            bm = BlockMap.load(path)
+        except Exception as e:
+            self.bmap_note = f"ignored unreadable bmap: {e}"
+            return
+        if self.args.expect_size and bm.image_size != int(self.args.expect_size):
+            self.bmap_note = f"ignored bmap for {bm.image_size} bytes (image is {self.args.expect_size})"
+            return
+        self.bmap = bm
+        self.bmap_found = None
+
+    def fail_all(self, msg: str):
+        for t in self.live_targets():
+            t.fail("engine", msg)
+
+    def reject_image(self, msg: str):
+        """The stream itself is bad: fail every live target, drop the checkpoint, invalidate if asked."""
+        bad = self.live_targets()
+        self.fail_all(msg)
+        if self.cp and os.path.exists(self.args.checkpoint):
+            os.remove(self.args.checkpoint)   # the written data is not the image; nothing to resume
+        self.invalidate(bad)
+
+    def invalidate(self, targets: list):
+        if not self.args.invalidate_on_fail:
+            return
+        for t in targets:
+            try:
+                t.invalidate()
+            except OSError as e:
+                t.errors.append(f"invalidate: {e}")
+
+    # -- main --
+
+    def run(self) -> int:
+        a = self.args
+        for t in self.targets:
+            t.open()
+        try:
+            if not self.live_targets():
+                raise RuntimeError("no target could be opened")
+            if self.cp and a.resume:
+                self.load_resume()
+            elif self.cp and os.path.exists(a.checkpoint):
+                os.remove(a.checkpoint)   # stale: the target is about to be overwritten from byte 0
+            if a.bmap and os.path.exists(a.bmap):
+                self.load_bmap(a.bmap)
+            if a.source == "-":
+                self.source_fd = os.dup(sys.stdin.fileno())
+                while len(self.source_head) < 8:
+                    more = os.read(self.source_fd, 8 - len(self.source_head))
+                    if not more:
+                        break
+                    self.source_head += more
+                if self.format == "auto":
+                    self.format = sniff_bytes(self.source_head)
+                if self.format == "zip":
+                    raise RuntimeError("zip images can't be streamed (unzip needs a seekable file)")
+            elif self.format == "auto":
+                self.format = sniff_format(a.source)
+            self.decoder_argv = decoder_argv(self.format, a.threads)
+            if self.source_fd >= 0:
+                self.proc = subprocess.Popen(self.decoder_argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+            elif self.format == "zip":
+                # unzip needs a seekable file; its reads are dropped from the cache once it is done
+                self.proc = subprocess.Popen(self.decoder_argv + [a.source], stdout=subprocess.PIPE, bufsize=0)
+            else:
+                self.source_fd = os.open(a.source, os.O_RDONLY | getattr(os, "O_CLOEXEC", 0))
+                self.proc = subprocess.Popen(self.decoder_argv, stdin=subprocess.PIPE, stdout=subprocess.PIPE, bufsize=0)
+        except Exception as e:
+            self.errors.append(f"open: {e}")
+            self.phase = "failed"
+            self.report()
+            log(f"ERROR: {e}")
+            return 2
+
+        self.phase = "writing"
+        log(f"engine: format={self.format} decoder={' '.join(self.decoder_argv)} block={self.block} "
+            f"depth={self.depth} buffers={len(self.ring.bufs)} sync_every={self.sync_bytes // MIB}MiB "
+            f"targets={','.join(t.path + ('(direct)' if t.direct else '') for t in self.live_targets())}")
+        if self.bmap:
+            log(f"engine: bmap maps {self.bmap.mapped_bytes // MIB} of {self.bmap.image_size // MIB} MiB; "
+                + ("zeroing the rest (device zero-out, else written)" if self.bmap.generated else "skipping the rest"))
+        elif self.bmap_note:
+            log(f"engine: {self.bmap_note}")
+        if self.resume:
+            log("engine: resume: " + (self.resume["note"] or f"continuing after byte {self.resume_at}, "
+                                                               f"re-checking the last {self.resume_tail // MIB} MiB"))
+        preps = [threading.Thread(target=self.guard, args=(t, t.prepare), daemon=True) for t in self.live_targets()]
+        for p in preps:
+            p.start()
+        for p in preps:
+            p.join()
+        for t in self.live_targets():
+            t.start()
+        dec = threading.Thread(target=self.decoder, name="decode", daemon=True)
+        dec.start()
+        feed = None
+        if self.source_fd >= 0:
+            feed = threading.Thread(target=self.feeder, name="feed", daemon=True)
+            feed.start()
+
+        last_log = 0.0
+        while dec.is_alive():
+            dec.join(timeout=0.5)
+            self.report()
+            now = time.time()
+            if now - last_log >= 5:
+                last_log = now
+                for x in self.snapshot()["targets"]:
+                    if x["ok"]:
+                        log(f"progress: {x['target']}: {x['bytes_done'] // MIB} MiB, {x['mbps']} MB/s"
+                            + (f", eta {x['eta_s']}s" if x["eta_s"] is not None else ""))
+            if self.abort.is_set() and self.proc.poll() is None:
+                self.proc.kill()
+        if not self.live_targets() and self.proc.poll() is None:
+            self.proc.kill()
+
+        rc = self.proc.wait()
+        if feed is not None:
+            feed.join(timeout=30)
+        if feed is None:
+            try:
+                with open(a.source, "rb") as f:
+                    drop_cache(f.fileno())
+            except OSError:
+                pass
+        if rc != 0 and not self.abort.is_set() and self.live_targets():
+            self.errors.append(f"decode: {self.format} decoder exited {rc}")
+        self.phase = "syncing"
+        for t in self.targets:
+            t.join_writers()
+        self.report()
+        streamed = self.live_targets()
+        if self.errors:
+            self.fail_all("decode failed")
+        for t in self.targets:
+            t.finish()
+        if self.errors:
+            self.invalidate(streamed)
+
+        if self.live_targets() and self.source_hasher:
+            self.source_sha256 = self.source_hasher.hexdigest()
+            exp = a.expect_source_sha256.lower()
+            if self.source_sha256 != exp:
+                self.errors.append(f"verify: source sha256 mismatch after {self.source_bytes} bytes: "
+                                   f"expected {exp}, got {self.source_sha256}")
+                self.reject_image("source sha256 mismatch")
+        if self.live_targets():
+            self.actual_sha256 = self.hasher.hexdigest()
+            exp = (a.expect_sha256 or "").lower()
+            if exp and self.actual_sha256 != exp:
+                self.errors.append(f"verify: extract sha256 mismatch after {self.bytes_hashed} bytes: "
+                                   f"expected {exp}, got {self.actual_sha256}")
+                self.reject_image("extract sha256 mismatch")
+            if a.expect_size and self.bytes_hashed != int(a.expect_size):
+                if a.invalidate_on_fail:
+                    self.errors.append(f"verify: decompressed {self.bytes_hashed} bytes, expected {a.expect_size}")
+                    self.reject_image("extract size mismatch")
+                else:
+                    log(f"WARNING: decompressed {self.bytes_hashed} bytes, catalog extract_size is {a.expect_size}")
+
+        if self.chunks is not None and self.live_targets():
+            self.phase = "verifying"
+            self.report()
+            log(f"engine: read-back verify ({a.verify})")
+            vts = []
+            for t in self.live_targets():
+                vt = threading.Thread(target=lambda t=t: self.guard(t, t.verify_readback), daemon=True)
+                vt.start()
+                vts.append(vt)
+            for vt in vts:
+                vt.join()
+
+        if self.live_targets() and self.bmap_found is not None:
+            try:
+                BlockMap(self.decoded, self.bmap_found).save(a.bmap_out)
+            except OSError as e:
+                self.bmap_note = f"could not save bmap: {e}"
+
+        for t in self.live_targets():
+            t.phase = "done"
+        ok = [t for t in self.targets if t.ok]
+        self.phase = "done" if len(ok) == len(self.targets) else ("partial" if ok else "failed")
+        self.report()
+        if self.cp and ok and os.path.exists(a.checkpoint):
+            os.remove(a.checkpoint)
+        if a.ok_list:
+            with open(a.ok_list, "w", encoding="utf-8") as f:
+                f.write("".join(t.path + "\n" for t in ok))
+        s = self.snapshot()
+        for e in s["errors"]:
+            log(f"ERROR: {e}")
+        for x in s["targets"]:
+            log(f"engine: {x['target']}: {'OK' if x['ok'] else 'FAILED'} wrote {x['bytes_written']} bytes "
+                f"(skipped {x['bytes_skipped']}) at {x['mbps']} MB/s, {x['syncs']} syncs")
+            if x["trim"]:
+                t = x["trim"]
+                log(f"engine: {x['target']}: discarded {t['discard_bytes']} bytes in {t['discard_s']}s, device-zeroed "
+                    f"{t['zeroed_bytes']} bytes in {t['zeroout_s']}s" + (f" (~{t['saved_s']}s saved)" if t["saved_s"] is not None else "")
+                    + (f"; {t['note']}" if t["note"] else ""))
+            if x["delta"]:
+                d = x["delta"]
+                log(f"engine: {x['target']}: delta compared {d['bytes_compared']} bytes, {d['bytes_unchanged']} unchanged "
+                    f"({d['read_s']}s reading)" + ("; fell back to plain writes" if d["fallback"] else ""))
+        log(f"engine: {len(ok)}/{len(self.targets)} targets ok in {s['elapsed_s']}s; {self.format} decode {s['decoder']['mbps']} MB/s")
+        if len(ok) == len(self.targets):
+            return 0
+        return 3 if ok else 1
+
+    def guard(self, target: Target, fn):
+        try:
+            fn()
+        except Exception as e:
+            target.fail(fn.__name__, e)
+
+
+def build_parser() -> argparse.ArgumentParser:
+    ap = argparse.ArgumentParser(prog="flash_engine.py", description="jr-golden-sd native flash engine")
+    ap.add_argument("--source", required=True, help="cached image (compressed or raw), or - for stdin")
+    ap.add_argument("--format", default="auto", choices=["auto"] + FORMATS, help="auto = sniff magic bytes")
+    ap.add_argument("--threads", type=int, default=0, help="decoder threads (0 = all cores)")
+    ap.add_argument("--target", required=True, action="append", help="block device to write (repeat to fan out)")
+    ap.add_argument("--status", default="", help="JSON status file, rewritten about once a second")
+    ap.add_argument("--ok-list", default="", help="write the targets that finished cleanly here, one per line")
+    ap.add_argument("--expect-size", type=int, default=0, help="decompressed size (extract_size), for ETA and capacity check")
+    ap.add_argument("--block-size", type=int, default=4 * MIB)
+    ap.add_argument("--buffers", type=int, default=8)
+    ap.add_argument("--queue-depth", type=int, default=4, help="concurrent writes per target")
+    ap.add_argument("--write-size", type=int, default=0, help="bytes per pwrite (0 = --block-size)")
+    ap.add_argument("--tune", action="store_true", help="try write sizes / depths during the first seconds")
+    ap.add_argument("--profile", action="append", default=[], help="PATH=WRITE_SIZE:DEPTH for a target (skips tuning)")
+    ap.add_argument("--sync-mb", type=int, default=64, help="fdatasync after this many MiB (0 = only at the end)")
+    ap.add_argument("--stall-timeout", type=int, default=120, help="fail a target that makes no progress this long")
+    ap.add_argument("--expect-sha256", default="", help="extract_sha256: hash of the decompressed image")
+    ap.add_argument("--expect-source-sha256", default="", help="image_download_sha256: hash of the source bytes as read")
+    ap.add_argument("--invalidate-on-fail", action="store_true", help="zero the first/last MiB of targets if the image is bad")
+    ap.add_argument("--verify", default="none", choices=["none", "sample", "full"], help="read-back verification after the write")
+    ap.add_argument("--verify-samples", type=int, default=64, help="random chunks to read back in sample mode")
+    ap.add_argument("--delta", action="store_true", help="read the target first and write only chunks that differ")
+    ap.add_argument("--delta-max-ratio", type=float, default=0.5, help="fall back to plain writes above this changed fraction")
+    ap.add_argument("--trim", default="auto", choices=["auto", "off"], help="discard before writing, zero sparse ranges on the device")
+    ap.add_argument("--checkpoint", default="", help="single target: record durable progress here at every sync")
+    ap.add_argument("--resume", action="store_true", help="continue from --checkpoint if it matches this image and target")
+    ap.add_argument("--resume-verify-mb", type=int, default=64, help="re-read this much before the checkpoint on resume")
+    ap.add_argument("--target-id", default="", help="stable target identity (serial) stored in the checkpoint")
+    ap.add_argument("--image-id", default="", help="image identity (blob sha256) stored in the checkpoint")
+    ap.add_argument("--bmap", default="", help="bmaptool XML block map; only mapped ranges are written")
+    ap.add_argument("--bmap-out", default="", help="when writing everything, save a block map of non-zero blocks here")
+    ap.add_argument("--no-direct", dest="direct", action="store_false", help="write through the page cache")
+    ap.add_argument("--allow-file", action="store_true", help="allow a regular file target (testing)")
+    return ap
+
+
+def main(argv: list[str]) -> int:
+    args = build_parser().parse_args(argv)
+    return Engine(args).run()
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
@@ -0,0 +1,759 @@
+#!/usr/bin/env python3
+"""
+Random-access index over cached OS images (stdlib only), for /api/os_cache/inspect.
+
+A compressed image can only be entered where its decoder starts from scratch:
+
+  xz     every block; multi-threaded xz writes many. The table comes from the stream index at the end
+         of the file, so building it reads a few KiB.
+  zstd   every frame, found by walking frame and block headers (the seekable format's seek table is a
+         skippable frame and is simply stepped over). Frames without a content size are measured once.
+  gzip   every member (pigz --independent, concatenated gzip). zlib can't resume inside a member, so a
+         single-member image is one unit; the member scan decodes the image once.
+  bzip2 / zip: one unit, read from the start.
+
+Each unit records its compressed (c, cn) and decompressed (u, un) extent. ImageReader.read(offset, n)
+decodes from the start of the unit holding offset and keeps that decoder open, so the mostly-forward
+reads of a partition-table / FAT walk cost one pass over the units they touch.
+
+inspect() parses the MBR (or the GPT behind a protective MBR) and lists the files of FAT partitions,
+including the small first-boot config files that tell systemd (cmdline.txt / firstrun.sh) and
+cloud-init (user-data / meta-data) images apart. Given a write(offset, data) as well, Fat can replace or
+add files in the root directory of a raw image's boot partition (pre-customized images).
+"""
+import bisect, bz2, lzma, os, struct, subprocess, threading, time, uuid, zipfile, zlib
+
+try:
+    from . import flash_engine
+except ImportError:  # run from app/ (job CLI)
+    import flash_engine
+
+MIB = 1024 * 1024
+SECTOR = 512
+READ_STEP = MIB          # compressed bytes fed per step
+OUT_STEP = 4 * MIB       # most decompressed bytes produced per step (a MiB of xz'd zeros is GiBs)
+
+MBR_TYPES = {0x01: "fat12", 0x04: "fat16", 0x06: "fat16", 0x0b: "fat32", 0x0c: "fat32", 0x0e: "fat16",
+             0x82: "linux-swap", 0x83: "linux", 0x8e: "linux-lvm", 0xee: "gpt-protective", 0xef: "efi"}
+GPT_TYPES = {
+    "c12a7328-f81f-11d2-ba4b-00a0c93ec93b": "efi",
+    "ebd0a0a2-b9e5-4433-87c0-68b6b72699c7": "basic-data",
+    "0fc63daf-8483-4772-8e79-3d69d8477de4": "linux",
+    "b921b045-1df0-41c3-af44-4c6f280d3fae": "linux-root-arm64",
+    "69dad710-2ce4-4e3c-b16c-21a1d49abed3": "linux-root-arm",
+    "4f68bce3-e8cd-4db1-96e7-fbcaf984b709": "linux-root-x86-64",
+    "bc13c2ff-59e6-4262-a352-b275fd6f7172": "xbootldr",
+    "0657fd6d-a4ab-43c4-84e5-0933c84b4f4f": "linux-swap",
+}
+# small files worth showing in full: they decide how an image configures itself on first boot
+INIT_FILES = ("cmdline.txt", "config.txt", "firstrun.sh", "userconf.txt", "user-data", "meta-data",
+              "network-config")
+INIT_FILE_MAX = 16 * 1024
+
+
+# -- unit tables --
+
+def xz_varint(buf: bytes, pos: int) -> tuple[int, int]:
+    n = shift = 0
+    while True:
+        b = buf[pos]
+        pos += 1
+        n |= (b & 0x7F) << shift
+        if not b & 0x80:
+            return n, pos
+        shift += 7
+        if shift > 63:
+            raise ValueError("xz: bad varint in index")
+
+
+def xz_units(path: str) -> list[dict]:
+    """Blocks of every stream, walking the stream footers/indexes backwards from the end of the file."""
+    units = []
+    with open(path, "rb") as f:
+        end = f.seek(0, 2)
+        while end > 0:
+            f.seek(end - 4)
+            if f.read(4) == bytes(4):   # stream padding
+                end -= 4
+                continue
+            f.seek(end - 12)
+            footer = f.read(12)
+            if len(footer) != 12 or footer[10:] != b"YZ":
+                raise ValueError("xz: no stream footer")
+            backward = (struct.unpack("<I", footer[4:8])[0] + 1) * 4
+            index_at = end - 12 - backward
+            f.seek(index_at)
+            index = f.read(backward)
+            if index_at < 12 or index[:1] != b"\x00":
+                raise ValueError("xz: bad index")
+            count, pos = xz_varint(index, 1)
+            recs = []
+            for _ in range(count):
+                unpadded, pos = xz_varint(index, pos)
+                usize, pos = xz_varint(index, pos)
+                recs.append(((unpadded + 3) // 4 * 4, usize))
+            hdr = index_at - sum(cn for cn, _ in recs) - 12
+            f.seek(max(0, hdr))
+            if hdr < 0 or f.read(6) != b"\xfd7zXZ\x00":
+                raise ValueError("xz: block sizes don't match the stream header")
+            c = hdr + 12
+            stream = []
+            for cn, un in recs:
+                stream.append({"c": c, "cn": cn, "un": un, "hdr": hdr})
+                c += cn
+            units[:0] = stream
+            end = hdr
+    return units
+
+
+def zstd_units(path: str) -> list[dict]:
+    """Frames, by walking frame headers and block headers (no decoding)."""
+    units = []
+    with open(path, "rb") as f:
+        end = f.seek(0, 2)
+        c = 0
+        while c < end:
+            f.seek(c)
+            head = f.read(8)
+            magic = struct.unpack("<I", head[:4])[0] if len(head) >= 4 else 0
+            if 0x184D2A50 <= magic <= 0x184D2A5F:   # skippable frame (e.g. a seek table)
+                c += 8 + struct.unpack("<I", head[4:8])[0]
+                continue
+            if magic != 0xFD2FB528 or len(head) < 5:
+                raise ValueError(f"zstd: no frame at byte {c}")
+            fhd = head[4]
+            single = fhd >> 5 & 1
+            fcs_len = ((1 if single else 0), 2, 4, 8)[fhd >> 6]
+            p = c + 5 + (0 if single else 1) + (0, 1, 2, 4)[fhd & 3]
+            f.seek(p)
+            fcs = None
+            if fcs_len:
+                fcs = int.from_bytes(f.read(fcs_len), "little") + (256 if fcs_len == 2 else 0)
+            p += fcs_len
+            while True:
+                f.seek(p)
+                raw = f.read(3)
+                if len(raw) != 3:
+                    raise ValueError("zstd: truncated frame")
+                bh = int.from_bytes(raw, "little")
+                btype = bh >> 1 & 3
+                if btype == 3:
+                    raise ValueError("zstd: reserved block type")
+                p += 3 + (1 if btype == 1 else bh >> 3)
+                if bh & 1:
+                    break
+            p += 4 if fhd >> 2 & 1 else 0
+            if p > end:
+                raise ValueError("zstd: truncated frame")
+            units.append({"c": c, "cn": p - c, "un": fcs})
+            c = p
+    return units
+
+
+def gzip_units(path: str) -> list[dict]:
+    """Members, found by decoding the image once."""
+    units = []
+    with open(path, "rb") as f:
+        c = 0
+        d, start, un = None, 0, 0
+        while True:
+            data = f.read(READ_STEP)
+            if not data:
+                break
+            pos = c
+            c += len(data)
+            while data:
+                if d is None:
+                    stripped = data.lstrip(b"\0")   # padding after a member
+                    pos += len(data) - len(stripped)
+                    data = stripped
+                    if not data:
+                        break
+                    d, start, un = zlib.decompressobj(31), pos, 0
+                n = len(data)
+                un += len(d.decompress(data, OUT_STEP))
+                data = d.unconsumed_tail
+                while data and not d.eof:
+                    un += len(d.decompress(data, OUT_STEP))
+                    data = d.unconsumed_tail
+                if d.eof:
+                    data = d.unused_data
+                    pos += n - len(data)
+                    units.append({"c": start, "cn": pos - start, "un": un})
+                    d = None
+                else:
+                    pos += n
+        if d is not None:
+            raise ValueError("gzip: truncated member")
+    return units
+
+
+def build_index(path: str) -> dict:
+    """Unit table for path. Formats without usable entry points get a single unit from byte 0."""
+    fmt = flash_engine.sniff_format(path)
+    size = os.path.getsize(path)
+    note = None
+    units = []
+    try:
+        units = {"xz": xz_units, "zstd": zstd_units, "gzip": gzip_units}.get(fmt, lambda p: [])(path)
+    except (ValueError, OSError, EOFError, zlib.error) as e:
+        note = f"{e}; reading from the start"
+        units = []
+    if fmt == "raw":
+        units = [{"c": 0, "cn": size, "un": size}]
+    elif not units:
+        units = [{"c": 0, "cn": size, "un": None}]
+    idx = {"format": fmt, "size_bytes": size, "units": units}
+    u = 0
+    for i, unit in enumerate(units):
+        if unit["un"] is None and i < len(units) - 1:
+            with ImageReader(path, idx) as r:   # zstd frame written without a content size
+                unit["un"] = r.unit_length(i)
+        unit["u"] = u
+        u += unit["un"] or 0
+    idx["image_bytes"] = u if units[-1]["un"] is not None else None
+    idx["seekable"] = fmt == "raw" or len(units) > 1
+    idx["note"] = note
+    return idx
+
+
+# -- reading --
+
+def inflate(chunks, new):
+    """Decompressed pieces of consecutive streams (gzip members, xz / bzip2 streams), at most OUT_STEP each."""
+    d = None
+    for data in chunks:
+        while data:
+            if d is None or d.eof:
+                data = data.lstrip(b"\0")
+                if not data:
+                    break
+                d = new()
+            if hasattr(d, "unconsumed_tail"):   # zlib
+                out = d.decompress(data, OUT_STEP)
+                data = d.unconsumed_tail or (d.unused_data if d.eof else b"")
+                if out:
+                    yield out
+                continue
+            out = d.decompress(data, OUT_STEP)
+            while True:
+                if out:
+                    yield out
+                if d.eof or d.needs_input:
+                    break
+                out = d.decompress(b"", OUT_STEP)
+            data = d.unused_data if d.eof else b""
+
+
+class ImageReader:
+    """Decompressed-offset reads over an indexed image."""
+
+    def __init__(self, path: str, index: dict):
+        self.path = path
+        self.fmt = index["format"]
+        self.units = index["units"]
+        self.starts = [u.get("u", 0) for u in self.units]
+        self.fd = os.open(path, os.O_RDONLY | getattr(os, "O_CLOEXEC", 0))
+        self.unit = -1
+        self.chunks = iter(())
+        self.buf = b""
+        self.buf_at = 0
+        self.decoded = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def close(self):
+        if hasattr(self.chunks, "close"):
+            self.chunks.close()
+        if self.fd >= 0:
+            flash_engine.drop_cache(self.fd)
+            os.close(self.fd)
+            self.fd = -1
+
+    def compressed(self, c: int, cn: int):
+        end = c + cn
+        while c < end:
+            data = os.pread(self.fd, min(READ_STEP, end - c), c)
+            if not data:
+                return
+            c += len(data)
+            yield data
+
+    def decode(self, unit: dict):
+        fmt = self.fmt
+        if fmt == "raw":
+            yield from self.compressed(unit["c"], unit["cn"])
+        elif fmt == "xz" and "hdr" in unit:
+            head = os.pread(self.fd, 12, unit["hdr"])
+            yield from inflate(self.prefixed(head, unit), lambda: lzma.LZMADecompressor(lzma.FORMAT_XZ))
+        elif fmt == "xz":
+            yield from inflate(self.compressed(unit["c"], unit["cn"]), lzma.LZMADecompressor)
+        elif fmt == "gzip":
+            yield from inflate(self.compressed(unit["c"], unit["cn"]), lambda: zlib.decompressobj(31))
+        elif fmt == "bzip2":
+            yield from inflate(self.compressed(unit["c"], unit["cn"]), bz2.BZ2Decompressor)
+        elif fmt == "zip":
+            with zipfile.ZipFile(self.path) as z:
+                member = max(z.infolist(), key=lambda i: i.file_size)
+                with z.open(member) as src:
+                    while True:
+                        data = src.read(OUT_STEP)
+                        if not data:
+                            return
+                        yield data
+        elif fmt == "zstd":
+            yield from self.zstd(unit)
+        else:
+            raise ValueError(f"can't read {fmt} images")
+
+    def prefixed(self, head: bytes, unit: dict):
+        yield head
+        yield from self.compressed(unit["c"], unit["cn"])
+
+    def zstd(self, unit: dict):
+        # no zstd in the stdlib here: the CLI decodes the frame while a thread feeds it
+        proc = subprocess.Popen(["zstd", "-dcq"], stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+
+        def feed():
+            try:
+                for data in self.compressed(unit["c"], unit["cn"]):
+                    proc.stdin.write(data)
+            except (BrokenPipeError, ValueError, OSError):
+                pass
+            finally:
+                try:
+                    proc.stdin.close()
+                except OSError:
+                    pass
+
+        t = threading.Thread(target=feed, daemon=True)
+        t.start()
+        try:
+            while True:
+                data = proc.stdout.read(OUT_STEP)
+                if not data:
+                    break
+                yield data
+        finally:
+            proc.kill()
+            proc.wait()
+            t.join(timeout=5)
+
+    def open_unit(self, i: int):
+        if hasattr(self.chunks, "close"):
+            self.chunks.close()
+        self.unit = i
+        self.chunks = self.decode(self.units[i])
+        self.buf = b""
+        self.buf_at = self.starts[i]
+
+    def unit_length(self, i: int) -> int:
+        self.open_unit(i)
+        n = sum(len(b) for b in self.chunks)
+        self.unit = -1
+        return n
+
+    def read(self, offset: int, n: int) -> bytes:
+        """n bytes of the decompressed image at offset (fewer at the end of the image)."""
+        out = bytearray()
+        while len(out) < n:
+            at = offset + len(out)
+            i = max(0, bisect.bisect_right(self.starts, at) - 1)
+            if i != self.unit or at < self.buf_at:
+                self.open_unit(i)
+            while self.buf_at + len(self.buf) <= at:
+                self.buf_at += len(self.buf)
+                self.buf = next(self.chunks, b"")
+                self.decoded += len(self.buf)
+                if not self.buf:
+                    break
+            if not self.buf:
+                break
+            k = at - self.buf_at
+            out += self.buf[k:k + n - len(out)]
+        return bytes(out)
+
+
+# -- partition tables + FAT --
+
+def partitions(read) -> dict:
+    mbr = read(0, SECTOR)
+    if len(mbr) < SECTOR or mbr[510:512] != b"\x55\xaa":
+        return {"table": None, "partitions": []}
+    parts = []
+    for i in range(4):
+        e = mbr[446 + 16 * i:462 + 16 * i]
+        start, count = struct.unpack("<II", e[8:16])
+        if e[4] and count:
+            parts.append({"number": i + 1, "start_bytes": start * SECTOR, "size_bytes": count * SECTOR,
+                          "type": f"0x{e[4]:02x}", "kind": MBR_TYPES.get(e[4], "other"), "bootable": e[0] == 0x80})
+    if not any(p["type"] == "0xee" for p in parts):
+        return {"table": "mbr", "disk_id": f"{struct.unpack('<I', mbr[440:444])[0]:08x}", "partitions": parts}
+    hdr = read(SECTOR, SECTOR)
+    if hdr[:8] != b"EFI PART":
+        return {"table": "mbr", "partitions": parts, "note": "protective MBR without a GPT header"}
+    lba, count, esize = struct.unpack("<QII", hdr[72:88])
+    count = min(count, 256)
+    table = read(lba * SECTOR, count * esize)
+    parts = []
+    for i in range(count):
+        e = table[i * esize:(i + 1) * esize]
+        if len(e) < 128 or e[:16] == bytes(16):
+            continue
+        ptype = str(uuid.UUID(bytes_le=bytes(e[:16])))
+        first, last = struct.unpack("<QQ", e[32:48])
+        parts.append({"number": i + 1, "start_bytes": first * SECTOR, "size_bytes": (last - first + 1) * SECTOR,
+                      "type": ptype, "kind": GPT_TYPES.get(ptype, "other"), "bootable": bool(e[48] & 4),
+                      "name": e[56:128].decode("utf-16-le", "replace").rstrip("\0")})
+    return {"table": "gpt", "disk_guid": str(uuid.UUID(bytes_le=bytes(hdr[56:72]))), "partitions": parts}
+
+
+class Fat:
+    """
+    FAT12/16/32 walker over read(offset, n). With write(offset, data) it can also replace or add files
+    in the root directory (write_file); FAT changes are kept in memory until flush().
+    """
+
+    def __init__(self, read, start: int, write=None):
+        bs = read(start, SECTOR)
+        if len(bs) < SECTOR or bs[510:512] != b"\x55\xaa" or b"FAT" not in (bs[54:57], bs[82:85]):
+            raise ValueError("no FAT boot sector")
+        bps, spc, rsvd, nfats, rootents, tot16, _, fatsz16 = struct.unpack("<HBHBHHBH", bs[11:24])
+        tot32, fatsz32, rootclus = struct.unpack("<II4xI", bs[32:48])
+        if bps not in (512, 1024, 2048, 4096) or not spc or spc & (spc - 1) or not nfats:
+            raise ValueError("implausible FAT geometry")
+        fatsz = fatsz16 or fatsz32
+        root_secs = (rootents * 32 + bps - 1) // bps
+        self.data_sec = rsvd + nfats * fatsz + root_secs
+        clusters = ((tot16 or tot32) - self.data_sec) // spc
+        self.bits = 12 if clusters < 4085 else 16 if clusters < 65525 else 32
+        self.read, self.write, self.start, self.bps, self.spc = read, write, start, bps, spc
+        self.clusters = clusters
+        self.nfats = nfats
+        self.fat_at = start + rsvd * bps
+        self.fat_len = fatsz * bps
+        self.fat_pages = {}
+        self.table = None   # whole FAT, once something is written
+        self.fsinfo = start + struct.unpack("<H", bs[48:50])[0] * bps if self.bits == 32 else None
+        self.root = rootclus if self.bits == 32 else None
+        self.root_at = start + (rsvd + nfats * fatsz) * bps
+        self.root_len = root_secs * bps
+        label = bs[71:82] if self.bits == 32 else bs[43:54]
+        self.label = label.decode("ascii", "replace").strip() or None
+        self.cluster_bytes = bps * spc
+
+    def fat_bytes(self, off: int, n: int) -> bytes:
+        if self.table is not None:
+            return bytes(self.table[off:off + n])
+        out = b""
+        while n > 0:
+            page, k = divmod(off, 64 * 1024)
+            if page not in self.fat_pages:
+                self.fat_pages[page] = self.read(self.fat_at + page * 64 * 1024,
+                                                 min(64 * 1024, max(0, self.fat_len - page * 64 * 1024)))
+            chunk = self.fat_pages[page][k:k + n]
+            if not chunk:
+                break
+            out += chunk
+            off += len(chunk)
+            n -= len(chunk)
+        return out
+
+    def entry(self, c: int) -> int:
+        """Raw FAT entry of cluster c (end-of-chain when it lies past the table)."""
+        if self.bits == 12:
+            raw = self.fat_bytes(c + c // 2, 2)
+            v = struct.unpack("<H", raw)[0] if len(raw) == 2 else 0xFFFF
+            return v >> 4 if c & 1 else v & 0xFFF
+        if self.bits == 16:
+            raw = self.fat_bytes(c * 2, 2)
+            return struct.unpack("<H", raw)[0] if len(raw) == 2 else 0xFFFF
+        raw = self.fat_bytes(c * 4, 4)
+        return (struct.unpack("<I", raw)[0] if len(raw) == 4 else 0x0FFFFFFF) & 0x0FFFFFFF
+
+    def next_cluster(self, c: int) -> int | None:
+        v = self.entry(c)
+        return None if v < 2 or v >= {12: 0xFF7, 16: 0xFFF7, 32: 0x0FFFFFF7}[self.bits] else v
+
+    def chain(self, c: int, max_bytes: int) -> list[tuple[int, int]]:
+        """Image extents (offset, length) of a cluster chain, contiguous clusters merged."""
+        runs, seen, total = [], set(), 0
+        while c and c >= 2 and c not in seen and total < max_bytes:
+            seen.add(c)
+            off = self.start + (self.data_sec + (c - 2) * self.spc) * self.bps
+            if runs and runs[-1][0] + runs[-1][1] == off:
+                runs[-1] = (runs[-1][0], runs[-1][1] + self.cluster_bytes)
+            else:
+                runs.append((off, self.cluster_bytes))
+            total += self.cluster_bytes
+            c = self.next_cluster(c)
+        return runs
+
+    def read_chain(self, c: int, max_bytes: int) -> bytes:
+        data = b"".join(self.read(off, n) for off, n in self.chain(c, max_bytes))
+        return data[:max_bytes]
+
+    def dir_extents(self, cluster: int | None) -> list[tuple[int, int]]:
+        return [(self.root_at, self.root_len)] if cluster is None else self.chain(cluster, 4 * MIB)
+
+    def dir_entries(self, cluster: int | None) -> list[dict]:
+        raw = b"".join(self.read(off, n) for off, n in self.dir_extents(cluster))
+        out, lfn = [], {}
+        for i in range(0, len(raw) - 31, 32):
+            e = raw[i:i + 32]
+            if e[0] == 0:
+                break
+            if e[0] == 0xE5:
+                lfn = {}
+                continue
+            attr = e[11]
+            if attr & 0x3F == 0x0F:
+                part = (e[1:11] + e[14:26] + e[28:32]).decode("utf-16-le", "replace")
+                lfn[e[0] & 0x1F] = part.split("\0")[0]
+                continue
+            if attr & 0x08:
+                lfn = {}
+                continue
+            short = e[:8].decode("ascii", "replace").rstrip()
+            ext = e[8:11].decode("ascii", "replace").rstrip()
+            name = "".join(lfn[k] for k in sorted(lfn)) if lfn else (short + ("." + ext if ext else ""))
+            lfn = {}
+            if name in (".", ".."):
+                continue
+            out.append({"name": name, "dir": bool(attr & 0x10), "size": struct.unpack("<I", e[28:32])[0],
+                        "cluster": (struct.unpack("<H", e[20:22])[0] << 16 | struct.unpack("<H", e[26:28])[0]),
+                        "slot": i // 32, "short": bytes(e[:11])})
+        return out
+
+    def listing(self, max_depth: int = 2, max_entries: int = 2000) -> tuple[list[dict], bool]:
+        files, todo = [], [("", self.root, 0)]
+        while todo:
+            prefix, cluster, depth = todo.pop(0)
+            for e in self.dir_entries(cluster):
+                if len(files) >= max_entries:
+                    return files, True
+                path = prefix + "/" + e["name"]
+                files.append({"path": path, "size_bytes": 0 if e["dir"] else e["size"], "dir": e["dir"]})
+                if e["dir"] and depth + 1 < max_depth and e["cluster"]:
+                    todo.append((path, e["cluster"], depth + 1))
+        return files, False
+
+    def find(self, path: str) -> dict | None:
+        cluster, entry = self.root, None
+        for name in [p for p in path.split("/") if p]:
+            entry = next((e for e in self.dir_entries(cluster) if e["name"].lower() == name.lower()), None)
+            if entry is None:
+                return None
+            cluster = entry["cluster"]
+        return entry
+
+    def read_file(self, path: str, max_bytes: int) -> bytes | None:
+        e = self.find(path)
+        if not e or e["dir"]:
+            return None
+        return self.read_chain(e["cluster"], min(e["size"], max_bytes)) if e["cluster"] else b""
+
+    # -- writing (root directory only) --
+
+    def set_entry(self, c: int, v: int):
+        t = self.table
+        if self.bits == 12:
+            off = c + c // 2
+            w = struct.unpack_from("<H", t, off)[0]
+            w = (w & 0x000F) | (v << 4) if c & 1 else (w & 0xF000) | v
+            struct.pack_into("<H", t, off, w)
+        elif self.bits == 16:
+            struct.pack_into("<H", t, c * 2, v)
+        else:
+            struct.pack_into("<I", t, c * 4, (struct.unpack_from("<I", t, c * 4)[0] & 0xF0000000) | v)
+
+    def alloc(self, n: int) -> list[int]:
+        """n free clusters, chained and terminated."""
+        if self.table is None:
+            self.table = bytearray(self.read(self.fat_at, self.fat_len))
+        got = []
+        c = 2
+        while len(got) < n:
+            if c >= self.clusters + 2:
+                raise ValueError("FAT partition is full")
+            if self.entry(c) == 0:
+                got.append(c)
+            c += 1
+        eoc = {12: 0xFFF, 16: 0xFFFF, 32: 0x0FFFFFFF}[self.bits]
+        for a, b in zip(got, got[1:] + [eoc]):
+            self.set_entry(a, b)
+        return got
+
+    def free(self, c: int):
+        if self.table is None:
+            self.table = bytearray(self.read(self.fat_at, self.fat_len))
+        seen = set()
+        while c and c not in seen:
+            seen.add(c)
+            nxt = self.next_cluster(c)
+            self.set_entry(c, 0)
+            c = nxt
+
+    def cluster_at(self, c: int) -> int:
+        return self.start + (self.data_sec + (c - 2) * self.spc) * self.bps
+
+    def root_slots(self, need: int) -> list[int]:
+        """Offsets of need consecutive free root-directory slots; a FAT32 root grows by a cluster if full."""
+        slots = [off + k for off, n in self.dir_extents(self.root) for k in range(0, n, 32)]
+        raw = b"".join(self.read(off, n) for off, n in self.dir_extents(self.root))
+        run = []
+        for i, off in enumerate(slots):
+            if raw[i * 32] in (0x00, 0xE5):
+                run.append(off)
+                if len(run) == need:
+                    return run
+            else:
+                run = []
+        if self.root is None:
+            raise ValueError("root directory is full")
+        last = self.root
+        while self.next_cluster(last):
+            last = self.next_cluster(last)
+        c = self.alloc(1)[0]
+        self.set_entry(last, c)
+        self.write(self.cluster_at(c), bytes(self.cluster_bytes))
+        return self.root_slots(need)
+
+    def short_name(self, name: str) -> bytes:
+        """8.3 alias for name, unique in the root directory."""
+        stem, dot, ext = name.upper().rpartition(".")
+        if not dot:
+            stem, ext = ext, ""
+        keep = lambda x: "".join(ch for ch in x if ch.isalnum() or ch in "$%'-_@~`!(){}^#&")
+        base, suffix = keep(stem), keep(ext)
+        taken = {e["short"] for e in self.dir_entries(self.root)}
+        if (base, suffix) == (stem, ext) and 0 < len(base) <= 8 and len(suffix) <= 3:
+            short = (base.ljust(8) + suffix.ljust(3)).encode()
+            if short not in taken:
+                return short
+        for n in range(1, 1000):
+            tail = f"~{n}"
+            short = ((base[:8 - len(tail)] + tail).ljust(8) + suffix[:3].ljust(3)).encode()
+            if short not in taken:
+                return short
+        raise ValueError(f"no free 8.3 alias for {name}")
+
+    def write_file(self, name: str, data: bytes):
+        """Replace or create a file in the root directory."""
+        t = time.localtime()
+        dtime = t.tm_hour << 11 | t.tm_min << 5 | t.tm_sec // 2
+        ddate = max(0, t.tm_year - 1980) << 9 | t.tm_mon << 5 | t.tm_mday
+        clusters = self.alloc((len(data) + self.cluster_bytes - 1) // self.cluster_bytes) if data else []
+        for i, c in enumerate(clusters):
+            chunk = data[i * self.cluster_bytes:(i + 1) * self.cluster_bytes]
+            self.write(self.cluster_at(c), chunk.ljust(self.cluster_bytes, b"\0"))
+        first = clusters[0] if clusters else 0
+        old = next((e for e in self.dir_entries(self.root) if e["name"].lower() == name.lower() and not e["dir"]), None)
+        if old:
+            if old["cluster"]:
+                self.free(old["cluster"])
+            slots = [off + k for off, n in self.dir_extents(self.root) for k in range(0, n, 32)]
+            off = slots[old["slot"]]
+            e = bytearray(self.read(off, 32))
+        else:
+            short = self.short_name(name)
+            chk = 0
+            for b in short:
+                chk = ((chk >> 1) | (chk & 1) << 7) + b & 0xFF
+            u = (name + "\0").encode("utf-16-le") if len(name) % 13 else name.encode("utf-16-le")
+            u += b"\xff" * (-len(u) % 26)
+            parts = [u[i:i + 26] for i in range(0, len(u), 26)]
+            lfn = [bytes([(i + 1) | (0x40 if i == len(parts) - 1 else 0)]) + p[:10] + bytes([0x0F, 0, chk]) + p[10:22]
+                   + b"\0\0" + p[22:] for i, p in enumerate(parts)]
+            slots = self.root_slots(len(lfn) + 1)
+            for off, ent in zip(slots, reversed(lfn)):
+                self.write(off, ent)
+            off = slots[-1]
+            e = bytearray(32)
+            e[:11] = short
+            e[11] = 0x20
+            struct.pack_into("<HH", e, 14, dtime, ddate)
+        struct.pack_into("<H", e, 18, ddate)
+        struct.pack_into("<H", e, 20, first >> 16)
+        struct.pack_into("<HH", e, 22, dtime, ddate)
+        struct.pack_into("<H", e, 26, first & 0xFFFF)
+        struct.pack_into("<I", e, 28, len(data))
+        self.write(off, bytes(e))
+
+    def flush(self):
+        """Write the in-memory FAT to every copy; the FAT32 free-cluster hint becomes "unknown"."""
+        if self.table is None:
+            return
+        for k in range(self.nfats):
+            self.write(self.fat_at + k * self.fat_len, bytes(self.table))
+        if self.fsinfo:
+            fsi = self.read(self.fsinfo, SECTOR)
+            if fsi[:4] == b"RRaA":
+                self.write(self.fsinfo + 488, b"\xff" * 8)
+
+
+def guess_init_format(names: set) -> str | None:
+    """The catalog's init_format an image's boot partition looks built for."""
+    if "user-data" in names or "meta-data" in names:
+        return "cloudinit-rpi" if "cmdline.txt" in names else "cloudinit"
+    if "cmdline.txt" in names:
+        return "systemd"
+    return None
+
+
+def inspect(read, max_depth: int = 2, max_entries: int = 2000) -> dict:
+    """Partition table, and for each FAT partition its label, files and first-boot config."""
+    table = partitions(read)
+    for p in table["partitions"]:
+        try:
+            fat = Fat(read, p["start_bytes"])
+        except (ValueError, struct.error):
+            sb = read(p["start_bytes"] + 1024, 136)
+            if len(sb) == 136 and sb[56:58] == b"\x53\xef":
+                p["fs"] = "ext4"
+                p["label"] = sb[120:136].split(b"\0")[0].decode("utf-8", "replace") or None
+            continue
+        files, truncated = fat.listing(max_depth, max_entries)
+        p.update({"fs": f"vfat (FAT{fat.bits})", "label": fat.label, "files": files, "files_truncated": truncated})
+        names = {f["path"][1:].lower() for f in files if f["path"].count("/") == 1}
+        init = {}
+        for name in INIT_FILES:
+            if name in names:
+                data = fat.read_file(name, INIT_FILE_MAX) or b""
+                init[name] = data.decode("utf-8", "replace")
+        p["init_files"] = init
+        p["init_format"] = guess_init_format(names)
+    boot = next((p for p in table["partitions"] if "files" in p), None)
+    table["boot_partition"] = boot["number"] if boot else None
+    table["init_format"] = boot.get("init_format") if boot else None
+    return table
+
+
+def customize_boot(read, write, files: dict, cmdline_append: str = "") -> dict:
+    """
+    Write files (name -> bytes) into the root of the image's first FAT partition and append
+    cmdline_append to its cmdline.txt. read/write address the raw image.
+    """
+    fat = None
+    for p in partitions(read)["partitions"]:
+        try:
+            fat = Fat(read, p["start_bytes"], write)
+            break
+        except (ValueError, struct.error):
+            continue
+    if fat is None:
+        raise ValueError("image has no FAT boot partition")
+    files = dict(files)
+    if cmdline_append:
+        cur = fat.read_file("cmdline.txt", 64 * 1024)
+        if cur is None:
+            raise ValueError("boot partition has no cmdline.txt")
+        files["cmdline.txt"] = (cur.decode("utf-8", "replace").strip() + " " + cmdline_append.strip() + "\n").encode()
+    for name, data in files.items():
+        fat.write_file(name, data)
+    fat.flush()
+    return {"partition": p["number"], "label": fat.label, "files": sorted(files)}
@@ -0,0 +1,94 @@
+#!/usr/bin/env bash
+# Two throwaway instances (separate cache dirs, JR_GOLDEN_SD_PEERS pointing at each other):
+# a blob only A has must reach B from A, hash-verified, with the upstream URL unreachable;
+# a blob A holds under the wrong hash must be refused. Needs SD mode (downloads are gated on it).
+set -euo pipefail
+
+cd "${REPO:-/opt/jr-pi-toolkit/golden-sd}" || { echo "FAIL: repo path missing"; exit 2; }
+GUNICORN="${GUNICORN:-.venv/bin/gunicorn}"
+PORT_A="${PORT_A:-8041}"
+PORT_B="${PORT_B:-8042}"
+A="http://127.0.0.1:${PORT_A}"
+B="http://127.0.0.1:${PORT_B}"
+
+tmp="$(mktemp -d)"
+pids=()
+cleanup() {
+  for p in "${pids[@]}"; do kill "$p" 2>/dev/null || true; done
+  wait 2>/dev/null || true
+  rm -rf "$tmp"
+}
+trap cleanup EXIT
+
+mkdir -p "$tmp/a/os/blobs" "$tmp/b"
+
+# Good blob on A; a second file on A whose name is not its hash
+head -c $((3 * 1024 * 1024)) /dev/urandom > "$tmp/good"
+head -c $((1024 * 1024)) /dev/urandom > "$tmp/bad"
+GOOD="$(sha256sum "$tmp/good" | cut -d' ' -f1)"
+BAD="$(sha256sum "$tmp/bad" | cut -d' ' -f1)"
+cp "$tmp/good" "$tmp/a/os/blobs/$GOOD"
+head -c $((1024 * 1024)) /dev/urandom > "$tmp/a/os/blobs/$BAD"
+
+# B's catalog: both images, upstream unreachable, so a peer is the only source
+provider="$(python3 -c 'import json; print(json.load(open("data/os-providers/01-rpi-imager.json"))["id"])')"
+python3 - "$tmp/b/$provider.json" "$GOOD" "$BAD" <<'PY'
+import json, sys
+path, good, bad = sys.argv[1:4]
+items = [{"name": f"Peer smoke {tag}", "url": f"http://127.0.0.1:9/peer-smoke-{tag}.img.xz",
+          "image_download_size": size, "image_download_sha256": sha, "release_date": "2000-01-01"}
+         for tag, sha, size in (("good", good, 3 * 1024 * 1024), ("bad", bad, 1024 * 1024))]
+json.dump({"os_list": items}, open(path, "w"))
+PY
+
+JR_GOLDEN_SD_CACHE_DIR="$tmp/a" JR_GOLDEN_SD_PEERS="$B" \
+  "$GUNICORN" -w 1 -b "127.0.0.1:${PORT_A}" app.app:app >"$tmp/a.log" 2>&1 &
+pids+=($!)
+JR_GOLDEN_SD_CACHE_DIR="$tmp/b" JR_GOLDEN_SD_PEERS="$A" \
+  "$GUNICORN" -w 1 -b "127.0.0.1:${PORT_B}" app.app:app >"$tmp/b.log" 2>&1 &
+pids+=($!)
+./scripts/health-wait.sh "$A/api/health"
+./scripts/health-wait.sh "$B/api/health"
+
+os_id() {
+  curl -sS --max-time 8 "$B/api/os?q=peer%20smoke%20$1" | python3 -c 'import sys, json
+items = json.loads(sys.stdin.read() or "{}").get("items") or []
+if len(items) != 1:
+    raise SystemExit(f"FAIL: expected one catalog item, got {len(items)}")
+print(items[0]["id"])'
+}
+
+# download on B; prints the finished job's status
+download() {
+  local jid
+  jid="$(curl -sS --max-time 8 -H 'Content-Type: application/json' -d "{\"os_id\": \"$1\"}" "$B/api/download_os" \
+    | python3 -c 'import sys, json
+d = json.loads(sys.stdin.read() or "{}")
+if not d.get("job_id"):
+    raise SystemExit(f"FAIL: no download job: {d}")
+print(d["job_id"])')"
+  for _ in $(seq 1 120); do
+    st="$(curl -sS --max-time 3 "$B/api/job/$jid" | python3 -c 'import sys, json; print(json.load(sys.stdin)["job"]["status"])')"
+    [ "$st" != "running" ] && break
+    sleep 0.5
+  done
+  echo "$jid $st"
+}
+
+echo "== blob only A has reaches B from A (expect success, hash verified) =="
+read -r jid st < <(download "$(os_id good)")
+test "$st" = "success" || { echo "FAIL: download job $jid: $st"; cat "$tmp/b/jobs/$jid.log"; exit 3; }
+grep -q "Fetched from peer: $A" "$tmp/b/jobs/$jid.log" || { echo "FAIL: not fetched from peer"; exit 3; }
+test "$(sha256sum "$tmp/b/os/blobs/$GOOD" | cut -d' ' -f1)" = "$GOOD" || { echo "FAIL: blob on B has the wrong hash"; exit 3; }
+echo "OK: fetched from peer, sha256 $GOOD"
+
+echo
+echo "== peer copy that doesn't match its hash (expect refused) =="
+read -r jid st < <(download "$(os_id bad)")
+test "$st" = "failed" || { echo "FAIL: download job $jid: $st"; exit 4; }
+grep -q "Peer copy failed verification: $A" "$tmp/b/jobs/$jid.log" || { echo "FAIL: bad peer copy not refused"; exit 4; }
+test ! -e "$tmp/b/os/blobs/$BAD" || { echo "FAIL: bad copy landed in B's store"; exit 4; }
+echo "OK: bad peer copy refused"
+
+echo
+echo "SMOKE PEER CACHE OK"
@@ -0,0 +1,117 @@
+#!/usr/bin/env bash
+# Thermal readings and pacing against a fake sysfs tree (JR_SYSFS_ROOT): /api/thermal output for
+# cool / firmware-throttled / hot states, then the pacing hysteresis on a stand-in job: stopped at
+# pause_c, still stopped between resume_c and pause_c, continued below resume_c.
+set -euo pipefail
+
+cd "${REPO:-/opt/jr-pi-toolkit/golden-sd}" || { echo "FAIL: repo path missing"; exit 2; }
+GUNICORN="${GUNICORN:-.venv/bin/gunicorn}"
+PY="${PY:-.venv/bin/python}"
+PORT="${PORT:-8043}"
+base="http://127.0.0.1:${PORT}"
+
+tmp="$(mktemp -d)"
+pids=()
+cleanup() {
+  for p in "${pids[@]}"; do kill -CONT "$p" 2>/dev/null || true; kill "$p" 2>/dev/null || true; done
+  wait 2>/dev/null || true
+  rm -rf "$tmp"
+}
+trap cleanup EXIT
+
+sys="$tmp/sys"
+zone="$sys/class/thermal/thermal_zone0"
+mkdir -p "$zone" "$sys/class/thermal/thermal_zone1" "$sys/devices/system/cpu/cpu0/cpufreq" \
+  "$sys/devices/platform/soc/soc:firmware"
+echo cpu-thermal > "$zone/type"
+echo passive > "$zone/trip_point_0_type"
+echo 85000 > "$zone/trip_point_0_temp"
+echo critical > "$zone/trip_point_1_type"
+echo 110000 > "$zone/trip_point_1_temp"
+echo gpu-thermal > "$sys/class/thermal/thermal_zone1/type"
+echo 40000 > "$sys/class/thermal/thermal_zone1/temp"
+echo 1500000 > "$sys/devices/system/cpu/cpu0/cpufreq/scaling_cur_freq"
+echo 2400000 > "$sys/devices/system/cpu/cpu0/cpufreq/cpuinfo_max_freq"
+throttled="$sys/devices/platform/soc/soc:firmware/get_throttled"
+temp() { echo "$(( $1 * 1000 ))" > "$zone/temp"; }
+temp 50
+echo 0 > "$throttled"
+
+export JR_SYSFS_ROOT="$sys" JR_GOLDEN_SD_CACHE_DIR="$tmp/cache"
+"$GUNICORN" -w 1 -b "127.0.0.1:${PORT}" app.app:app >"$tmp/app.log" 2>&1 &
+pids+=($!)
+./scripts/health-wait.sh "$base/api/health"
+
+# thermal <python expression over d (the /api/thermal JSON) that must hold> <label>
+thermal() {
+  curl -sS --max-time 3 "$base/api/thermal" | python3 -c 'import sys, json
+d = json.loads(sys.stdin.read() or "{}")
+t = d.get("thermal") or {}
+if not eval(sys.argv[1]):
+    raise SystemExit(f"FAIL: {sys.argv[2]}: {json.dumps(d)}")
+print("OK:", sys.argv[2])' "$1" "$2"
+}
+
+echo "== cool (expect both zones, passive trip, clock, no flags, not hot) =="
+thermal 't["temp_c"] == 50.0 and len(t["zones"]) == 2 and t["zones"][0]["passive_c"] == 85.0' "zones"
+thermal 't["cpu_mhz"] == 1500 and t["cpu_max_mhz"] == 2400' "cpu clock"
+thermal 't["throttled_raw"] == "0x0" and t["throttled_now"] == [] and d["hot"] == ""' "not throttled, not hot"
+
+# Limits as the app computes them (policy.thermal may override the passive-trip defaults)
+read -r pause resume < <(curl -sS --max-time 3 "$base/api/thermal" | python3 -c 'import sys, json
+d = json.load(sys.stdin); print(int(d["pause_c"]), int(d["resume_c"]))')
+echo "pause_c=$pause resume_c=$resume"
+test "$resume" -lt "$pause" || { echo "FAIL: resume_c not below pause_c"; exit 3; }
+
+echo
+echo "== firmware throttled (get_throttled 0x50005) =="
+echo 0x50005 > "$throttled"
+thermal 't["throttled_now"] == ["under_voltage", "throttled"] and t["throttled_since_boot"] == ["under_voltage", "throttled"]' "flags decoded"
+thermal 'd["hot"] in ("firmware throttled", "")' "hot only for throttled (when policy.thermal.pause_on_throttle)"
+echo 0x50000 > "$throttled"
+thermal 't["throttled_now"] == [] and d["hot"] == ""' "since-boot flags alone don't hold jobs"
+
+echo
+echo "== hot (expect hot at pause_c) =="
+temp "$pause"
+thermal 'd["hot"].endswith("(limit %.0fC)" % d["pause_c"])' "hot at pause_c"
+temp 50
+
+echo
+echo "== pacing hysteresis on a stand-in prefetch job =="
+setsid sleep 600 &
+job=$!
+pids+=("$job")
+"$PY" app/app.py telemetry smoke-thermal --pid "$job" --type prefetch </dev/null >"$tmp/telemetry.log" 2>&1 &
+pids+=($!)
+tel="$tmp/cache/jobs/smoke-thermal.telemetry.json"
+
+state() { awk '{print $3}' "/proc/$job/stat"; }
+# expect <paused true|false> <process state T|S> <label>: wait up to 30s for the sampler
+expect() {
+  for _ in $(seq 1 60); do
+    if [ -f "$tel" ] && python3 -c 'import sys, json; sys.exit(0 if json.load(open(sys.argv[1]))["paused"] == (sys.argv[2] == "true") else 1)' "$tel" "$1" \
+        && [ "$(state)" = "$2" ]; then
+      echo "OK: $3"
+      return 0
+    fi
+    sleep 0.5
+  done
+  echo "FAIL: $3 (state $(state))"; cat "$tmp/telemetry.log"; exit 4
+}
+
+expect false S "cool: job runs"
+temp "$((pause + 1))"
+expect true T "at pause_c: job stopped"
+between=$(( (pause + resume) / 2 ))
+temp "$between"
+sleep 12   # a couple of sampler intervals
+expect true T "${between}C, above resume_c: job still stopped"
+thermal 'd["hot"] == ""' "but a job not paused yet would run at ${between}C"
+temp "$((resume - 1))"
+expect false S "below resume_c: job continued"
+grep -q "THERMAL: pausing job" "$tmp/telemetry.log" && grep -q "THERMAL: resuming job" "$tmp/telemetry.log" \
+  || { echo "FAIL: pause/resume not logged"; exit 4; }
+
+echo
+echo "SMOKE THERMAL OK"